@@ -14,4 +14,13 @@ MEDICAL_CENTERS			= 'Processed Datasets/medical_centers.csv'
 HOSPITALS 				= 'Processed Datasets/hospitals.csv'
 HOSPITALS_YAML 			= 'Processed Datasets/hospitals.yaml'
 DEMOGRAPHICS			= 'Processed Datasets/demographics.csv'
-SAMUR_MERGED			= 'Processed Datasets/Dataset_SAMUR_{0}.csv'
\ No newline at end of file
+DISTRICT_FEATURES		= '../data/district_features.npz'
+SAMUR_MERGED			= 'Processed Datasets/Dataset_SAMUR_{0}.csv'
+DISTRIBUTIONS_YAML		= '../data/distributions.yaml'
+EMERGENCY_RATES			= '../data/emergency_rates.npz'
+CITY_CONFIG				= '../data/city_defaults.yaml'
+TRAFFIC_HISTORY			= 'traffic_data.csv'
+TRAFFIC_DEFAULT_COLUMNS	= '../data/default_columns.csv'
+TRAFFIC_MODELS_LEGACY	= '../data/traffic_models'
+TRAFFIC_MODEL			= '../data/traffic_model.npz'
+DISTRICTS_GEOMETRY		= '../data/madrid_districts_processed/madrid_districts_processed.shp'
\ No newline at end of file
@@ -0,0 +1,149 @@
+import sys, getopt
+import numpy as np
+import pandas as pd
+import yaml
+import DatasetPaths
+
+'''
+Fits the emergency generator distributions used by CitySim from the processed SAMUR dataset.
+
+The dataset is streamed in chunks and every row is reduced to a single integer code
+(severity, month, weekday, hour, district), so all the statistics come out of one bincount
+accumulator instead of per-column value_counts. From that joint count array we derive the
+per-severity marginals written to distributions.yaml (and optionally to the severity_dists
+of a city configuration), and optionally a joint (hour x weekday x district) rate tensor per
+severity that CitySim can load with its emergency_rates parameter.
+'''
+
+SEVERITY_LEVELS = 5
+CHUNK_SIZE = 500000
+COLUMNS = ['Solicitud', 'Gravedad', 'Distrito']
+
+def district_codes(df_districts):
+	# Same normalized names that merge_districts uses to join the SAMUR dataset
+	return dict(zip(df_districts['DATASET_SAMUR'], df_districts['codigo'].astype(int)))
+
+def count_emergencies(chunks, codes, severity_levels=SEVERITY_LEVELS):
+	n_districts = max(codes.values())
+	shape = (severity_levels + 1, 13, 7, 24, n_districts + 1)
+	counts = np.zeros(int(np.prod(shape)), dtype=np.int64)
+	time_min, time_max = None, None
+	dropped = 0
+
+	for chunk in chunks:
+		time = pd.to_datetime(chunk['Solicitud'])
+		severity = pd.to_numeric(chunk['Gravedad'], errors='coerce').fillna(0).astype(np.int64).values
+		district = chunk['Distrito'].map(codes).fillna(0).astype(np.int64).values
+		valid = (severity >= 1) & (severity <= severity_levels) & (district > 0) & time.notna().values
+		dropped += int((~valid).sum())
+
+		time = time[valid]
+		flat = np.ravel_multi_index(
+			(severity[valid], time.dt.month.values, time.dt.weekday.values, time.dt.hour.values, district[valid]),
+			shape)
+		counts += np.bincount(flat, minlength=counts.size)
+
+		if len(time) > 0:
+			time_min = time.min() if time_min is None else min(time_min, time.min())
+			time_max = time.max() if time_max is None else max(time_max, time.max())
+
+	if dropped > 0:
+		print(f'Dropped {dropped} records without valid severity, date or district')
+	return counts.reshape(shape), time_min, time_max
+
+def hour_exposure(time_min, time_max):
+	# Seconds observed for every (hour, weekday) combination in the dataset span
+	hours = pd.date_range(time_min.floor('H'), time_max.floor('H'), freq='H')
+	exposure = np.bincount(hours.hour.values * 7 + hours.weekday.values, minlength=24 * 7)
+	return exposure.reshape(24, 7) * 3600.0
+
+def relative_dist(counts, first):
+	dist = counts / counts.mean()
+	return {i + first: round(float(v), 5) for i, v in enumerate(dist)}
+
+def fit_marginals(counts, time_min, time_max):
+	total_seconds = (time_max - time_min).total_seconds()
+	dists = {}
+	for severity in range(1, counts.shape[0]):
+		sub = counts[severity]
+		district_counts = sub.sum(axis=(0, 1, 2))[1:]
+		dists[severity] = {
+			'frequency': round(float(sub.sum() / total_seconds), 8),
+			'hourly_dist': relative_dist(sub.sum(axis=(0, 1, 3)), 0),
+			'daily_dist': relative_dist(sub.sum(axis=(0, 2, 3)), 1),
+			'monthly_dist': relative_dist(sub.sum(axis=(1, 2, 3))[1:], 1),
+			'district_prob': {d + 1: round(float(v), 5) for d, v in enumerate(district_counts / district_counts.sum())},
+		}
+	return dists
+
+def fit_rate_tensor(counts, time_min, time_max):
+	'''Returns emergencies per second for every [severity, hour, weekday, district] and the monthly
+	modulation that CitySim multiplies on top of it. Index 0 of severity and district is unused,
+	weekday follows datetime.weekday() (0 is Monday).'''
+	joint = counts.sum(axis=1).transpose(0, 2, 1, 3)
+	exposure = hour_exposure(time_min, time_max)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		rates = np.where(exposure[None, :, :, None] > 0, joint / exposure[None, :, :, None], 0.0)
+		monthly = counts.sum(axis=(2, 3, 4)).astype(np.float64)
+		monthly[:, 1:] /= np.maximum(monthly[:, 1:].mean(axis=1, keepdims=True), 1)
+	monthly[:, 0] = 0.0
+	return rates, monthly
+
+def save_distributions(dists, path=DatasetPaths.DISTRIBUTIONS_YAML):
+	with open(path, 'w+', encoding='utf8') as f:
+		yaml.dump(dists, f, allow_unicode=True)
+
+def update_city_config(dists, path=DatasetPaths.CITY_CONFIG):
+	with open(path, encoding='utf8') as f:
+		config = yaml.safe_load(f)
+	config['severity_dists'] = dists
+	with open(path, 'w+', encoding='utf8') as f:
+		yaml.dump(config, f, allow_unicode=True, sort_keys=False)
+
+def save_rate_tensor(rates, monthly, path=DatasetPaths.EMERGENCY_RATES):
+	np.savez(path, rates=rates, monthly=monthly)
+
+def fit_distributions(samur_file, df_districts, joint=False, chunksize=CHUNK_SIZE):
+	chunks = pd.read_csv(samur_file, usecols=COLUMNS, chunksize=chunksize)
+	counts, time_min, time_max = count_emergencies(chunks, district_codes(df_districts))
+	dists = fit_marginals(counts, time_min, time_max)
+	tensors = fit_rate_tensor(counts, time_min, time_max) if joint else None
+	return dists, tensors
+
+def usage():
+	print('fit_distributions.py -s <samurfile> -o <outputyaml> [-c <cityconfig>] [-j <ratesfile>]')
+	print('-c also overwrites the severity_dists of the given city configuration')
+	print('-j also fits the joint (hour x weekday x district) rate tensor and saves it to <ratesfile>')
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'hs:o:c:j:', ['samurfile=', 'outputfile=', 'cityconfig=', 'joint='])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+
+	samur_file = DatasetPaths.SAMUR
+	output_file = DatasetPaths.DISTRIBUTIONS_YAML
+	city_config = None
+	rates_file = None
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ('-s', '--samurfile'):
+			samur_file = arg
+		elif opt in ('-o', '--outputfile'):
+			output_file = arg
+		elif opt in ('-c', '--cityconfig'):
+			city_config = arg
+		elif opt in ('-j', '--joint'):
+			rates_file = arg
+
+	df_districts = pd.read_csv(DatasetPaths.DISTRICTS, encoding='utf-8-sig')
+	dists, tensors = fit_distributions(samur_file, df_districts, joint=rates_file is not None)
+	save_distributions(dists, output_file)
+	if city_config is not None:
+		update_city_config(dists, city_config)
+	if tensors is not None:
+		save_rate_tensor(*tensors, rates_file)
+	print(yaml.dump(dists[1]))
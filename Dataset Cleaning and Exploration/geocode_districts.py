@@ -0,0 +1,66 @@
+import os
+import sys, getopt
+import pandas as pd
+import DatasetPaths
+from utils import coordinatesToKm0
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.envs.spatial_index import DistrictIndex
+
+'''
+Assigns district codes to any dataset with latitude and longitude columns from the district
+geometry, instead of relying on the district names provided by the dataset.
+
+Codes follow the order of the shapes in the shapefile, as in CitySim. Points outside every
+district get code 0. The file is processed in chunks and every chunk is geocoded with one batched
+lookup of the grid index, so millions of rows take seconds.
+'''
+
+CHUNK_SIZE = 1000000
+OUTPUT_COLUMN = 'Distrito_codigo_geo'
+
+def geocode(df, index, latitude_column='latitude', longitude_column='longitude'):
+	x, y = coordinatesToKm0(df[latitude_column].values, df[longitude_column].values)
+	df[OUTPUT_COLUMN] = index.lookup(x, y)
+	return df
+
+def geocode_file(input_file, output_file, latitude_column, longitude_column, geometry=DatasetPaths.DISTRICTS_GEOMETRY, chunksize=CHUNK_SIZE):
+	index = DistrictIndex.from_shapefile(geometry)
+	header = True
+	for chunk in pd.read_csv(input_file, chunksize=chunksize):
+		chunk = geocode(chunk, index, latitude_column, longitude_column)
+		chunk.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+		header = False
+
+def usage():
+	print('geocode_districts.py -i <inputfile> -o <outputfile> [-a <latitudecolumn>] [-n <longitudecolumn>] [-g <shapefile>]')
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'hi:o:a:n:g:', ['inputfile=', 'outputfile=', 'latitude=', 'longitude=', 'geometry='])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+
+	input_file, output_file = None, None
+	latitude_column, longitude_column = 'latitude', 'longitude'
+	geometry = DatasetPaths.DISTRICTS_GEOMETRY
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ('-i', '--inputfile'):
+			input_file = arg
+		elif opt in ('-o', '--outputfile'):
+			output_file = arg
+		elif opt in ('-a', '--latitude'):
+			latitude_column = arg
+		elif opt in ('-n', '--longitude'):
+			longitude_column = arg
+		elif opt in ('-g', '--geometry'):
+			geometry = arg
+	if input_file is None or output_file is None:
+		usage()
+		sys.exit(2)
+
+	geocode_file(input_file, output_file, latitude_column, longitude_column, geometry)
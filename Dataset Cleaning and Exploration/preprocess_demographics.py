@@ -1,7 +1,18 @@
+import hashlib, os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import DatasetPaths
-from utils import sumCells
-from statistics import mean 
+
+'''
+Extracts the district demographic KPIs of the Madrid indicator workbooks, one per year.
+
+Every workbook is parsed once with all its sheets (one per district), the three years in parallel
+processes, and the KPI cells of every sheet are gathered with a single fancy index per year. The
+mean over the years is saved as demographics.csv for the SAMUR merge, and as a feature store .npz
+indexed by district code that CitySim loads with its district_features parameter without pandas.
+The store remembers the workbooks it was built from, so it is only rebuilt when they change.
+'''
 
 kpis = ['density','surface_ha','age_avg','foreigns_perc','people_per_home','elder_alone_perc','monoparental_homes_perc','income','unemployment_perc']
 
@@ -40,29 +51,94 @@ cells2018 = {
 			'unemployment_perc':[(67,3)]
 			}
 
-def getDemographicsDataset(df_districts):
+def workbooks():
+	return [
+		(DatasetPaths.RAW_DEMOGRAPHICS_2016, cells2016),
+		(DatasetPaths.RAW_DEMOGRAPHICS_2017, cells2017),
+		(DatasetPaths.RAW_DEMOGRAPHICS_2018, cells2018),
+	]
+
+def cellIndex(cells):
+	# Row and column of every KPI cell, and the KPI each one adds to
+	flat = [(row, col, k) for k, kpi in enumerate(kpis) for row, col in cells[kpi]]
+	return tuple(np.array(index) for index in zip(*flat))
+
+def parseNumberCells(values):
+	# Vectorized utils.parseNumberCell: '1.234,5 %' strings and plain numbers
+	values = pd.Series(values.ravel())
+	text = values.map(type) == str
+	cleaned = values[text].str.replace('.', '', regex=False).str.replace('%', '', regex=False)
+	cleaned = cleaned.str.replace(' ', '', regex=False).str.replace(',', '.', regex=False)
+	values[text] = cleaned
+	return pd.to_numeric(values, errors='coerce').values.astype(np.float64)
+
+def extractWorkbook(path, cells):
+	'''Sheet names and (sheets x kpis) KPI values of a workbook, all sheets parsed in one pass.'''
+	sheets = pd.read_excel(path, sheet_name=None)
+	rows, cols, kpi = cellIndex(cells)
+	# Sheets other than the districts (blank ones in 2018) can be smaller, their KPIs are NaN
+	missing = np.full(len(rows), np.nan, dtype=object)
+	raw = np.stack([
+		sheet.values[rows, cols] if sheet.shape[0] > rows.max() and sheet.shape[1] > cols.max() else missing
+		for sheet in sheets.values()])
+	values = parseNumberCells(raw).reshape(raw.shape)
+	features = np.zeros((len(kpis), len(sheets)))
+	np.add.at(features, kpi, values.T)
+	return list(sheets.keys()), features.T
+
+def extractAll(sources, workers=None):
+	'''Sheet names of the first workbook and the mean of the KPIs of every year, per sheet.'''
+	paths, cells = zip(*sources)
+	with ProcessPoolExecutor(max_workers=workers or len(sources)) as executor:
+		results = list(executor.map(extractWorkbook, paths, cells))
+	districts = results[0][0]
+	years = [features[[names.index(district) for district in districts]] for names, features in results]
+	return districts, np.mean(years, axis=0)
+
+def sourcesKey(sources):
+	digest = hashlib.sha1(' '.join(kpis).encode())
+	for path, cells in sources:
+		stat = os.stat(path)
+		digest.update(f'{os.path.basename(path)} {stat.st_size} {stat.st_mtime_ns} {sorted(cells.items())}'.encode())
+	return digest.hexdigest()
+
+def saveFeatureStore(df, df_districts, key, path=DatasetPaths.DISTRICT_FEATURES):
+	'''Saves the KPIs as a float matrix indexed by district code (row 0 unused), with their names.'''
+	codes = df['District'].map(dict(zip(df_districts['DATASET_SAMUR'], df_districts['codigo'].astype(int))))
+	features = np.zeros((int(df_districts['codigo'].max()) + 1, len(kpis)))
+	features[codes.values] = df[kpis].values
+	np.savez(path, key=key, names=np.array(kpis), features=features)
+
+def loadFeatureStore(df_districts, key, path=DatasetPaths.DISTRICT_FEATURES):
+	'''Demographics dataframe of a feature store built from the same workbooks, None otherwise.'''
+	if not os.path.isfile(path):
+		return None
+	with np.load(path) as store:
+		if str(store['key']) != key or store['names'].tolist() != kpis:
+			return None
+		features = store['features']
+	codes = df_districts['codigo'].astype(int).values
+	df = pd.DataFrame(features[codes], columns=kpis)
+	df.insert(0, 'District', df_districts['DATASET_SAMUR'].values)
+	return df
 
-	xls2016 = pd.ExcelFile(DatasetPaths.RAW_DEMOGRAPHICS_2016)
-	xls2017 = pd.ExcelFile(DatasetPaths.RAW_DEMOGRAPHICS_2017)
-	xls2018 = pd.ExcelFile(DatasetPaths.RAW_DEMOGRAPHICS_2018)
+def getDemographicsDataset(df_districts, store_file=DatasetPaths.DISTRICT_FEATURES):
+	sources = workbooks()
+	key = sourcesKey(sources)
+	df = loadFeatureStore(df_districts, key, store_file) if store_file else None
+	if df is not None:
+		return df
 
-	districts = xls2016.sheet_names
+	districts, features = extractAll(sources)
 	df = buildBaseDataframe(districts)
-	
-	## Each dataset have its own cell positions for items:
-
-	for district in districts:
-		ds2016 = pd.read_excel(xls2016,district)
-		ds2017 = pd.read_excel(xls2017,district)
-		ds2018 = pd.read_excel(xls2018,district)
-		for kpi in kpis:
-			value = mean([sumCells(ds2016,cells2016[kpi]),sumCells(ds2017,cells2017[kpi]),sumCells(ds2018,cells2018[kpi])])
-			df.loc[df['District']==district,kpi] = value
+	df[kpis] = features
 	#Replace district name with normalized one		
 	df_district_names = df_districts[['DATASET_SAMUR','DATASET_DEMOGRAPHICS']]
 	df = df.merge(df_district_names,left_on='District', right_on='DATASET_DEMOGRAPHICS')		
 	df['District'] = df['DATASET_SAMUR']
 	df.drop(columns=['DATASET_SAMUR','DATASET_DEMOGRAPHICS'],inplace = True)
+	if store_file:
+		saveFeatureStore(df, df_districts, key, store_file)
 	return df
 		
 def buildBaseDataframe(districts):
@@ -70,7 +146,7 @@ def buildBaseDataframe(districts):
 
 
 if __name__ == '__main__':	
-	df_districts = pd.read_csv(DatasetPaths.DISTRICTS, encoding = 'utf8')
+	df_districts = pd.read_csv(DatasetPaths.DISTRICTS, encoding = 'utf-8-sig')
 	df = getDemographicsDataset(df_districts)	
 	print(df.head())
-	df.to_csv(DatasetPaths.DEMOGRAPHICS,index=False)
\ No newline at end of file
+	df.to_csv(DatasetPaths.DEMOGRAPHICS,index=False)
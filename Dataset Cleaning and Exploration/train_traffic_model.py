@@ -0,0 +1,105 @@
+import os
+import sys, getopt
+import pickle
+import numpy as np
+import pandas as pd
+import DatasetPaths
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.envs.traffic_model import LinearTrafficModel
+
+'''
+Trains the multi-output traffic model used by CitySim's TrafficManager.
+
+The traffic history written by compress.py (fecha;distrito;carga, one row per 15 minute slot and
+district) is pivoted to a slots x districts matrix and all the districts are fitted at once with a
+single least squares solve over the calendar features of default_columns.csv. The legacy
+lr_model_<district>.sav regressors can also be converted to the same format, and any model can be
+checked against them.
+'''
+
+SEP = ';'
+
+def read_columns(default_columns=DatasetPaths.TRAFFIC_DEFAULT_COLUMNS):
+	return list(pd.read_csv(default_columns, sep=SEP).columns)
+
+def build_design(dates, model):
+	'''One-hot calendar feature matrix, one row per date'''
+	dates = pd.DatetimeIndex(dates)
+	rows = np.arange(len(dates))
+	x = np.zeros((len(dates), len(model.columns)))
+	x[:, model.year_index] = dates.year.values
+	for prefix, values in (('day_', dates.day.values), ('month_', dates.month.values),
+			('hour-minute_', dates.hour.values * 60 + dates.minute.values), ('weekday_', dates.weekday.values)):
+		x[rows, model._rows(prefix, values)] = 1
+	return x
+
+def train(df_traffic, columns):
+	df_traffic['fecha'] = pd.to_datetime(df_traffic['fecha'])
+	loads = df_traffic.pivot_table(index='fecha', columns='distrito', values='carga', aggfunc='mean').dropna()
+	districts = loads.columns.astype(int).values
+
+	empty = LinearTrafficModel(columns, districts, np.zeros((len(columns), len(districts))), np.zeros(len(districts)))
+	x = np.hstack([build_design(loads.index, empty), np.ones((len(loads), 1))])
+	solution = np.linalg.lstsq(x, loads.values, rcond=None)[0]
+	return LinearTrafficModel.centered(columns, districts, solution[:-1], solution[-1])
+
+def load_legacy(dir_traffic_models=DatasetPaths.TRAFFIC_MODELS_LEGACY):
+	models = {}
+	for model_file in os.listdir(dir_traffic_models):
+		district = int(model_file.split('_')[-1].split('.')[0])
+		with open(os.path.join(dir_traffic_models, model_file), 'rb') as f:
+			models[district] = pickle.load(f)
+	return models
+
+def compare_with_legacy(model, legacy_models, samples=2000, seed=0):
+	'''Maximum absolute difference with the legacy per-district predictions over random 15 minute
+	slots between 2017 and 2024'''
+	rng = np.random.RandomState(seed)
+	dates = pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.randint(0, 8 * 365 * 96, samples) * 15, unit='min')
+	x = build_design(dates, model)
+	prediction = model.predict(x)
+	legacy = np.stack([legacy_models[d].predict(x) for d in model.districts], axis=1)
+	return np.abs(prediction - legacy).max()
+
+def usage():
+	print('train_traffic_model.py [-t <trafficfile>] [-l <legacymodelsdir>] [-o <outputfile>] [-c]')
+	print('-t trains the model from the traffic history written by compress.py')
+	print('-l converts the legacy per-district models instead of training')
+	print('-c compares the predictions with the legacy per-district models')
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'ht:l:o:c', ['trafficfile=', 'legacy=', 'outputfile=', 'check'])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+
+	traffic_file = DatasetPaths.TRAFFIC_HISTORY
+	legacy_dir = None
+	output_file = DatasetPaths.TRAFFIC_MODEL
+	check = False
+	for opt, arg in opts:
+		if opt == '-h':
+			usage()
+			sys.exit()
+		elif opt in ('-t', '--trafficfile'):
+			traffic_file = arg
+		elif opt in ('-l', '--legacy'):
+			legacy_dir = arg
+		elif opt in ('-o', '--outputfile'):
+			output_file = arg
+		elif opt in ('-c', '--check'):
+			check = True
+
+	columns = read_columns()
+	if legacy_dir is not None:
+		model = LinearTrafficModel.from_sklearn(load_legacy(legacy_dir), columns)
+	else:
+		model = train(pd.read_csv(traffic_file, sep=SEP), columns)
+	model.save(output_file)
+	print(f'Saved {model.coef.shape[0]} features x {model.coef.shape[1]} districts to {output_file}')
+
+	if check:
+		diff = compare_with_legacy(model, load_legacy(legacy_dir or DatasetPaths.TRAFFIC_MODELS_LEGACY))
+		print(f'Maximum difference with the legacy models: {diff:.6f}')
@@ -0,0 +1,76 @@
+"""
+Hospital coverage rasters of CitySim: cost and accuracy against _displacement_time.
+
+Builds the coverage raster (or loads it from its cache), checks the travel times of random
+hospital and cell pairs against _displacement_time with the same traffic, and compares the time
+of a whole raster per traffic slot with the queries it replaces. Then reports the inhabitants
+covered within 8 and 15 minutes along one simulated day.
+
+    python benchmarks/coverage.py [pairs] [cell size in km]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.envs.citysim import CitySim
+
+if __name__ == "__main__":
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    cell = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+    env = CitySim(
+        city_config=ROOT / "data/city_defaults.yaml",
+        city_geometry=ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        traffic_default_cols=ROOT / "data/default_columns.csv",
+        traffic_models=ROOT / "data/traffic_model.npz",
+        time_step=300,
+        coverage_cell=cell,
+    )
+    env.seed(0)
+    env.reset()
+    while env.traffic_manager.last_update == 0:
+        env.step([[0, 0, 0]])
+
+    start = time.perf_counter()
+    coverage = env._get_coverage()
+    print(
+        f"Raster of {len(coverage.x)} cells of {cell} km, {env.n_hospitals} hospitals: "
+        f"{time.perf_counter() - start:.2f} s to build or load, {coverage.lengths.nbytes / 2**20:.1f} MiB"
+    )
+
+    start = time.perf_counter()
+    times = env.coverage_times()
+    raster_seconds = time.perf_counter() - start
+
+    rng = np.random.RandomState(1)
+    hospitals = rng.randint(1, env.n_hospitals + 1, pairs)
+    cells = rng.randint(len(coverage.x), size=pairs)
+    start = time.perf_counter()
+    reference = np.array(
+        [
+            env._displacement_time(
+                (env.hospital_x[h], env.hospital_y[h], env.hospital_district[h]), (coverage.x[c], coverage.y[c], 0)
+            )
+            for h, c in zip(hospitals.tolist(), cells.tolist())
+        ]
+    )
+    query_seconds = (time.perf_counter() - start) / pairs
+    error = np.abs(times[hospitals, cells] - reference) / np.maximum(reference, 1e-9)
+    print(
+        f"Max relative difference to _displacement_time {error.max():.2e}; one raster "
+        f"{raster_seconds * 1000:.1f} ms against {query_seconds * times[1:].size:.1f} s of queries"
+    )
+
+    # Coverage along a day, every hour
+    population = env.cell_population.sum()
+    for step in range(24):
+        for _ in range(12):
+            env.step([[0, 0, 0]])
+        covered = [env.covered_population(minutes).sum() / population for minutes in (8, 15)]
+        print(f"  {env.time:%H:%M} covered within 8 min {covered[0]:.1%}, within 15 min {covered[1]:.1%}")
@@ -0,0 +1,37 @@
+"""
+Repeatability of the ES trainer rollouts.
+
+ESTrainer compares the returns of antithetic pairs and of directions evaluated by different
+workers, each one reusing its CitySim between rollouts. This runs a random agent episode, then a
+longer one with another seed on the same environment, then the first one again, and checks that
+both returns are equal, timing every rollout. A random agent dispatches from the first step, so
+its return depends on the traffic, unlike the one of an untrained policy.
+
+    python benchmarks/es_rollouts.py [steps] [actions per round]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.agents.test_agents import RandomAgent
+from src.experiments.es_trainer import rollout
+from src.experiments.sweep import DEFAULT_ENV, _get_env
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 720
+    n_actions = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    env = _get_env(dict(DEFAULT_ENV, kpis=False))
+    agent = RandomAgent(len(env.hospitals) - 1, env.severity_levels, n_actions)
+
+    returns = []
+    for seed, episode_steps in ((0, steps), (1, 2 * steps), (0, steps)):
+        start = time.perf_counter()
+        returns.append(rollout(env, agent, episode_steps, seed))
+        print(f"Seed {seed}, {episode_steps} steps: return {returns[-1][0]:.1f} in {time.perf_counter() - start:.1f} s")
+    assert returns[2] == returns[0], "Rollouts with the same seed differ"
+    print("Rollouts with the same seed match")
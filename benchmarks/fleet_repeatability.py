@@ -0,0 +1,38 @@
+"""
+Repeatability of the fleet optimizer evaluations.
+
+FleetOptimizer memoizes rewards by (allocation, seed) and compares candidates simulated by
+different workers, each one reusing its CitySim between evaluations. This evaluates the configured
+allocation, then a longer episode with another seed on the same environment, then the configured
+allocation again, and checks that both rewards are equal, timing every evaluation.
+
+    python benchmarks/fleet_repeatability.py [steps] [stress]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.experiments.fleet_optimizer import _evaluate
+from src.experiments.sweep import DEFAULT_ENV, _get_env, allocate
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 720
+    stress = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    env = _get_env(DEFAULT_ENV)
+    configured = np.array(env.config_ambulances[1:])
+    allocation = tuple(allocate(configured, int(configured.sum())).tolist())
+
+    rewards = []
+    for seed, episode_steps in ((0, steps), (1, 2 * steps), (0, steps)):
+        start = time.perf_counter()
+        rewards.append(_evaluate(allocation, seed, episode_steps, stress, "greedy", DEFAULT_ENV))
+        print(f"Seed {seed}, {episode_steps} steps: reward {rewards[-1]:.1f} in {time.perf_counter() - start:.1f} s")
+    assert rewards[2] == rewards[0], "Evaluations of the same allocation and seed differ"
+    print("Evaluations of the same allocation and seed match")
@@ -0,0 +1,99 @@
+"""
+Speed and accuracy of the simplified levels of detail of the CitySim geometry.
+
+For every tolerance, reports the vertices and the area and boundary errors of the zones, then
+compares with the exact zones the zone assignment of random points (lookup), the sampling of
+emergency locations (random_point) and the travel times of random routes, which go through
+route_lengths and the traffic model as in CitySim.
+
+    python benchmarks/geometry_lod.py [routes] [tolerances in m ...]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.envs.citysim import CitySim
+from src.envs.live import sample_points
+
+
+def travel_times(env, origins, destinations, districts):
+    start = time.perf_counter()
+    times = np.array(
+        [
+            env._displacement_time((*origin, district), (*destination, 0))
+            for origin, destination, district in zip(origins, destinations, districts)
+        ]
+    )
+    return times, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    routes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tolerances = [float(t) / 1000 for t in sys.argv[2:]] or [0.005, 0.025, 0.1]
+
+    env = CitySim(
+        city_config=ROOT / "data/city_defaults.yaml",
+        city_geometry=ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        traffic_default_cols=ROOT / "data/default_columns.csv",
+        traffic_models=ROOT / "data/traffic_model.npz",
+        geometry_cache=False,
+    )
+    env.seed(0)
+    env.reset()
+    while env.traffic_manager.last_update == 0:  # Traffic of the first slot, the same for every level
+        env.step([[0, 0, 0]])
+    exact = env.geometry
+
+    _, x, y = sample_points(exact, 200_000, seed=1).T
+    rng = np.random.RandomState(2)
+    pairs = rng.randint(len(x), size=(routes, 2))
+    origins = np.column_stack((x[pairs[:, 0]], y[pairs[:, 0]]))
+    destinations = np.column_stack((x[pairs[:, 1]], y[pairs[:, 1]]))
+    assigned = exact.lookup(x, y)
+    exact_times = None
+
+    print(
+        f"{'tolerance':>9} {'vertices':>8} {'area err':>9} {'bound err':>9} {'build s':>7} "
+        f"{'lookup ms':>9} {'mismatch':>9} {'sample us':>9} {'outside':>8} "
+        f"{'route us':>8} {'time err':>9} {'max err':>8}"
+    )
+    for tolerance in [0.0] + tolerances:
+        start = time.perf_counter()
+        level = exact.simplified(tolerance)
+        build = time.perf_counter() - start
+        summary = level.error_summary()
+
+        # Zone assignment of the same points
+        start = time.perf_counter()
+        zones = level.lookup(x, y)
+        lookup = time.perf_counter() - start
+        mismatch = np.mean(zones != assigned)
+
+        # Emergency locations sampled in every zone, and how many fall outside the exact zone
+        np.random.seed(3)
+        codes = np.repeat(exact.codes, 200)
+        start = time.perf_counter()
+        samples = np.array([level.random_point(code) for code in codes.tolist()])
+        sample = (time.perf_counter() - start) / len(codes)
+        outside = np.mean(exact.lookup(samples[:, 0], samples[:, 1]) != codes)
+
+        # Travel times with the traffic model of the first step
+        env.routing_geometry = level
+        times, seconds = travel_times(env, origins, destinations, level.lookup(origins[:, 0], origins[:, 1]))
+        if exact_times is None:
+            exact_times = times
+        error = np.abs(times - exact_times) / np.maximum(exact_times, 1e-9)
+
+        print(
+            f"{tolerance * 1000:>7g} m {summary['vertices']:>8} {summary['area_error']:>9.2%} "
+            f"{summary['boundary_error'] * 1000:>7.1f} m {build:>7.2f} {lookup * 1000:>9.1f} "
+            f"{mismatch:>9.4%} {sample * 1e6:>9.1f} {outside:>8.3%} {seconds / routes * 1e6:>8.1f} "
+            f"{error.mean():>9.4%} {error.max():>8.3%}"
+        )
+    env.close()
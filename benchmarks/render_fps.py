@@ -0,0 +1,50 @@
+"""
+Frame rate of CitySim.render("rgb_array") on one core, with a loaded city.
+
+    python benchmarks/render_fps.py [stress] [width] [output file]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.agents.test_agents import RandomAgent
+from src.envs.citysim import CitySim
+
+if __name__ == "__main__":
+    stress = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 640
+    render_file = sys.argv[3] if len(sys.argv) > 3 else None
+
+    env = CitySim(
+        city_config=ROOT / "data/city_defaults.yaml",
+        city_geometry=ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        traffic_default_cols=ROOT / "data/default_columns.csv",
+        traffic_models=ROOT / "data/traffic_model.npz",
+        stress=stress,
+        render_width=width,
+        render_file=render_file,
+    )
+    env.seed(0)
+    agent = RandomAgent(len(env.hospitals) - 1, env.severity_levels, 5)
+    observation, info = env.reset(), {}
+
+    start = time.perf_counter()
+    env.render("rgb_array")
+    print(f"Background raster: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    frames, render_seconds = 300, 0.0
+    for _ in range(frames):
+        observation, reward, done, info = env.step(agent(observation, info.get("action_mask")))
+        start = time.perf_counter()
+        frame = env.render("rgb_array")
+        render_seconds += time.perf_counter() - start
+    queued = sum(len(q) for q in env.active_emergencies[1:])
+    print(
+        f"{frame.shape[1]}x{frame.shape[0]} frames, {queued} queued emergencies, "
+        f"{len(env.ambulances)} moving ambulances: {frames / render_seconds:.0f} fps"
+    )
+    env.close()
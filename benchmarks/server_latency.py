@@ -0,0 +1,109 @@
+"""
+Round trip latency of the CitySim server on this machine.
+
+Starts a server with one worker, then measures empty request round trips, and the overhead of a
+remote step over the same step of a local CitySim, checking that both give the same rewards and
+observations, table by table with their dtypes.
+
+    python benchmarks/server_latency.py [steps] [socketpath|host:port]
+"""
+
+import multiprocessing
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.agents.test_agents import NaiveGreedyAgent
+from src.envs.citysim import CitySim
+from src.envs.client import RemoteCitySim, RemoteVecCitySim
+from src.envs.server import EnvServer, parse_address
+
+ENV_KWARGS = {
+    "city_config": ROOT / "data/city_defaults.yaml",
+    "city_geometry": ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+    "traffic_default_cols": ROOT / "data/default_columns.csv",
+    "traffic_models": ROOT / "data/traffic_model.npz",
+    "kpis": False,
+}
+
+
+def microseconds(seconds):
+    seconds = np.asarray(seconds) * 1e6
+    return f"mean {seconds.mean():.1f} us, p50 {np.median(seconds):.1f} us, p99 {np.percentile(seconds, 99):.1f} us"
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    address = parse_address(sys.argv[2]) if len(sys.argv) > 2 else "/tmp/citysim_benchmark.sock"
+
+    server = multiprocessing.Process(target=EnvServer(address, ENV_KWARGS, 1, 5).run)
+    server.start()
+    try:
+        remote = RemoteCitySim(address)
+
+        timings = []
+        for _ in range(20000):
+            start = time.perf_counter()
+            remote.ping()
+            timings.append(time.perf_counter() - start)
+        print(f"Empty round trip: {microseconds(timings[1000:])}")
+
+        # Local episode, recording the agent actions and timing only env.step
+        local = CitySim(**ENV_KWARGS)
+        local.seed(0)
+        random.seed(0)
+        agent = NaiveGreedyAgent(len(local.hospitals) - 1, local.severity_levels, 1)
+        # Copies, the agent edits the tables it is given
+        observation = local.reset()
+        local_observations = [[table.copy() for table in observation]]
+        actions, local_rewards, local_times = [], [], []
+        for _ in range(steps):
+            action = agent(observation)
+            start = time.perf_counter()
+            observation, reward, _, _ = local.step(action)
+            local_times.append(time.perf_counter() - start)
+            actions.append(action)
+            local_rewards.append(reward)
+            local_observations.append([table.copy() for table in observation])
+
+        # The same episode in the server
+        remote.seed(0)
+        remote_observations = [remote.reset()]
+        remote_rewards, remote_times = [], []
+        for action in actions:
+            start = time.perf_counter()
+            observation, reward, _, _ = remote.step(action)
+            remote_times.append(time.perf_counter() - start)
+            remote_rewards.append(reward)
+            remote_observations.append(observation)
+        assert remote_rewards == local_rewards, "Remote and local episodes differ"
+        for step, (expected, actual) in enumerate(zip(local_observations, remote_observations)):
+            for table, (a, b) in enumerate(zip(expected, actual)):
+                assert a.dtype == b.dtype and np.array_equal(a, b), f"Remote table {table} differs at step {step}"
+
+        print(f"Local step:  {microseconds(local_times)}")
+        print(f"Remote step: {microseconds(remote_times)}")
+        print(f"Remote step overhead: {(np.mean(remote_times) - np.mean(local_times)) * 1e6:.1f} us per step")
+
+        # Four environments per message
+        vec = RemoteVecCitySim(address, 4)
+        vec.seed(0)
+        vec.reset()
+        null = np.zeros((4, 1, 3), dtype=np.int64)
+        start = time.perf_counter()
+        for _ in range(steps // 4):
+            vec.step(null)
+        elapsed = time.perf_counter() - start
+        print(f"Batched steps, 4 environments: {elapsed / (steps // 4) / 4 * 1e6:.1f} us per environment step")
+
+        vec.close()
+        remote.close()
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,97 @@
+"""
+Parity and speed of the CitySim stepping backends.
+
+Runs the same episodes with backend="numpy" and with the stepping kernel of kernels.py, checks
+that rewards, observations and final states are identical, and reports the time of the array part
+of the step (transition) and of whole steps. Without Numba the kernel runs as plain Python, which
+still checks its logic but is slower than the NumPy path.
+
+    python benchmarks/step_kernel.py [steps] [stress]
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.agents.test_agents import NaiveGreedyAgent, RandomAgent
+from src.envs.citysim import CitySim
+from src.envs.kernels import HAVE_NUMBA, step_transition
+
+ENV_KWARGS = {
+    "city_config": ROOT / "data/city_defaults.yaml",
+    "city_geometry": ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+    "traffic_default_cols": ROOT / "data/default_columns.csv",
+    "traffic_models": ROOT / "data/traffic_model.npz",
+    "actions_per_round": 10,
+}
+
+
+def same(a, b):
+    return np.array_equal(a, b, equal_nan=a.dtype.kind == "f")
+
+
+def run(env, agent_class, steps, seed):
+    """Rewards, observations and final state of an episode, and its transition and step times."""
+    env.seed(seed)
+    random.seed(seed)
+    agent = agent_class(len(env.hospitals) - 1, env.severity_levels, env.actions_per_round)
+    transition = env._kernel_transition if env.step_kernel is not None else env._numpy_transition
+    timed = {"transition": 0.0}
+
+    def timed_transition(action):
+        start = time.perf_counter()
+        result = transition(action)
+        timed["transition"] += time.perf_counter() - start
+        return result
+
+    env._kernel_transition = env._numpy_transition = timed_transition
+    observation, info = env.reset(), {}
+    rewards, observations = [], []
+    start = time.perf_counter()
+    for _ in range(steps):
+        if agent_class is RandomAgent:
+            action = agent(observation, info.get("action_mask"))
+        else:
+            action = agent(observation)
+        observation, reward, _, info = env.step(action)
+        rewards.append(reward)
+        observations.append(np.concatenate([part.ravel() for part in observation]))
+    elapsed = time.perf_counter() - start
+    del env._kernel_transition, env._numpy_transition
+    return rewards, observations, env.get_state(), timed["transition"] / steps, elapsed / steps
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    stress = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    numpy_env = CitySim(stress=stress, **ENV_KWARGS)
+    kernel_env = CitySim(stress=stress, backend="numba", **ENV_KWARGS)
+    kernel_env.step_kernel = step_transition  # Interpreted kernel when Numba is missing
+    kernel_name = "numba" if HAVE_NUMBA else "python kernel"
+    if HAVE_NUMBA:  # Compile outside of the timings
+        run(kernel_env, RandomAgent, 10, 0)
+
+    for agent_class in (NaiveGreedyAgent, RandomAgent):
+        reference = run(numpy_env, agent_class, steps, 0)
+        result = run(kernel_env, agent_class, steps, 0)
+        assert reference[0] == result[0], "Rewards differ"
+        assert all(np.array_equal(a, b) for a, b in zip(reference[1], result[1])), "Observations differ"
+        assert reference[2].keys() == result[2].keys()
+        assert all(same(reference[2][k], result[2][k]) for k in reference[2]), "States differ"
+
+        print(f"{agent_class.__name__}, {steps} steps at stress {stress}: identical episodes")
+        print(
+            f"  transition: numpy {reference[3] * 1e6:.1f} us, {kernel_name} {result[3] * 1e6:.1f} us, "
+            f"speedup {reference[3] / result[3]:.2f}x"
+        )
+        print(
+            f"  whole step: numpy {reference[4] * 1e6:.1f} us, {kernel_name} {result[4] * 1e6:.1f} us, "
+            f"speedup {reference[4] / result[4]:.2f}x"
+        )
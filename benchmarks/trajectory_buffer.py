@@ -0,0 +1,129 @@
+"""
+Memory and throughput of the shared memory trajectory buffer against lists of observations.
+
+Collects random agent transitions from CitySim, compares the bytes per transition of the usual
+(observation, action, reward, next_observation, done) tuples of arrays with a buffer record,
+checks that decoded observations match the originals, then runs several producer processes
+writing into one buffer while this process samples minibatches and sequences from it.
+
+    python benchmarks/trajectory_buffer.py [transitions] [producers]
+"""
+
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.agents.test_agents import RandomAgent
+from src.experiments.sweep import DEFAULT_ENV, _get_env
+from src.experiments.trajectory_buffer import TrajectoryBuffer, TransitionLayout
+
+ENV_KWARGS = dict(DEFAULT_ENV, stress=3.0, actions_per_round=5)
+
+
+def list_bytes(transition):
+    """Bytes held by a transition tuple: arrays, their headers and the containers."""
+    total = sys.getsizeof(transition)
+    for item in transition:
+        if isinstance(item, list):
+            total += sys.getsizeof(item) + sum(sys.getsizeof(array) for array in item)
+        else:
+            total += sys.getsizeof(item)
+    return total
+
+
+def produce(buffer, index, steps, seed):
+    env = _get_env(ENV_KWARGS)
+    env.seed(seed)
+    agent = RandomAgent(len(env.hospitals) - 1, env.severity_levels, env.actions_per_round)
+    writer = buffer.producer(index)
+    observation, info = env.reset(), {}
+    for _ in range(steps):
+        action = agent(observation, info.get("action_mask"))
+        next_observation, reward, done, next_info = env.step(action)
+        writer.add(observation, action, reward, done, info)
+        observation, info = (env.reset(), {}) if done else (next_observation, next_info)
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    producers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    env = _get_env(ENV_KWARGS)
+    env.seed(0)
+    agent = RandomAgent(len(env.hospitals) - 1, env.severity_levels, env.actions_per_round)
+    layout = TransitionLayout.from_env(env)
+    buffer = TrajectoryBuffer(layout, steps, 1)
+    writer = buffer.producer(0)
+
+    observation, info = env.reset(), {}
+    transitions = []
+    add_seconds = 0.0
+    for _ in range(steps):
+        action = agent(observation, info.get("action_mask"))
+        next_observation, reward, done, next_info = env.step(action)
+        transitions.append((observation, action, reward, next_observation, done))
+        begin = time.perf_counter()
+        writer.add(observation, action, reward, done, info)
+        add_seconds += time.perf_counter() - begin
+        observation, info = next_observation, next_info
+
+    # Memory per million transitions. Consecutive tuples share their observations, count them once
+    per_list = np.mean([list_bytes(t) for t in transitions]) - np.mean([list_bytes(t[3]) for t in transitions])
+    per_list_both = np.mean([list_bytes(t) for t in transitions])
+    per_record = layout.dtype.itemsize
+    print(
+        f"Per million transitions: lists {per_list_both * 1e6 / 2**30:.2f} GiB "
+        f"({per_list * 1e6 / 2**30:.2f} GiB sharing next observations), "
+        f"records {per_record * 1e6 / 2**30:.3f} GiB ({per_record} bytes each)"
+    )
+
+    # Round trip of the observations
+    decoded = layout.decode(buffer.records[0])
+    errors = []
+    for part, name in enumerate(("hospitals", "emergencies", "time", "traffic")):
+        original = np.stack([t[0][part] for t in transitions])
+        error = np.nanmax(np.abs(decoded[part] - original), initial=0)
+        same_nan = np.array_equal(np.isnan(decoded[part]), np.isnan(original))
+        errors.append(f"{name} {error:.4g}{'' if same_nan else ' (NaN mismatch)'}")
+    actions = np.array([np.array(t[1]).reshape(-1, 3) for t in transitions])
+    assert np.array_equal(buffer.records[0]["action"], actions)
+    print("Largest decoding error: " + ", ".join(errors))
+    print(f"Encoding: {add_seconds / steps * 1e6:.1f} us per transition")
+    buffer.close()
+
+    # Producer processes writing while this process samples
+    capacity = steps
+    shared = TrajectoryBuffer(layout, capacity, producers)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=produce, args=(shared, i, steps, i)) for i in range(producers)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    samples = sampled = 0
+    sample_seconds = 0.0
+    while any(worker.is_alive() for worker in workers):
+        if shared.counters.min() < 64:
+            time.sleep(0.01)
+            continue
+        begin = time.perf_counter()
+        batch = shared.sample(256)
+        sequences = shared.sequences(16, 32)
+        sample_seconds += time.perf_counter() - begin
+        samples += 1
+        time.sleep(0.05)  # A learner spends most of its time on the minibatches
+        sampled += len(batch["reward"]) + sequences.size
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{producers} producers: {shared.counters.sum() / elapsed:.0f} transitions/s written, "
+        f"{samples} sample rounds while writing ({sample_seconds / max(samples, 1) * 1000:.1f} ms for 256 "
+        f"transitions and 16 sequences of 32), {sampled} records read"
+    )
+    shared.close()
@@ -0,0 +1,128 @@
+"""
+Time dependent travel times of CitySim: accuracy and speed of the cumulative tables.
+
+Starting at the morning rush hour, computes the travel times of random routes in batch with the
+traffic profile of eta_horizon slots, and checks them against stepping every trip through the
+slot boundaries one by one. Also checks that without a horizon the batch gives the times of
+_displacement_time, and reports how much frozen traffic misses, overall and for trips leaving
+Fuencarral-El Pardo (district 8).
+
+    python benchmarks/travel_times.py [routes] [horizon]
+"""
+
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from src.envs.citysim import CitySim
+from src.envs.live import sample_points
+
+
+def stepped_time(profile, departure, rows, lengths):
+    """Reference travel time, advancing slot by slot through every piece."""
+    clock = departure
+    for row, length in zip(rows, lengths):
+        while length > 0:
+            slot = min(max(int((clock - profile.start) // profile.slot_seconds), 0), profile.speed.shape[1] - 1)
+            speed = row @ profile.speed[:, slot] if isinstance(row, np.ndarray) else profile.speed[row, slot]
+            slot_end = profile.start + (slot + 1) * profile.slot_seconds
+            if slot == profile.speed.shape[1] - 1 or clock + length / speed <= slot_end:
+                clock += length / speed
+                length = 0
+            else:
+                length -= (slot_end - clock) * speed
+                clock = slot_end
+    return clock - departure
+
+
+def reference(env, profile, origins, destinations, districts, departure):
+    times = []
+    for origin, destination, district in zip(origins, destinations, districts):
+        position, length = env.routing_geometry.route_pieces(origin, destination)
+        column = env.zone_traffic_column[position]
+        present = set(column[column >= 0].tolist())
+        if district > 0:
+            present.add(int(env.zone_traffic_column[env.geometry.position(district)]))
+        outside = np.zeros(len(profile.speed))
+        outside[sorted(present) or slice(None)] = 1
+        rows = [c if c >= 0 else outside / outside.sum() for c in column.tolist()]
+        times.append(stepped_time(profile, departure, rows, length))
+    return np.array(times)
+
+
+def make_env(horizon):
+    return CitySim(
+        city_config=ROOT / "data/city_defaults.yaml",
+        city_geometry=ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        traffic_default_cols=ROOT / "data/default_columns.csv",
+        traffic_models=ROOT / "data/traffic_model.npz",
+        time_start=datetime.fromisoformat("2020-01-08T06:50:00"),
+        eta_horizon=horizon,
+    )
+
+
+if __name__ == "__main__":
+    routes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    horizon = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    envs = {}
+    for h in (0, horizon):
+        env = envs[h] = make_env(h)
+        env.seed(0)
+        env.reset()
+        while env.traffic_manager.last_update == 0:
+            env.step([[0, 0, 0]])
+    frozen, dependent = envs[0], envs[horizon]
+    dependent.traffic_manager.traffic = dict(frozen.traffic_manager.traffic)
+    dependent.traffic_manager.profile = None
+
+    points = sample_points(frozen.geometry, 2 * routes, seed=1)
+    districts = points[:routes, 0].astype(int)
+    origins, destinations = points[:routes, 1:], points[routes:, 1:]
+
+    # Frozen traffic: the batch against one _displacement_time per route
+    start = time.perf_counter()
+    single = np.array(
+        [frozen._displacement_time((*o, d), (*e, 0)) for o, e, d in zip(origins, destinations, districts)]
+    )
+    single_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = frozen.travel_times(origins, destinations, origin_districts=districts)
+    batch_seconds = time.perf_counter() - start
+    print(
+        f"Frozen traffic, {routes} routes: max relative difference {np.max(np.abs(batch - single) / single):.2e}, "
+        f"{single_seconds / routes * 1e6:.0f} us per _displacement_time, {batch_seconds / routes * 1e6:.0f} us per route in batch"
+    )
+
+    # Time dependent traffic, against stepping through the slots
+    profile = dependent.traffic_profile()
+    start = time.perf_counter()
+    timed = dependent.travel_times(origins, destinations, origin_districts=districts)
+    timed_seconds = time.perf_counter() - start
+    checked = min(routes, 300)
+    start = time.perf_counter()
+    stepped = reference(dependent, profile, origins[:checked], destinations[:checked], districts[:checked], dependent.clock)
+    stepped_seconds = time.perf_counter() - start
+    print(
+        f"Time dependent, {horizon} slots: max relative difference to stepping {np.max(np.abs(timed[:checked] - stepped) / stepped):.2e}, "
+        f"{timed_seconds / routes * 1e6:.0f} us per route in batch, {stepped_seconds / checked * 1e6:.0f} us stepping"
+    )
+
+    # Queries only search the tables, their cost barely depends on the number of slots
+    for trips in (1, 100, routes):
+        start = time.perf_counter()
+        profile.travel_times(np.full(trips, dependent.clock), np.arange(trips), districts[:trips] - 1, np.full(trips, 30.0))
+        print(f"  {trips} pieces of 30 km: {(time.perf_counter() - start) / trips * 1e6:.1f} us per piece")
+
+    error = (batch - timed) / timed
+    fuencarral = districts == 8
+    print(
+        f"Frozen minus time dependent: mean {error.mean():+.2%}, worst {error[np.argmax(np.abs(error))]:+.2%}; "
+        f"from Fuencarral-El Pardo ({fuencarral.sum()} routes) mean {error[fuencarral].mean():+.2%}"
+    )
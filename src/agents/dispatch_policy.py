@@ -0,0 +1,101 @@
+import numpy as np
+
+
+def flatten_observation(observation):
+    """Flat vector of a tables observation, the same as CitySim._get_obs(mode="flat")."""
+    return np.concatenate([piece.ravel() for piece in observation]).astype(np.float32)
+
+
+class DispatchPolicy():
+    """Linear (hidden=0) or one hidden layer tanh policy from the flat observation to actions.
+
+    Every action row has three heads of scores, severity (0..n_severity_levels), start hospital
+    and end hospital (0..n_hospitals), and takes the best valid entry of each. With an action
+    mask, severities without queued emergencies and hospitals without ambulances are never
+    chosen, the null start hospital 0 always can. All the weights are one flat float32 vector,
+    params, which is what the evolution strategies trainer perturbs.
+    """
+
+    def __init__(self, n_hospitals, n_severity_levels, n_actions, obs_size, hidden=0, seed=0):
+        self.n_hospitals = n_hospitals
+        self.n_severity_levels = n_severity_levels
+        self.n_actions = n_actions
+        self.obs_size = obs_size
+        self.hidden = hidden
+        self.seed = seed
+        self.head_sizes = (n_severity_levels + 1, n_hospitals + 1, n_hospitals + 1)
+        self.n_outputs = n_actions * sum(self.head_sizes)
+
+        # Observations are standardized with fixed statistics, see fit_normalization
+        self.obs_mean = np.zeros(obs_size, dtype=np.float32)
+        self.obs_std = np.ones(obs_size, dtype=np.float32)
+
+        if hidden:
+            self.shapes = [(obs_size, hidden), (hidden,), (hidden, self.n_outputs), (self.n_outputs,)]
+        else:
+            self.shapes = [(obs_size, self.n_outputs), (self.n_outputs,)]
+        self.n_params = sum(int(np.prod(shape)) for shape in self.shapes)
+        self.set_params(self.initial_params())
+
+    def initial_params(self):
+        """Zero output layer, and a random hidden layer scaled to the input size."""
+        params = np.zeros(self.n_params, dtype=np.float32)
+        if self.hidden:
+            rng = np.random.RandomState(self.seed)
+            params[: self.obs_size * self.hidden] = rng.randn(self.obs_size * self.hidden) / np.sqrt(self.obs_size)
+        return params
+
+    def set_params(self, params):
+        self.params = np.asarray(params, dtype=np.float32)
+        self.weights = []
+        offset = 0
+        for shape in self.shapes:
+            size = int(np.prod(shape))
+            self.weights.append(self.params[offset : offset + size].reshape(shape))
+            offset += size
+
+    def fit_normalization(self, observations):
+        """Standardize inputs with the mean and deviation of a list of observations."""
+        flat = np.stack([flatten_observation(observation) for observation in observations])
+        self.obs_mean = flat.mean(axis=0)
+        std = flat.std(axis=0)
+        self.obs_std = np.where(std > 1e-6, std, 1).astype(np.float32)
+
+    def scores(self, observation):
+        x = (flatten_observation(observation) - self.obs_mean) / self.obs_std
+        if self.hidden:
+            x = np.tanh(x @ self.weights[0] + self.weights[1])
+        return (x @ self.weights[-2] + self.weights[-1]).reshape(self.n_actions, -1)
+
+    def __call__(self, observation, action_mask=None):
+        scores = self.scores(observation)
+        n_severity, n_start, _ = self.head_sizes
+        severity = scores[:, :n_severity]
+        start = scores[:, n_severity : n_severity + n_start]
+        end = scores[:, n_severity + n_start :]
+        if action_mask is not None:
+            severity = np.where(action_mask["severity"], severity, -np.inf)
+            valid_start = action_mask["hospital"].copy()
+            valid_start[0] = True
+            start = np.where(valid_start, start, -np.inf)
+        return np.column_stack((severity.argmax(axis=1), start.argmax(axis=1), end.argmax(axis=1)))
+
+    def save(self, path):
+        np.savez(
+            path,
+            params=self.params,
+            obs_mean=self.obs_mean,
+            obs_std=self.obs_std,
+            spec=np.array(
+                [self.n_hospitals, self.n_severity_levels, self.n_actions, self.obs_size, self.hidden, self.seed]
+            ),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            policy = cls(*saved["spec"].tolist())
+            policy.set_params(saved["params"])
+            policy.obs_mean = saved["obs_mean"]
+            policy.obs_std = saved["obs_std"]
+        return policy
@@ -27,14 +27,21 @@ class RandomAgent():
         self.n_severity_levels = n_severity_levels
         self.n_actions = n_actions
 
-    def __call__(self, observation):
-        severities = np.random.randint(self.n_severity_levels+1, size=self.n_actions)
-        start_hospitals = np.random.randint(self.n_hospitals+1, size=self.n_actions)
+    def __call__(self, observation, action_mask=None):
+        if action_mask is None:
+            severities = np.random.randint(self.n_severity_levels+1, size=self.n_actions)
+            start_hospitals = np.random.randint(self.n_hospitals+1, size=self.n_actions)
+        else:
+            # Only sample severities with queued emergencies and hospitals with ambulances
+            valid_severities = np.flatnonzero(action_mask['severity'])
+            valid_hospitals = np.flatnonzero(action_mask['hospital'])
+            if len(valid_hospitals) == 0:
+                return np.zeros((self.n_actions, 3), dtype=int)
+            severities = np.random.choice(valid_severities, size=self.n_actions)
+            start_hospitals = np.random.choice(valid_hospitals, size=self.n_actions)
         end_hospitals = np.random.randint(self.n_hospitals+1, size=self.n_actions)
-        
-        to_return = [(severities[i], start_hospitals[i], end_hospitals[i]) for i in range(self.n_actions)]
 
-        return to_return
+        return np.column_stack((severities, start_hospitals, end_hospitals))
     
 class NaiveGreedyAgent():
     def __init__(self, n_hospitals, n_severity_levels, n_actions):
@@ -54,6 +61,8 @@ class NaiveGreedyAgent():
                 if em[-1] != 0:
                     distances = distances_to_hospitals(em[2], em[3], hospitals)
                     ff_hospital = first_free_hospital(distances, hospitals)
+                    if ff_hospital is None:  # No ambulance left anywhere
+                        break
                     hospitals[ff_hospital][4] -= 1
                     to_return.append((int(em[0]), ff_hospital, int(distances[0][0])))
                     num_actions_taken += 1
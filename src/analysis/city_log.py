@@ -0,0 +1,278 @@
+"""
+Columnar reader and analytics for CitySim text logs (see CitySim log_file).
+
+A log is a sequence of "Reset" lines, one per episode, followed by space separated records:
+
+    EM [timeISO] [severity] [coordXkm] [coordYkm] [district_code] [em_identifier]
+    AM [timeISO] [severity] [hosp_origin] [hosp_destination] [tobjective] [thospital] [em_identifier]
+
+Files are read in fixed size byte chunks. The lines of every chunk are classified with NumPy and
+the EM and AM lines are handed, as two contiguous buffers, to the pandas C parser, so no Python
+code runs per line. Ambulances are joined to their emergency by episode, severity and identifier,
+emergencies still waiting for an ambulance at the end of a chunk are carried over to the next, and
+all the statistics are mergeable sums, so memory stays bounded by the chunk size and several files
+can be analyzed in parallel processes.
+
+    python -m src.analysis.city_log city_log.log [more logs...]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+
+EM_COLUMNS = ["time", "severity", "x", "y", "district", "code"]
+AM_COLUMNS = ["time", "severity", "origin", "destination", "tobjective", "thospital", "code"]
+EPISODE_COLUMNS = ["emergencies", "dispatched", "relocations", "wait_sum", "arrival_sum"]
+
+
+def _seconds(values):
+    """ISO timestamps as int64 seconds since the epoch."""
+    return pd.to_datetime(values).values.astype("datetime64[s]").astype(np.int64)
+
+
+def _empty(columns):
+    return pd.DataFrame({column: np.zeros(0, dtype=np.int64) for column in columns + ["episode"]})
+
+
+def _parse(data, starts, lengths, columns, time_columns):
+    """DataFrame with the lines of a chunk given by their starts and lengths, without their
+    two letter tag.
+    """
+    if len(starts) == 0:
+        return _empty(columns)
+    # Byte mask of the selected lines, including their newline, one byte per byte of the chunk
+    selected = np.zeros(len(data) + 1, dtype=np.int8)
+    selected[starts + 3] = 1
+    selected[starts + lengths + 1] = -1
+    buffer = data[np.cumsum(selected[:-1], dtype=np.int8).view(bool)].tobytes()
+    df = pd.read_csv(io.BytesIO(buffer), sep=" ", header=None, names=columns)
+    for column in time_columns:
+        df[column] = _seconds(df[column])
+    return df
+
+
+def iter_chunks(path, chunk_bytes: int = 1 << 23):
+    """Parse a log in chunks of about chunk_bytes.
+
+    Yields (emergencies, ambulances) DataFrames with the EM and AM records of every chunk, with
+    times in seconds since the epoch and an episode column counting the Reset lines seen before
+    every record (0 for records before the first Reset).
+    """
+    episode = 0
+    remainder = b""
+    with open(path, "rb") as log:
+        while True:
+            block = log.read(chunk_bytes)
+            data = remainder + block
+            if not block:
+                if not data:
+                    return
+                data += b"\n"
+            cut = data.rfind(b"\n") + 1
+            data, remainder = data[:cut], data[cut:]
+            if not data:
+                continue
+
+            array = np.frombuffer(data, dtype=np.uint8)
+            ends = np.flatnonzero(array == ord("\n"))
+            starts = np.concatenate([[0], ends[:-1] + 1])
+            lengths = ends - starts
+            padded = np.append(array, [0, 0])
+            first, second = padded[starts], padded[starts + 1]
+            tag = (first.astype(np.int64) << 8) | second
+            resets = (first == ord("R")) & (second == ord("e"))
+            line_episode = episode + np.cumsum(resets)
+            episode = int(line_episode[-1])
+
+            is_em = (tag == (ord("E") << 8 | ord("M"))) & (lengths > 3)
+            is_am = (tag == (ord("A") << 8 | ord("M"))) & (lengths > 3)
+            emergencies = _parse(array, starts[is_em], lengths[is_em], EM_COLUMNS, ["time"])
+            ambulances = _parse(
+                array, starts[is_am], lengths[is_am], AM_COLUMNS, ["time", "tobjective", "thospital"]
+            )
+            emergencies["episode"] = line_episode[is_em]
+            ambulances["episode"] = line_episode[is_am]
+            yield emergencies, ambulances
+
+            if not block:
+                return
+
+
+def read_log(path, chunk_bytes: int = 1 << 23):
+    """Whole log as (emergencies, ambulances) DataFrames, for logs that fit in memory."""
+    chunks = list(iter_chunks(path, chunk_bytes))
+    if not chunks:
+        return _empty(EM_COLUMNS), _empty(AM_COLUMNS)
+    return (
+        pd.concat([em for em, _ in chunks], ignore_index=True),
+        pd.concat([am for _, am in chunks], ignore_index=True),
+    )
+
+
+def join_dispatches(emergencies, ambulances):
+    """Ambulances sent to emergencies joined to their emergency, with wait (appearance to
+    dispatch) and arrival (appearance to tobjective) times in seconds.
+    """
+    attending = ambulances[ambulances["severity"] > 0]
+    joined = attending.merge(
+        emergencies[["episode", "severity", "code", "time", "x", "y", "district"]],
+        on=["episode", "severity", "code"],
+        suffixes=("", "_appearance"),
+    )
+    joined["wait"] = joined["time"] - joined["time_appearance"]
+    joined["arrival"] = joined["tobjective"] - joined["time_appearance"]
+    return joined
+
+
+def _key(df):
+    """Single int64 (episode, severity, code) key of every emergency record."""
+    return (
+        (df["episode"].values.astype(np.int64) << 40)
+        | (df["severity"].values.astype(np.int64) << 32)
+        | df["code"].values.astype(np.int64)
+    )
+
+
+def _fit(array, shape):
+    """Zero pad an array to at least the given shape."""
+    shape = tuple(max(a, b) for a, b in zip(array.shape, shape))
+    if shape == array.shape:
+        return array
+    padded = np.zeros(shape, dtype=array.dtype)
+    padded[tuple(slice(0, n) for n in array.shape)] = array
+    return padded
+
+
+class LogStats:
+    """Mergeable response time, workload and episode statistics of one or several logs.
+
+    Attributes:
+        bin_seconds: int, width of the response time histogram bins.
+        n_bins: int, number of bins, the last one collects everything above.
+        wait_hist, arrival_hist: np.ndarray [severity, bin], emergencies by wait and arrival time.
+        dispatches: np.ndarray [severity, hospital], ambulances launched by every hospital,
+            severity 0 being moves between hospitals.
+        busy_seconds: np.ndarray [hospital], seconds from launch to thospital of the ambulances
+            launched by every hospital.
+        episodes: DataFrame indexed by (file, episode) with emergencies, dispatched, relocations,
+            unattended, mean_wait and mean_arrival.
+    """
+
+    def __init__(self, bin_seconds: int = 60, max_seconds: int = 4 * 3600):
+        self.bin_seconds = bin_seconds
+        self.n_bins = -(-max_seconds // bin_seconds) + 1
+        self.wait_hist = np.zeros((1, self.n_bins), dtype=np.int64)
+        self.arrival_hist = np.zeros((1, self.n_bins), dtype=np.int64)
+        self.dispatches = np.zeros((1, 1), dtype=np.int64)
+        self.busy_seconds = np.zeros(1, dtype=np.int64)
+        self._episodes = []
+
+    def _histogram(self, hist, severity, seconds):
+        bins = np.clip(seconds // self.bin_seconds, 0, self.n_bins - 1)
+        hist = _fit(hist, (severity.max() + 1, self.n_bins))
+        np.add.at(hist, (severity, bins), 1)
+        return hist
+
+    def update(self, emergencies, joined, ambulances, file=""):
+        """Account the emergencies and ambulances of a chunk, joined being the ambulances that
+        found their emergency (see join_dispatches).
+        """
+        if len(joined):
+            severity = joined["severity"].values
+            self.wait_hist = self._histogram(self.wait_hist, severity, joined["wait"].values)
+            self.arrival_hist = self._histogram(self.arrival_hist, severity, joined["arrival"].values)
+
+        if len(ambulances):
+            severity = ambulances["severity"].values
+            origin = ambulances["origin"].values
+            self.dispatches = _fit(self.dispatches, (severity.max() + 1, origin.max() + 1))
+            np.add.at(self.dispatches, (severity, origin), 1)
+            self.busy_seconds = _fit(self.busy_seconds, (origin.max() + 1,))
+            np.add.at(self.busy_seconds, origin, ambulances["thospital"].values - ambulances["time"].values)
+
+        episodes = pd.DataFrame(
+            {
+                "emergencies": emergencies.groupby("episode").size(),
+                "dispatched": joined.groupby("episode").size(),
+                "relocations": (ambulances["severity"] == 0).groupby(ambulances["episode"]).sum(),
+                "wait_sum": joined.groupby("episode")["wait"].sum(),
+                "arrival_sum": joined.groupby("episode")["arrival"].sum(),
+            },
+            columns=EPISODE_COLUMNS,
+        )
+        episodes["file"] = str(file)
+        self._episodes.append(episodes.fillna(0).reset_index())
+
+    def merge(self, other):
+        """Add the statistics of another LogStats with the same bins."""
+        assert other.bin_seconds == self.bin_seconds and other.n_bins == self.n_bins
+        for name in ("wait_hist", "arrival_hist", "dispatches", "busy_seconds"):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            shape = tuple(max(a, b) for a, b in zip(mine.shape, theirs.shape))
+            setattr(self, name, _fit(mine, shape) + _fit(theirs, shape))
+        self._episodes.extend(other._episodes)
+        return self
+
+    @property
+    def episodes(self):
+        if not self._episodes:
+            return pd.DataFrame(columns=EPISODE_COLUMNS)
+        df = pd.concat(self._episodes, ignore_index=True).groupby(["file", "episode"]).sum()
+        df["unattended"] = df["emergencies"] - df["dispatched"]
+        df["mean_wait"] = df["wait_sum"] / df["dispatched"].where(df["dispatched"] > 0)
+        df["mean_arrival"] = df["arrival_sum"] / df["dispatched"].where(df["dispatched"] > 0)
+        return df.drop(columns=["wait_sum", "arrival_sum"])
+
+    def quantile(self, q, kind="arrival", severity=None):
+        """Quantile q, in seconds (upper bin edge), of the wait or arrival times."""
+        hist = self.wait_hist if kind == "wait" else self.arrival_hist
+        hist = hist[1:].sum(axis=0) if severity is None else _fit(hist, (severity + 1, 1))[severity]
+        total = hist.sum()
+        if total == 0:
+            return float("nan")
+        return float((np.searchsorted(np.cumsum(hist), q * total) + 1) * self.bin_seconds)
+
+
+def analyze_log(path, chunk_bytes: int = 1 << 23, bin_seconds: int = 60, max_seconds: int = 4 * 3600):
+    """LogStats of one log file, read in chunks of chunk_bytes."""
+    stats = LogStats(bin_seconds, max_seconds)
+    pending = None  # Emergencies not attended yet, carried over between chunks
+    for emergencies, ambulances in iter_chunks(path, chunk_bytes):
+        candidates = emergencies if pending is None else pd.concat([pending, emergencies], ignore_index=True)
+        joined = join_dispatches(candidates, ambulances)
+        stats.update(emergencies, joined, ambulances, path)
+
+        # Keep the emergencies of the last episode that have no ambulance yet
+        waiting = ~np.isin(_key(candidates), _key(joined))
+        last_episode = pd.concat([candidates["episode"], ambulances["episode"]]).max()
+        pending = candidates[waiting & (candidates["episode"].values == last_episode)]
+    return stats
+
+
+def analyze_logs(paths, workers=None, **kwargs):
+    """LogStats of several log files, analyzed in parallel processes and merged."""
+    paths = list(paths)
+    if workers == 1 or len(paths) <= 1:
+        results = [analyze_log(path, **kwargs) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_log, path, **kwargs) for path in paths]
+            results = [future.result() for future in futures]
+    stats = results[0] if results else LogStats(kwargs.get("bin_seconds", 60), kwargs.get("max_seconds", 4 * 3600))
+    for other in results[1:]:
+        stats.merge(other)
+    return stats
+
+
+if __name__ == "__main__":
+    stats = analyze_logs(sys.argv[1:])
+    print(stats.episodes.to_string())
+    for severity in range(1, len(stats.arrival_hist)):
+        print(
+            f"Severity {severity}: median wait {stats.quantile(0.5, 'wait', severity):.0f} s, "
+            f"p90 arrival {stats.quantile(0.9, 'arrival', severity):.0f} s"
+        )
+    print("Dispatches per hospital:", stats.dispatches[1:].sum(axis=0))
@@ -0,0 +1,134 @@
+"""
+Periodic checkpoints of CitySim episodes.
+
+A checkpoint is the complete dynamic state of the environment (see CitySim.get_state) saved as a
+compressed .npz file: the queue samples of the KPIs grow with the episode, but are small integers
+that compress about 20 times. The environment only takes the snapshot, a few array copies, and a
+background thread compresses and writes it, so long runs can be checkpointed every few thousand
+steps without stalling. Files are written under a temporary name and renamed, so a crash never
+leaves a partial checkpoint behind, and resuming from the latest one continues the episode bit for
+bit.
+
+Files are named checkpoint_<episode>_<step>.npz, with episode a sequence number that every new
+episode of the directory increases, so the name order is the order of the snapshots even when an
+earlier episode ran longer: rotation drops the files of the earlier episodes first, and the latest
+checkpoint is always one of the current episode.
+"""
+
+import os
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+
+PREFIX = "checkpoint_"
+
+
+def save_state(path, state):
+    """Write a state dict of arrays to path atomically."""
+    path = Path(path)
+    temporary = path.with_name(path.name + ".tmp")
+    with temporary.open("wb") as f:
+        np.savez_compressed(f, **state)
+    os.replace(temporary, path)
+
+
+def load_state(path):
+    with np.load(path) as checkpoint:
+        return {name: checkpoint[name] for name in checkpoint.files}
+
+
+def checkpoint_name(episode, step):
+    return f"{PREFIX}{episode:06d}_{step:012d}.npz"
+
+
+def checkpoint_episode(path):
+    """Episode sequence number of a checkpoint file."""
+    return int(Path(path).stem[len(PREFIX) :].split("_")[0])
+
+
+def latest_checkpoint(directory):
+    """Path of the checkpoint with the highest step of the latest episode in directory, None if
+    there is none."""
+    checkpoints = sorted(Path(directory).glob(PREFIX + "*_*.npz"))
+    return checkpoints[-1] if checkpoints else None
+
+
+class Checkpointer:
+    """Background writer of environment checkpoints.
+
+    Attributes:
+        directory: Path where checkpoint_<episode>_<step>.npz files are written.
+        every: int, steps between two checkpoints.
+        keep: int, number of most recent checkpoints kept on disk.
+        episode: int, sequence number of the current episode, the latest one of the directory
+            until start_episode.
+    """
+
+    def __init__(self, directory, every: int, keep: int = 2):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.every = every
+        self.keep = keep
+        latest = latest_checkpoint(self.directory)
+        self.episode = checkpoint_episode(latest) if latest is not None else 0
+        self.error = None
+        # A single pending snapshot: if the writer is late, a newer snapshot replaces it
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def start_episode(self):
+        """Number the next checkpoints as those of a new episode."""
+        self.episode += 1
+
+    def resume_episode(self, path):
+        """Number the next checkpoints as those of the episode of checkpoint path, being resumed."""
+        path = Path(path)
+        if path.parent.resolve() == self.directory.resolve() and path.name.startswith(PREFIX):
+            self.episode = checkpoint_episode(path)
+
+    def maybe_save(self, env):
+        if self.every > 0 and env.current_step % self.every == 0:
+            self.save(env)
+
+    def save(self, env):
+        """Snapshot the environment now and hand the snapshot to the writer thread."""
+        if self.error is not None:
+            raise self.error
+        item = (self.episode, env.current_step, env.get_state())
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                except queue.Empty:
+                    pass
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            episode, step, state = item
+            try:
+                save_state(self.directory / checkpoint_name(episode, step), state)
+                for old in sorted(self.directory.glob(PREFIX + "*_*.npz"))[: -self.keep]:
+                    old.unlink()
+            except Exception as error:  # Surfaced on the next save
+                self.error = error
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until the pending snapshot, if any, is on disk."""
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
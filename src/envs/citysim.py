@@ -23,21 +23,14 @@ TODO:
 """
 
 import calendar
+import math
 import os
+import random
+import warnings
 from collections import defaultdict, deque, namedtuple
 from datetime import datetime, timedelta
 from pathlib import Path
 import shapefile
-from shapely.geometry import (
-    shape,
-    Polygon,
-    Point,
-    MultiPolygon,
-    LinearRing,
-    MultiLineString,
-    MultiPoint,
-    LineString,
-)
 
 import gym
 import numpy as np
@@ -45,8 +38,15 @@ import pandas as pd
 import yaml
 from gym import spaces
 from gym.utils import seeding
-from recordclass import recordclass
 
+from .sim_calendar import SimCalendar
+from .checkpoint import Checkpointer, latest_checkpoint, load_state
+from .coverage import CoverageRaster
+from .geometry import CityGeometry, level_cache_file
+from .kernels import HAVE_NUMBA, step_transition
+from .metrics import KPITracker
+from .rendering import CityRenderer, FrameWriter
+from .stores import AmbulanceStore, EmergencyQueue
 from .traffic_manager import TrafficManager
 
 
@@ -55,16 +55,76 @@ class CitySim(gym.Env):
 
     Attributes:
         city_config: str or Path, YAML file with parameters describing the city to simulate. If no 
-            file is provided, default values will be used.
-        city_geometry: str or Path, shapefile describing the limits of the city districts.
+            file is provided, default values will be used. Its districts are the zones of
+            city_geometry, which can be finer than the districts of the traffic model (barrios or
+            custom zones): a zone entry may then give the traffic district it belongs to with a
+            traffic_district key, by default the zone code itself.
+        city_geometry: str or Path, shapefile describing the limits of the city zones, with codes
+            1..n in file order.
+        geometry_cache: str or Path, .npz file caching the precomputed geometry index, by default
+            next to city_geometry. False disables the cache.
+        geometry_tolerance: float, or dict with "sampling", "routing" and "observation" keys,
+            simplification tolerance in km of the zones used to sample emergency locations, to
+            split routes by zone and to assign points to zones (observations, replayed records,
+            rendering). 0, the default, uses the exact zones; for example 0.025 (25 m) keeps the
+            zone assignment of nearly every point with a fraction of the vertices. Every level is
+            in self.geometry_levels with its errors, see CityGeometry.simplified.
         time_step: int, seconds advanced at each step. Should be high to avoid sparse actions but low
             to enable accuracy. Compromise. One minute by default.
         stress: float, multiplier for the emergency generator, in order to artificially increase or
             decrease the amount of emergencies and modify the stress to the system.
+        traffic_models: str or Path, .npz file with the multi-output traffic model written by
+            train_traffic_model.py. A directory with the legacy per-district models is also accepted.
         log_file: str or Path, text file where simulation events will be logged in chronological 
             order.
+        emergency_rates: str or Path, optional .npz file written by fit_distributions.py with a joint
+            [severity, hour, weekday, district] rate tensor. When provided, emergencies are generated
+            from it instead of the independent marginals in severity_dists.
+        district_features: str or Path, optional .npz feature store written by
+            preprocess_demographics.py, a [district_code, feature] matrix of static demographic
+            KPIs. When provided, the last table of every observation is a districts table with one
+            row per zone, its code and the features of its (traffic) district.
+        emergency_source: optional object replacing the emergency generator, such as a
+            replay.ReplaySource replaying historical records. It must provide reset() and
+            pop_until(clock), returning arrays t, severity, district, x, y of the emergencies
+            appeared up to clock seconds since time_start (x, y NaN when unknown).
         mov_reward: int, reward that will be assigned to each ambulance that does not attend an 
             emergency, and only moves between hospitals.
+        actions_per_round: int, number of (severity, start_hospital, end_hospital) rows of the
+            action array that step accepts. Invalid rows are ignored, and the action mask returned
+            in the info dict tells which severities and hospitals can be used.
+        kpis: bool, keep streaming response time, queue and fleet KPIs in self.kpis (a
+            metrics.KPITracker). They are also returned in the info dict of the last step of an
+            episode, under "kpis", so evaluation runs do not need the log file. Off by default,
+            the queue samples grow with the episode.
+        kpi_queue_every: int, steps between two samples of the queue lengths.
+        checkpoint_dir: str or Path, directory for periodic checkpoints of the episode state.
+        checkpoint_every: int, steps between two checkpoints, 0 disables checkpointing.
+        resume: bool, continue from the latest checkpoint of checkpoint_dir. The log file is then
+            kept, and the next reset() restores the checkpoint instead of starting a new episode.
+        eta_horizon: int, traffic slots ahead over which travel times are integrated. 0, the
+            default, keeps the traffic of the dispatch time for the whole trip. Otherwise trips
+            follow the traffic predicted for every following slot (without noise), up to the
+            horizon and constant after it, see traffic_manager.TrafficProfile and travel_times.
+        traffic_forecast: int, traffic slots ahead shown in observations. When positive, a traffic
+            forecast table follows the traffic table, one row per traffic district with its code
+            and the traffic forecast for each of the next traffic_forecast slots. Forecasts come
+            from a table predicted once for the whole calendar, with a noise fixed per slot and
+            seed (see TrafficManager.forecast), so they cost no model call per step.
+        coverage_cell: float, side in km of the cells of the hospital coverage raster, see
+            coverage_times, reachable and covered_population.
+        coverage_minutes: tuple of minutes. When given, a coverage table follows the traffic tables,
+            one row per zone with its code and, for every threshold, the inhabitants (thousands,
+            from the district densities of city_config) reached within it by the hospitals with
+            available ambulances, with the current traffic.
+        coverage_cache: str or Path, .npy file caching the route lengths of the coverage raster,
+            memory mapped, by default next to city_geometry. False disables the cache.
+        render_width: int, width in pixels of the frames of render("rgb_array").
+        render_file: str or Path, optional file where every rgb_array frame is also streamed, a
+            video if it ends in .mp4/.mkv/.avi, which needs ffmpeg, raw RGB frames otherwise.
+        backend: str, "numpy" or "numba". "numba" runs the array part of every step (arrivals,
+            costs and action validation, see kernels.py) as a compiled kernel, and falls back to
+            "numpy" with a warning when Numba is not installed. Both give identical episodes.
     """
 
     metadata = {
@@ -77,7 +137,7 @@ class CitySim(gym.Env):
         city_config="data/city_defaults.yaml",  # YAML file w/ city and generator data
         city_geometry="data/madrid_districs_processed/madrid_districs_processed.shp",
         traffic_default_cols="data/default_columns.csv",
-        traffic_models="data/traffic_models",
+        traffic_models="data/traffic_model.npz",
         time_start: datetime = datetime.fromisoformat("2020-01-01T00:00:00"),
         time_end: datetime = datetime.fromisoformat("2024-12-31T23:59:59"),
         time_step: int = 60,
@@ -85,28 +145,40 @@ class CitySim(gym.Env):
         log_file=None,
         mov_reward: int = 0,
         actions_per_round: int = 1,
+        emergency_rates=None,
+        emergency_source=None,
+        district_features=None,
+        geometry_cache=None,
+        geometry_tolerance=0.0,
+        kpis: bool = False,
+        kpi_queue_every: int = 1,
+        checkpoint_dir=None,
+        checkpoint_every: int = 0,
+        resume: bool = False,
+        eta_horizon: int = 0,
+        traffic_forecast: int = 0,
+        coverage_cell: float = 0.5,
+        coverage_minutes=(),
+        coverage_cache=None,
+        render_width: int = 640,
+        render_file=None,
+        backend: str = "numpy",
     ):
         """Initialize the CitySim environment."""
-        assert os.path.isfile(city_config), "Invalid path for city configuration file"
+        assert type(city_config) is dict or os.path.isfile(city_config), "Invalid path for city configuration file"
         assert os.path.isfile(city_geometry), "Invalid path for city geometry file"
         assert os.path.isfile(traffic_default_cols), "Invalid path for traffic default file"
-        assert os.path.isdir(traffic_models), "Invalid path for traffic models directory"
+        assert os.path.exists(traffic_models), "Invalid path for traffic model file"
 
         self.time_start = time_start
         self.time_end = time_end
         self.time_step_seconds = time_step
         self.time_step = timedelta(seconds=self.time_step_seconds)
+        self.current_step = 0
+        self.actions_per_round = actions_per_round
         self.stress = stress
         self.mov_reward = mov_reward
 
-        # Named lists for status keeping
-        self.hospital = recordclass("Hospital", ["name", "loc", "available_amb"])
-        self.emergency = recordclass("Emergency", ["loc", "severity", "tappearance", "code"])
-        self.moving_amb = recordclass(
-            "MovingAmbulance",
-            ["tobjective", "thospital", "origin", "destination", "severity", "code"],
-        )
-
         # Read configuration file for setting up the city
         if type(city_config) is dict:
             config = city_config
@@ -115,18 +187,96 @@ class CitySim(gym.Env):
                 config = yaml.safe_load(config_file)
         with shapefile.Reader(str(city_geometry)) as sf:
             geometry = sf.shapes()
-        self._configure(config, geometry)
+        if geometry_cache is None:
+            geometry_cache = Path(city_geometry).with_suffix(".index.npz")
+        self._configure(config, geometry, geometry_cache or None, geometry_tolerance)
+
+        self.emergency_source = emergency_source
+
+        # Streaming KPIs, updated on every launch and step
+        self.kpis = None
+        if kpis:
+            self.kpis = KPITracker(
+                self.severity_levels,
+                int(self.geometry.codes.max()),
+                self.initial_ambulances,
+                queue_every=kpi_queue_every,
+            )
 
-        # Traffic model data
-        default_df = pd.read_csv(traffic_default_cols, sep=";")
-        self.traffic_manager = TrafficManager(
-            time_start, self.districts, traffic_models, default_df
+        # Optional joint emergency rates, emergencies per second for [severity, hour, weekday, district]
+        self.emergency_rates = None
+        if emergency_rates is not None:
+            assert os.path.isfile(emergency_rates), "Invalid path for emergency rates file"
+            with np.load(emergency_rates) as rates_file:
+                self.emergency_rates = rates_file["rates"]
+                self.emergency_monthly = rates_file["monthly"]
+
+        # Optional static district features, the same districts table in every observation
+        self.districts_table = None
+        if district_features is not None:
+            assert os.path.isfile(district_features), "Invalid path for district features file"
+            with np.load(district_features) as features_file:
+                features = features_file["features"]
+                self.district_feature_names = features_file["names"].tolist()
+            zone_district = self.zone_traffic_district[1:]
+            assert zone_district.max() < len(features), "District features do not cover every district"
+            self.districts_table = np.column_stack((self.geometry.codes, features[zone_district])).astype(float)
+            self.districts_table.setflags(write=False)
+
+        # Traffic model data. Feature columns are only needed to convert a legacy models directory
+        default_df = None
+        if os.path.isdir(traffic_models):
+            default_df = pd.read_csv(traffic_default_cols, sep=";")
+        self.traffic_manager = TrafficManager(self.traffic_districts, traffic_models, default_df)
+
+        # The engine runs on an integer clock, seconds since time_start, backed by calendar tables
+        self.calendar = SimCalendar(
+            time_start, time_end, self.time_step_seconds, self.traffic_manager.update_period
         )
+        self.end_seconds = self.calendar.end_seconds
+        self.eta_horizon = eta_horizon
+
+        # Optional traffic forecasts, predicted for every slot of the episode once
+        self.traffic_forecast = traffic_forecast
+        if traffic_forecast > 0:
+            self._build_forecast_table(int(self.calendar.slot[-1]) + traffic_forecast + 1)
+
+        # Hospital coverage raster, built on first use
+        self.coverage = None
+        self.coverage_cell = coverage_cell
+        self.coverage_minutes = tuple(coverage_minutes)
+        if coverage_cache is None:
+            coverage_cache = Path(city_geometry).with_suffix(".coverage.npy")
+        self.coverage_cache = coverage_cache or None
+        self._coverage_times = None
+
+        # Stepping backend, the compiled kernel needs Numba
+        assert backend in ("numpy", "numba"), "Invalid stepping backend"
+        self.step_kernel = None
+        if backend == "numba" and HAVE_NUMBA:
+            self.step_kernel = step_transition
+        elif backend == "numba":
+            warnings.warn("Numba is not installed, CitySim steps with the NumPy backend")
+
+        # The renderer is only built on the first rgb_array render
+        self.renderer = None
+        self.render_width = render_width
+        self.render_file = render_file
+
+        # Optional periodic checkpoints, written by a background thread
+        self.checkpointer = None
+        if checkpoint_dir is not None and checkpoint_every > 0:
+            self.checkpointer = Checkpointer(checkpoint_dir, checkpoint_every)
+        self._resume_from = None
+        if resume:
+            assert checkpoint_dir is not None, "Resuming requires a checkpoint directory"
+            self._resume_from = latest_checkpoint(checkpoint_dir)
 
         # Set up log file for registering simulation events
         self.log_events = log_file is not None
         if log_file is not None:
             self.log_file = Path(log_file)
+        if log_file is not None and self._resume_from is None:
             with self.log_file.open("w") as log:
                 log.write("City Simulation Log." + "\n")
                 log.write(
@@ -138,21 +288,51 @@ class CitySim(gym.Env):
                     + "\n"
                 )
 
+    @property
+    def clock(self):
+        """Seconds elapsed since time_start."""
+        return self.current_step * self.time_step_seconds
+
+    @property
+    def time(self):
+        """Current simulation time as a datetime, only built on demand."""
+        return self.calendar.datetime(self.clock)
+
     def seed(self, seed):
         np.random.seed(seed)
+        if seed is None:
+            # Fresh entropy above, the forecast noise needs an integer of it
+            seed = np.random.randint(2**31)
+        self.traffic_manager.forecast_seed = int(seed)
 
     def reset(self):
         """Return the environment to the start of a new scenario, with no active emergencies. 
         """
+        if self._resume_from is not None:
+            path, self._resume_from = self._resume_from, None
+            return self.resume(path)
+
+        if self.checkpointer is not None:
+            self.checkpointer.start_episode()
+
         # Reset status variables
-        self.time = self.time_start
-        self.active_emergencies = ["dummy"] + [deque() for i in range(self.severity_levels)]
-        self.outgoing_ambulances = []
-        self.incoming_ambulances = []
+        self.current_step = 0
+        self.active_emergencies = ["dummy"] + [EmergencyQueue() for i in range(self.severity_levels)]
+        self.ambulances = AmbulanceStore()
+        self.queued = np.zeros(self.severity_levels + 1, dtype=np.int64)
 
         # Reset number of ambulances in hospitals to initial
-        for i in self.hospitals.keys():
-            self.hospitals[i]["available_amb"] = self.initial_ambulances[i]
+        self.available_amb = np.array(self.initial_ambulances, dtype=np.int64)
+
+        # Traffic starts again from the first slot, whatever the previous episode left
+        self.traffic_manager.reset()
+        self._coverage_times = None
+
+        if self.emergency_source is not None:
+            self.emergency_source.reset()
+
+        if self.kpis is not None:
+            self.kpis.reset()
 
         # Reset cumulative variables
         self.total_emergencies = {level: 0 for level in range(1, self.severity_levels + 1)}
@@ -167,113 +347,274 @@ class CitySim(gym.Env):
 
     def step(self, action):
 
-        # Check for objectives in outgoing ambulances and apply failures to reward
-        new_outgoing = []
-        reward = 0
-        for ambulance in self.outgoing_ambulances:
-            if self.time >= ambulance["tobjective"]:  # Ambulance arrived at emergency
-                self.incoming_ambulances.append(ambulance)
-            else:
-                reward += -ambulance["severity"] * self.time_step_seconds
-                new_outgoing.append(ambulance)
-        self.outgoing_ambulances = new_outgoing
-
-        # Check for final destinations in incoming ambulances and add them to the roster
-        new_incoming = []
-        for ambulance in self.incoming_ambulances:
-            if self.time >= ambulance["thospital"]:
-                self.hospitals[ambulance["destination"]]["available_amb"] += 1
-            else:
-                if ambulance["severity"] > 3:  # High severity em. still active until hospital
-                    # The 1.0 is because once you are in the ambulance, the cost should be lower
-                    reward += -ambulance["severity"] * self.time_step_seconds * 0.5
-                new_outgoing.append(ambulance)
-        self.incoming_ambulances = new_incoming
-
-        # For every active emergencie still in queue, add the corresponing waiting cost
-        for severity, severity_queue in enumerate(self.active_emergencies):
-            if severity == 0:  # Skip the dummy level
-                continue
-            # Add cost proportional to number of active emergencies and severity
-            reward += -severity * self.time_step_seconds * len(severity_queue)
+        if self.step_kernel is not None:
+            reward, launches = self._kernel_transition(action)
+        else:
+            reward, launches = self._numpy_transition(action)
 
-        # Take actions.
-        for every_action in action:
-            severity, start_hospital_id, end_hospital_id = every_action
-            start_hospital = self.hospitals[start_hospital_id]
-            end_hospital = self.hospitals[end_hospital_id]
+        # Launch the planned ambulances, whose hospital and emergency counts are already taken
+        for severity, start_hospital_id, end_hospital_id in launches:
+            start_loc = self._hospital_loc(start_hospital_id)
+            end_loc = self._hospital_loc(end_hospital_id)
             if severity == 0:  # Move ambulances between hospitals, no emergency
-                if end_hospital_id == start_hospital_id:
-                    continue  # This movement would not make sense
-                if self.hospitals[start_hospital_id]["available_amb"] == 0:
-                    continue  # An empty hospital cannot launch ambulances
-                if (end_hospital_id == 0) or (start_hospital_id == 0):
-                    continue  # Null hospital does not launch or receive any ambulances
-                self.hospitals[start_hospital_id]["available_amb"] -= 1
-                tthospital = self._displacement_time(start_hospital["loc"], end_hospital["loc"])
+                tthospital = self._displacement_time(start_loc, end_loc)
                 code = self.total_ambulances[0] + 1
-                ambulance = self.moving_amb(
-                    self.time, self.time + tthospital, start_hospital_id, end_hospital_id, 0, code,
+                self._launch_ambulance(
+                    tobjective=self.clock,
+                    thospital=self.clock + math.ceil(tthospital),
+                    origin=start_hospital_id,
+                    destination=end_hospital_id,
+                    severity=0,
+                    code=code,
+                    x=end_loc[0],
+                    y=end_loc[1],
+                    district=end_loc[2],
+                    tappearance=self.clock,
                 )
-                self._log_ambulance(ambulance)
                 self.total_ambulances[0] = code
-                self.incoming_ambulances.append(ambulance)
                 reward += self.mov_reward  # Possible cost associated with the movement
                 continue
 
-            if (
-                start_hospital_id == 0
-            ):  # Starting hospital #0 simbolizes null action for severity level
-                continue
-            if len(self.active_emergencies[severity]) == 0:
-                # If the queue for this severity level is empty, no action
-                continue
-            if start_hospital["available_amb"] == 0:  # No ambulances in initial hospital, no action
-                continue
-
-            if end_hospital_id == 0:  # Null end hospital to return to start hospital
-                end_hospital_id = start_hospital_id
-                end_hospital = start_hospital
-
             # Launch an ambulance from start hospital towards emergency
-            self.hospitals[start_hospital_id]["available_amb"] -= 1
-            emergency = self.active_emergencies[severity].popleft()
-            ttobj = self._displacement_time(start_hospital["loc"], emergency["loc"])
-            tthospital = self._displacement_time(emergency["loc"], end_hospital["loc"]) + ttobj
-            code = emergency["code"]
-            ambulance = self.moving_amb(
-                self.time + ttobj,
-                self.time + tthospital,
-                start_hospital_id,
-                end_hospital_id,
-                severity,
-                code,
+            x, y, district, _, tappearance, code = self.active_emergencies[severity].popleft()
+            em_loc = (x, y, district)
+            ttobj = self._displacement_time(start_loc, em_loc)
+            tthospital = self._displacement_time(em_loc, end_loc, self.clock + ttobj) + ttobj
+            self._launch_ambulance(
+                tobjective=self.clock + math.ceil(ttobj),
+                thospital=self.clock + math.ceil(tthospital),
+                origin=start_hospital_id,
+                destination=end_hospital_id,
+                severity=severity,
+                code=code,
+                x=x,
+                y=y,
+                district=district,
+                tappearance=tappearance,
             )
-            self._log_ambulance(ambulance)
             self.total_ambulances[severity] += 1
-            self.outgoing_ambulances.append(ambulance)
 
         # Advance time
-        self.time += self.time_step
-        self.traffic_manager.update_traffic(self.time)
+        self.current_step += 1
+        self.calendar.ensure(self.current_step)
+        self.traffic_manager.update_traffic(
+            self.calendar.slot[self.current_step], self.calendar.slot_point(self.current_step)
+        )
 
         # Generate new emergencies. Emergencies are a series of FIFO lists, one per severity
         self._generate_emergencies()
 
         # Return state, reward, and whether the end time has been reached
-        return self._get_obs(), reward, self.time >= self.time_end, {}
+        done = self.clock >= self.end_seconds
+        info = {"action_mask": self.action_mask()}
+        if self.kpis is not None:
+            self.kpis.record_step(self.current_step, self.clock, self.queued)
+            if done:
+                info["kpis"] = self.kpis.export()
+        if self.checkpointer is not None:
+            self.checkpointer.maybe_save(self)
+        return self._get_obs(), reward, done, info
+
+    def _numpy_transition(self, action):
+        """Advance the ambulances on the move, add the waiting cost of the queues and plan the
+        launches of the actions. Returns the reward so far and the (severity, start_hospital,
+        end_hospital) launches, whose ambulances and emergencies are already counted as taken.
+        """
+        # Apply the cost of ambulances on their way and add the ones that arrived to the roster
+        reward, released = self.ambulances.advance(self.clock, self.time_step_seconds)
+        np.add.at(self.available_amb, released, 1)
+
+        # For every active emergencie still in queue, add the corresponing waiting cost
+        for severity, severity_queue in enumerate(self.active_emergencies):
+            if severity == 0:  # Skip the dummy level
+                continue
+            # Add cost proportional to number of active emergencies and severity
+            reward += -severity * self.time_step_seconds * len(severity_queue)
+
+        # Validity is checked for the whole array of actions at once with the state at the start
+        # of the step, availability is checked again as every launch changes it
+        launches = []
+        for severity, start_hospital_id, end_hospital_id in self._valid_actions(action):
+            if self.available_amb[start_hospital_id] == 0:
+                continue  # An empty hospital cannot launch ambulances
+            if severity > 0:
+                if self.queued[severity] == 0:
+                    # If the queue for this severity level is empty, no action
+                    continue
+                if end_hospital_id == 0:  # Null end hospital to return to start hospital
+                    end_hospital_id = start_hospital_id
+                self.queued[severity] -= 1
+            self.available_amb[start_hospital_id] -= 1
+            launches.append((severity, start_hospital_id, end_hospital_id))
+        return reward, launches
+
+    def _kernel_transition(self, action):
+        """The same as _numpy_transition, with the compiled kernel."""
+        store = self.ambulances
+        reward, keep, launches = self.step_kernel(
+            self.clock,
+            self.time_step_seconds,
+            store.view("severity"),
+            store.view("tobjective"),
+            store.view("thospital"),
+            store.view("destination"),
+            self.available_amb,
+            self.queued,
+            np.asarray(action, dtype=np.int64).reshape(-1, 3),
+            self.severity_levels,
+            self.n_hospitals,
+        )
+        if not keep.all():
+            store.compact(np.flatnonzero(keep))
+        return reward, launches.tolist()
 
     def render(self, mode="console"):
+        if mode == "rgb_array":
+            if self.renderer is None:
+                self.renderer = CityRenderer(self, self.render_width)
+                if self.render_file is not None:
+                    self.renderer.writer = FrameWriter(
+                        self.render_file,
+                        self.renderer.width,
+                        self.renderer.height,
+                        self.metadata["video.frames_per_second"],
+                    )
+            return self.renderer.render()
         print(self._get_obs())
 
     def close(self):
-        pass
+        if self.emergency_source is not None:
+            self.emergency_source.close()
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+        if self.renderer is not None:
+            self.renderer.close()
+
+    def get_state(self):
+        """Complete dynamic state of the episode, as a flat dict of arrays that set_state restores
+        exactly: step, queues, ambulances on the move, counters, traffic, KPIs and the states of
+        the NumPy and Python random generators.
+        """
+        levels = range(self.severity_levels + 1)
+        traffic = {k: v for k, v in self.traffic_manager.traffic.items() if k != "Missing"}
+        np_random = np.random.get_state()
+        py_random = random.getstate()
+        state = {
+            "current_step": np.int64(self.current_step),
+            "available_amb": self.available_amb.copy(),
+            "queued": self.queued.copy(),
+            "total_emergencies": np.array([self.total_emergencies.get(i, 0) for i in levels]),
+            "total_ambulances": np.array([self.total_ambulances[i] for i in levels]),
+            "traffic_districts": np.array(list(traffic.keys())),
+            "traffic_loads": np.array(list(traffic.values()), dtype=float),
+            "traffic_last_update": np.int64(self.traffic_manager.last_update),
+            "np_random_keys": np_random[1],
+            "np_random_pos": np.int64(np_random[2]),
+            "np_random_gauss": np.array([np_random[3], np_random[4]], dtype=float),
+            "py_random_keys": np.array(py_random[1], dtype=np.uint32),
+            "py_random_gauss": np.float64(np.nan if py_random[2] is None else py_random[2]),
+        }
+        for severity in range(1, self.severity_levels + 1):
+            for name, column in self.active_emergencies[severity].get_state().items():
+                state[f"emergencies_{severity}_{name}"] = column
+        for name, column in self.ambulances.get_state().items():
+            state[f"ambulances_{name}"] = column
+        if self.kpis is not None:
+            for name, value in self.kpis.get_state().items():
+                state[f"kpis_{name}"] = value
+        if self.traffic_forecast > 0:
+            state["traffic_forecast_seed"] = np.int64(self.traffic_manager.forecast_seed)
+        if self.log_events:
+            state["log_size"] = np.int64(self.log_file.stat().st_size)
+        return state
+
+    def set_state(self, state):
+        """Restore a state returned by get_state (or loaded from a checkpoint file)."""
+        self.current_step = int(state["current_step"])
+        self.calendar.ensure(self.current_step)
+        self.available_amb = np.array(state["available_amb"], dtype=np.int64)
+        self.queued = np.array(state["queued"], dtype=np.int64)
+        self.total_emergencies = {
+            i: int(state["total_emergencies"][i]) for i in range(1, self.severity_levels + 1)
+        }
+        self.total_ambulances = {
+            i: int(state["total_ambulances"][i]) for i in range(self.severity_levels + 1)
+        }
+        self.traffic_manager.traffic = dict(
+            zip(state["traffic_districts"].tolist(), state["traffic_loads"].tolist())
+        )
+        self.traffic_manager.last_update = int(state["traffic_last_update"])
+        self.traffic_manager.profile = None
+        self._coverage_times = None
+        if "traffic_forecast_seed" in state:
+            self.traffic_manager.forecast_seed = int(state["traffic_forecast_seed"])
+
+        gauss = state["np_random_gauss"]
+        np.random.set_state(
+            ("MT19937", state["np_random_keys"], int(state["np_random_pos"]), int(gauss[0]), gauss[1])
+        )
+        py_gauss = float(state["py_random_gauss"])
+        random.setstate(
+            (3, tuple(state["py_random_keys"].tolist()), None if np.isnan(py_gauss) else py_gauss)
+        )
+
+        self.active_emergencies = ["dummy"] + [EmergencyQueue() for i in range(self.severity_levels)]
+        for severity in range(1, self.severity_levels + 1):
+            prefix = f"emergencies_{severity}_"
+            self.active_emergencies[severity].set_state(
+                {name: state[prefix + name] for name, _ in EmergencyQueue.FIELDS}
+            )
+        self.ambulances = AmbulanceStore()
+        self.ambulances.set_state({name: state["ambulances_" + name] for name, _ in AmbulanceStore.FIELDS})
+        if self.kpis is not None:
+            self.kpis.set_state({k[len("kpis_") :]: v for k, v in state.items() if k.startswith("kpis_")})
+
+        # Replayed emergencies up to the current clock were already generated
+        if self.emergency_source is not None:
+            self.emergency_source.reset()
+            self.emergency_source.pop_until(self.clock)
+
+        # Drop what was logged after the checkpoint
+        if self.log_events and "log_size" in state and self.log_file.exists():
+            with self.log_file.open("r+b") as log:
+                log.truncate(int(state["log_size"]))
+
+    def resume(self, path=None):
+        """Restore a checkpoint file, by default the latest one of the checkpoint directory, and
+        return the observation to continue the episode from.
+        """
+        if path is None:
+            assert self.checkpointer is not None, "No checkpoint directory configured"
+            path = latest_checkpoint(self.checkpointer.directory)
+        assert path is not None and os.path.isfile(path), "No checkpoint to resume from"
+        self.set_state(load_state(path))
+        if self.checkpointer is not None:
+            self.checkpointer.resume_episode(path)
+        return self._get_obs()
+
+    def action_mask(self):
+        """Actions that can currently have an effect.
+
+        Returns a dict with "severity", a boolean array telling which severity levels have queued
+        emergencies (level 0, moving ambulances between hospitals, is always allowed), and
+        "hospital", a boolean array telling which hospitals have ambulances to launch.
+        """
+        severity = self.queued > 0
+        severity[0] = True
+        return {"severity": severity, "hospital": self.available_amb > 0}
 
     def set_stress(self, stress):
         """Modify the stress factor at any moment in the execution."""
         self.stress = stress
 
-    def _configure(self, config, geometry):
+    def set_fleet(self, available_amb):
+        """Modify the ambulances of every hospital (hospital 0 included) from the next reset on."""
+        assert len(available_amb) == len(self.hospitals), "One ambulance count per hospital expected"
+        self.initial_ambulances = [int(n) for n in available_amb]
+        if self.kpis is not None:
+            self.kpis.initial_ambulances = np.array(self.initial_ambulances, dtype=np.int64)
+
+    def _configure(self, config, geometry, geometry_cache=None, geometry_tolerance=0.0):
         """Set the city information variables to the configuration."""
 
         self.config = config.copy()
@@ -285,29 +626,66 @@ class CitySim(gym.Env):
         self.shown_emergencies_per_severity = config["shown_emergencies_per_severity"]
         self.n_hospitals = len(self.hospitals) - 1
 
-        # Generate a {district_code: Polygon} dict from the shapefile data
-        self.geo_dict = {i + 1: shape(geometry[i]) for i in range(len(geometry))}
+        # Index the zones of the shapefile, geo_dict is a {district_code: Polygon} dict
+        exact = CityGeometry.from_shapes(geometry, cache_file=geometry_cache)
+        self.geo_dict = exact.zones
+
+        # Levels of detail by tolerance, self.geometry is the one that assigns points to zones
+        if not isinstance(geometry_tolerance, dict):
+            geometry_tolerance = dict.fromkeys(("sampling", "routing", "observation"), geometry_tolerance)
+        assert set(geometry_tolerance) <= {"sampling", "routing", "observation"}, "Invalid geometry purpose"
+        self.geometry_levels = {0.0: exact}
+        for tolerance in sorted(set(geometry_tolerance.values())):
+            if tolerance and tolerance not in self.geometry_levels:
+                self.geometry_levels[tolerance] = exact.simplified(
+                    tolerance, level_cache_file(geometry_cache, tolerance)
+                )
+        self.geometry = self.geometry_levels[geometry_tolerance.get("observation", 0.0)]
+        self.routing_geometry = self.geometry_levels[geometry_tolerance.get("routing", 0.0)]
+        self.sampling_geometry = self.geometry_levels[geometry_tolerance.get("sampling", 0.0)]
+
+        # Traffic district of every zone, indexed like the lengths of geometry.route_lengths
+        self.zone_traffic_district = np.array(
+            [0]
+            + [
+                self.districts.get(code, {}).get("traffic_district", code)
+                for code in self.geometry.codes.tolist()
+            ]
+        )
+        self.traffic_districts = sorted(set(self.zone_traffic_district[1:].tolist()))
+        # Row of the traffic district of every zone in the traffic profile, -1 outside
+        self.zone_traffic_column = np.searchsorted(self.traffic_districts, self.zone_traffic_district)
+        self.zone_traffic_column[0] = -1
 
         # Correct possible discrepancies in hospital district data and geometry data
-        for hospital_id, hospital in self.hospitals.items():
-            point = Point(hospital["loc"]["x"], hospital["loc"]["y"])
-            hospital_district_code = 0
-            for district_code, polygon in self.geo_dict.items():
-                if polygon.contains(point):
-                    hospital_district_code = district_code
+        hospital_ids = list(self.hospitals.keys())
+        hospital_districts = self.geometry.lookup(
+            [self.hospitals[i]["loc"]["x"] for i in hospital_ids],
+            [self.hospitals[i]["loc"]["y"] for i in hospital_ids],
+        )
+        for hospital_id, hospital_district_code in zip(hospital_ids, hospital_districts.tolist()):
             self.hospitals[hospital_id]["loc"]["district_code"] = hospital_district_code
 
+        # Hospital locations as arrays indexed by hospital id
+        hospital_ids = range(len(self.hospitals))
+        self.hospital_x = np.array([self.hospitals[i]["loc"]["x"] for i in hospital_ids], dtype=float)
+        self.hospital_y = np.array([self.hospitals[i]["loc"]["y"] for i in hospital_ids], dtype=float)
+        self.hospital_district = np.array(
+            [self.hospitals[i]["loc"]["district_code"] for i in hospital_ids], dtype=int
+        )
+
         # Store original state of available ambulances on its own
         self.initial_ambulances = [
             self.config["hospitals"][i]["available_amb"]
             for i in range(len(self.config["hospitals"]))
         ]
+        self.config_ambulances = list(self.initial_ambulances)
 
-        # Define the action space
-        self.action_space = spaces.Tuple(
-            (
-                spaces.Tuple([spaces.Discrete(self.n_hospitals + 1)] * (self.severity_levels + 1)),
-                spaces.Tuple([spaces.Discrete(self.n_hospitals + 1)] * (self.severity_levels + 1)),
+        # Define the action space, one (severity, start_hospital, end_hospital) row per action
+        self.action_space = spaces.MultiDiscrete(
+            np.tile(
+                [self.severity_levels + 1, self.n_hospitals + 1, self.n_hospitals + 1],
+                (self.actions_per_round, 1),
             )
         )
 
@@ -320,51 +698,48 @@ class CitySim(gym.Env):
         observation = []
 
         # Hospitals table
-        # id x y available_amb incoming_amb ttamb
-        hospitals_table = []
-        for id, hospital in self.hospitals.items():
-            x, y = hospital["loc"]["x"], hospital["loc"]["y"]
-            district_code = hospital["loc"]["district_code"]
-            incoming = 0
-            for ambulance in self.outgoing_ambulances + self.incoming_ambulances:
-                if ambulance["destination"] == id:
-                    incoming += 1
-            hospital_data = [id, x, y, district_code, hospital["available_amb"], incoming]
-            hospitals_table.append(hospital_data)
-        observation.append(np.array(hospitals_table))
+        # id x y district_code available_amb incoming_amb
+        incoming = self.ambulances.count_by_destination(self.n_hospitals + 1)
+        hospitals_table = np.column_stack(
+            (
+                np.arange(self.n_hospitals + 1),
+                self.hospital_x,
+                self.hospital_y,
+                self.hospital_district,
+                self.available_amb,
+                incoming,
+            )
+        ).astype(float)
+        observation.append(hospitals_table)
 
         # Unattended emergencies, with locations and severity. 3D table in severity/order/data
-        # Data for each emergency is severity order time_active x y
-        emergencies_table = []
-        for severity, queue in enumerate(self.active_emergencies):
-            severity_table = []
-            if severity == 0:
-                continue
-            for order in range(self.shown_emergencies_per_severity):
-                if order < len(queue):
-                    emergency = queue[order]
-                    loc = emergency["loc"]
-                    x, y, district_code = loc["x"], loc["y"], loc["district_code"]
-                    tactive = int((self.time - emergency["tappearance"]) / self.time_step)
-                    emergency_data = [severity, tactive, x, y, district_code]
-                else:
-                    emergency_data = [0, 0, 0, 0, 0]
-                severity_table.append(emergency_data)
-            emergencies_table.append(severity_table)
-        observation.append(np.array(emergencies_table))
+        # Data for each emergency is severity time_active x y district_code, zeros when empty
+        emergencies_table = np.zeros((self.severity_levels, self.shown_emergencies_per_severity, 5))
+        for severity in range(1, self.severity_levels + 1):
+            shown = self.active_emergencies[severity].head(self.shown_emergencies_per_severity)
+            n = len(shown["code"])
+            table = emergencies_table[severity - 1]
+            table[:n, 0] = severity
+            table[:n, 1] = (self.clock - shown["tappearance"]) // self.time_step_seconds
+            table[:n, 2] = shown["x"]
+            table[:n, 3] = shown["y"]
+            table[:n, 4] = shown["district"]
+        observation.append(emergencies_table)
 
         # Districts data?
 
         # Time data
+        step = self.current_step
         time_data = np.array(
             [
                 self.time_step_seconds,  # Information about potential reaction time
-                self.time.month,
-                self.time.day,
-                self.time.weekday() + 1,
-                self.time.hour,
-                self.time.minute,
-            ]
+                self.calendar.month[step],
+                self.calendar.day[step],
+                self.calendar.weekday[step] + 1,
+                self.calendar.hour[step],
+                self.calendar.minute[step],
+            ],
+            dtype=int,
         )
         observation.append(time_data)
 
@@ -378,7 +753,25 @@ class CitySim(gym.Env):
         sorted_districts = sorted(all_districts)
         for district in sorted_districts:
             traffic_data.append([district, self.traffic_manager.traffic[district]])
-        observation.append(np.array(traffic_data))
+        # Float from the start, loads are still integer zeros before the first traffic update
+        observation.append(np.array(traffic_data, dtype=float))
+
+        # Traffic forecast, in the same district order
+        # district_code traffic_slot_1 ... traffic_slot_n
+        if self.traffic_forecast > 0:
+            forecast = self._get_traffic_forecast()
+            observation.append(np.column_stack((self.traffic_manager.districts, forecast.T)).astype(float))
+
+        # Population covered in every zone within every threshold, in thousands
+        # zone_code covered_1 ... covered_n
+        if self.coverage_minutes:
+            covered = [self.covered_population(m, self.available_amb > 0) / 1000 for m in self.coverage_minutes]
+            observation.append(np.column_stack([self.geometry.codes] + covered).astype(float))
+
+        # Static districts table, last so that the other tables keep their position
+        # zone_code feature_1 ... feature_n
+        if self.districts_table is not None:
+            observation.append(self.districts_table)
 
         if mode == "tables":
             return observation
@@ -398,9 +791,17 @@ class CitySim(gym.Env):
         The agent only knows about the location, severity and the time since it was generated.
         """
 
-        hour = self.time.hour
-        weekday = self.time.weekday() + 1
-        month = self.time.month
+        hour = self.calendar.hour[self.current_step]
+        weekday = self.calendar.weekday[self.current_step] + 1
+        month = self.calendar.month[self.current_step]
+
+        if self.emergency_source is not None:
+            self._replay_emergencies()
+            return
+
+        if self.emergency_rates is not None:
+            self._generate_joint_emergencies(hour, weekday - 1, month)
+            return
 
         for severity in range(1, self.severity_levels + 1):
             base_frequency = self.severity_dists[severity]["frequency"]
@@ -431,118 +832,261 @@ class CitySim(gym.Env):
                 district = np.random.choice(  # District where emergency will be located
                     np.arange(len(district_weights)) + 1, p=district_weights
                 )
-                loc = self._random_loc_in_distric(district)
-                tappearance = self.time
-                code = self.total_emergencies[severity] + 1
-                emergency = self.emergency(loc, severity, tappearance, code,)
-                self._log_emergency(emergency)
-                self.total_emergencies[severity] = code  # Accumulate in history
-                self.active_emergencies[severity].append(emergency)  # Add to queue
-
-    def _displacement_time(self, start, end):
-        """Given start and end points, returns a displacement time between both locations for an 
-        ambulance, based on the current traffic, metheorology, and randomness.
+                self._add_emergency(severity, district)
+
+    def _generate_joint_emergencies(self, hour, weekday, month):
+        """Generate the emergencies of a timestep from the joint rate tensor, drawing the number of
+        new emergencies of every severity and district at once.
+        """
+        rates = self.emergency_rates[1:, hour, weekday, :]
+        monthly = self.emergency_monthly[1:, month, None]
+        period_frequency = rates * monthly * self.stress * self.time_step_seconds
+        num_new_emergencies = np.random.poisson(period_frequency)
+
+        for severity, district in zip(*np.nonzero(num_new_emergencies)):
+            for _ in range(num_new_emergencies[severity, district]):
+                self._add_emergency(int(severity) + 1, int(district))
+
+    def _valid_actions(self, action):
+        """Rows of an (actions_per_round, 3) array of (severity, start_hospital, end_hospital)
+        actions that can be applied given the state at the start of the step.
+        """
+        actions = np.asarray(action, dtype=np.int64).reshape(-1, 3)
+        severity, start, end = actions.T
+        in_range = (
+            (severity >= 0)
+            & (severity <= self.severity_levels)
+            & (start >= 0)
+            & (start <= self.n_hospitals)
+            & (end >= 0)
+            & (end <= self.n_hospitals)
+        )
+        severity, start, end = severity * in_range, start * in_range, end * in_range
+
+        # Starting hospital #0 simbolizes null action, and an empty hospital launches nothing
+        valid = in_range & (start != 0) & (self.available_amb[start] > 0)
+        # Moving ambulances between hospitals needs two different, non null, hospitals
+        relocation = severity == 0
+        valid &= ~relocation | ((end != start) & (end != 0))
+        # Attending emergencies needs emergencies of that severity in queue
+        valid &= relocation | (self.queued[severity] > 0)
+        return actions[valid].tolist()
+
+    def _replay_emergencies(self):
+        """Queue the emergencies of the external source that appeared up to the current time."""
+        records = self.emergency_source.pop_until(self.clock)
+        x, y, district = records["x"], records["y"], records["district"]
+
+        # Geocode the located records without a known district, all at once
+        located = ~np.isnan(x) & ~np.isnan(y)
+        missing = located & (district == 0)
+        if missing.any():
+            district = district.copy()
+            district[missing] = self.geometry.lookup(x[missing], y[missing])
+
+        columns = (records["t"], records["severity"], district, x, y, located)
+        for t, severity, district, x, y, located in zip(*(c.tolist() for c in columns)):
+            if not 1 <= severity <= self.severity_levels or district == 0:
+                continue  # Unknown severity, or outside the simulated city
+            if not located:
+                self._add_emergency(severity, district, tappearance=t)
+                continue
+            self._add_emergency(severity, district, loc=(x, y), tappearance=t)
+
+    def _add_emergency(self, severity, district, loc=None, tappearance=None):
+        x, y = self._random_loc_in_distric(district) if loc is None else loc
+        tappearance = self.clock if tappearance is None else tappearance
+        code = self.total_emergencies[severity] + 1
+        self._log_emergency(severity, x, y, district, code)
+        self.total_emergencies[severity] = code  # Accumulate in history
+        self.active_emergencies[severity].append(x, y, district, severity, tappearance, code)
+        self.queued[severity] += 1
+
+    def _launch_ambulance(self, **ambulance):
+        self._log_ambulance(**ambulance)
+        if self.kpis is not None:
+            self.kpis.record_launch(
+                self.clock,
+                ambulance["severity"],
+                ambulance["origin"],
+                ambulance["district"],
+                ambulance["tappearance"],
+                ambulance["tobjective"],
+                ambulance["thospital"],
+            )
+        self.ambulances.append(tdispatch=self.clock, **ambulance)
+
+    def _hospital_loc(self, hospital_id):
+        return (
+            self.hospital_x[hospital_id],
+            self.hospital_y[hospital_id],
+            self.hospital_district[hospital_id],
+        )
+
+    def _displacement_time(self, start, end, departure=None):
+        """Given start and end points, returns a displacement time in seconds between both
+        locations for an ambulance, based on the current traffic, metheorology, and randomness.
 
         (x1, y1, district1) (x2, y2, district2)  [km], centro P. del Sol, x -> Este, y -> Norte
+
+        With an eta_horizon the trip leaves at departure (by default now) and follows the traffic
+        profile instead.
         """
+        if self.eta_horizon:
+            departure = self.clock if departure is None else departure
+            return float(self.travel_times([start[:2]], [end[:2]], departure, [start[2]])[0])
 
         distance_per_district = self._get_segments_per_district(
-            start["district_code"],
-            (start["x"], start["y"]),
-            end["district_code"],
-            (end["x"], end["y"]),
+            int(start[2]), (start[0], start[1]), int(end[2]), (end[0], end[1]),
         )
-        total_time = self.traffic_manager.displacement_time(distance_per_district)
-
-        return timedelta(seconds=total_time)
+        return self.traffic_manager.displacement_time(distance_per_district)
+
+    def _build_forecast_table(self, n_slots):
+        calendar = self.calendar
+        starts = calendar.slot_start(np.arange(n_slots, dtype=np.int64))
+        self.traffic_manager.set_forecast_table(calendar.fields(starts))
+
+    def _get_traffic_forecast(self):
+        """Forecast of the next traffic_forecast slots, (slots, traffic districts)."""
+        slot = int(self.calendar.slot[self.current_step])
+        if slot + self.traffic_forecast >= len(self.traffic_manager.forecast_table):
+            # Stepping after the end of the episode, as calendar.ensure
+            self._build_forecast_table(2 * (slot + self.traffic_forecast + 1))
+        return self.traffic_manager.forecast(slot, self.traffic_forecast)
+
+    def _get_coverage(self):
+        if self.coverage is None:
+            position = np.array([self.geometry.position(code) for code in self.hospital_district.tolist()])
+            origin_column = np.where(position > 0, self.zone_traffic_column[position], -1)
+            self.coverage = CoverageRaster(
+                self.routing_geometry,
+                self.hospital_x,
+                self.hospital_y,
+                origin_column,
+                self.zone_traffic_column,
+                len(self.traffic_districts),
+                self.coverage_cell,
+                self.coverage_cache,
+                self.geometry,
+            )
+            # Zone of every cell, in geometry.codes order, and its inhabitants
+            self.cell_zone = np.array([self.geometry.position(code) for code in self.coverage.zone.tolist()]) - 1
+            self.cell_population = (
+                np.array([self.districts.get(code, {}).get("density", 0.0) for code in self.coverage.zone.tolist()])
+                * self.coverage_cell ** 2
+            )
+        return self.coverage
 
-    def _get_random_point_in_polygon(self, polygon):
-        min_x, min_y, max_x, max_y = polygon.bounds
-        while True:
-            point = Point(np.random.uniform(min_x, max_x), np.random.uniform(min_y, max_y))
-            if polygon.contains(point):
-                return point
+    def coverage_times(self):
+        """Travel times in seconds from every hospital (rows by hospital id, inf for 0) to the
+        centre of every cell of the coverage raster (self.coverage.x, .y, .zone), with the traffic
+        of the current slot, as _displacement_time without an eta_horizon. Computed once per
+        traffic update.
+        """
+        coverage = self._get_coverage()
+        manager = self.traffic_manager
+        if self._coverage_times is None or self._coverage_times[0] != manager.last_update:
+            loads = [manager.traffic[district] for district in self.traffic_districts]
+            self._coverage_times = (manager.last_update, coverage.times(loads, manager._get_speed))
+        return self._coverage_times[1]
+
+    def reachable(self, hospital, minutes):
+        """Cells of the coverage raster that a hospital reaches within minutes, as a bool array."""
+        return self.coverage_times()[hospital] <= minutes * 60
+
+    def covered_population(self, minutes, hospitals=None):
+        """Inhabitants of every zone (in geometry.codes order) in the cells that any of hospitals
+        (ids or a bool mask by hospital id, all by default) reaches within minutes.
+        """
+        times = self.coverage_times()
+        if hospitals is not None:
+            times = times[np.asarray(hospitals)]
+        covered = np.any(times <= minutes * 60, axis=0)
+        return np.bincount(self.cell_zone, self.cell_population * covered, minlength=len(self.geometry.codes))
+
+    def traffic_profile(self):
+        """TrafficProfile of the current traffic slot, built again after every traffic update."""
+        manager = self.traffic_manager
+        if manager.profile is None:
+            calendar = self.calendar
+            slot_seconds = calendar.slot_minutes * 60
+            start = calendar.slot_start(int(calendar.slot[self.current_step]))
+            points = calendar.fields(start + slot_seconds * np.arange(1, self.eta_horizon + 1))
+            manager.build_profile(start, slot_seconds, points)
+        return manager.profile
+
+    def travel_times(self, origins, destinations, departure=None, origin_districts=None):
+        """Travel times in seconds of many straight routes, along the traffic profile.
+
+        Args:
+            origins, destinations: arrays (n, 2) of route ends, in km.
+            departure: clock in seconds at the start of the routes, one for all or one per route,
+                by default now.
+            origin_districts: zone codes of the origins, looked up when not given.
+
+        Without an eta_horizon the profile holds the current traffic, and the times are those of
+        _displacement_time up to rounding.
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        destinations = np.asarray(destinations, dtype=float).reshape(-1, 2)
+        n = len(origins)
+        departure = np.broadcast_to(np.asarray(self.clock if departure is None else departure, dtype=float), n)
+        if origin_districts is None:
+            origin_districts = self.geometry.lookup(origins[:, 0], origins[:, 1])
+        origin_position = self.geometry._code_position[np.asarray(origin_districts, dtype=np.int64)]
+
+        # The traffic district of the origin counts for the mean speed outside, as a piece of length 0
+        routes, positions, lengths = [], [], []
+        for i in range(n):
+            position, length = self.routing_geometry.route_pieces(origins[i], destinations[i])
+            routes.append(np.full(len(position) + 1, i))
+            positions.extend((origin_position[i : i + 1], position))
+            lengths.extend(([0.0], length))
+        routes, positions, lengths = np.concatenate(routes), np.concatenate(positions), np.concatenate(lengths)
+        return self.traffic_profile().travel_times(departure, routes, self.zone_traffic_column[positions], lengths)
+
+    def _district_of(self, x, y):
+        """Code of the district containing a point, 0 if it is outside the city."""
+        return self.geometry.lookup_one(x, y)
 
     def _random_loc_in_distric(self, district_code):
-        polygon = self.geo_dict[district_code]
-        point = self._get_random_point_in_polygon(polygon)
-        x, y = np.array(point.coords).flatten().tolist()
-        return {"x": x, "y": y, "district_code": district_code}
-
-    def _obtain_route_cuts(self, origin, destination):
-        route = LineString([Point(origin[0], origin[1]), Point(destination[0], destination[1])])
-
-        cuts = {}  # Dict with {district_code: list of (x, y) tuples},
-        for district_code, polygon in self.geo_dict.items():
-            # To allow handling more than 2 intersection points between route line and polygon
-            distric_lr = LinearRing(list(polygon.exterior.coords))
-            intersection = distric_lr.intersection(route)
-            # Intersects district in ONE point
-            if type(intersection) == Point:
-                cuts[district_code] = [(intersection.x, intersection.y)]
-            # Intersects district in TWO OR MORE points
-            if type(intersection) == MultiPoint:
-                cuts[district_code] = [(point.x, point.y) for point in intersection]
-        return cuts
-
-    # Calculate distances traversed across districts
+        return self.sampling_geometry.random_point(district_code)
+
+    # Calculate distances traversed across traffic districts
     def _get_segments_per_district(
         self, district_origin, origin, district_destination, destination
     ):
-        cuts = self._obtain_route_cuts(origin, destination)
-        # If may return empty for same origin and destination district, but it will need an entry
-        if len(cuts) == 0:
-            cuts[district_origin] = []
-
-        # Add points at start and end corresponding to the origin and destination
-        cuts[district_origin].insert(0, origin)
-        cuts[district_destination].append(destination)
+        lengths = self.routing_geometry.route_lengths(origin, destination)
+        crossed = np.flatnonzero(lengths[1:]) + 1
 
-        distances = {k: self._cartesian(*v) for (k, v) in cuts.items()}
-        distances["Missing"] = self._cartesian(origin, destination) - sum(distances.values())
+        # The origin traffic district always gets an entry, even for a zero length route
+        distances = {}
+        if district_origin > 0:
+            distances[int(self.zone_traffic_district[self.geometry.position(district_origin)])] = 0.0
+        for district, length in zip(self.zone_traffic_district[crossed].tolist(), lengths[crossed].tolist()):
+            distances[district] = distances.get(district, 0.0) + length
+        distances["Missing"] = float(lengths[0])
 
         return distances
 
-    def _cartesian(self, *kwargs):
-        """Given a series of points in th Cartesian plane, returns the sums of the distances 
-        between consecutive pairs of such points. There must be an even number of points.
-        """
-        if len(kwargs) % 2 != 0:
-            return 0
-        result = 0
-        for i in range(0, len(kwargs), 2):
-            p1 = kwargs[i]
-            p2 = kwargs[i + 1]
-            result += np.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-
-        return result
-
     def _reward_f(self, time_diff, severity):
         """Possible non-linear fuction to apply to the time difference between an ambulance arrival
         and the time reference of the emergency in order to calculate a reward for the agent.
         """
         return time_diff * severity  # Right now linear with time to emergency and severity
 
-    def _log_emergency(self, emergency):
+    def _log_emergency(self, severity, x, y, district_code, code):
         if self.log_events:
             time = self.time.isoformat()
-            severity = emergency["severity"]
-            loc = emergency["loc"]
-            x, y, district_code = loc["x"], loc["y"], loc["district_code"]
-            code = emergency["code"]
             info = f"EM {time} {severity} {x:.8f} {y:.8f} {district_code} {code}"
             with self.log_file.open("a") as log:
                 log.write(info + "\n")
 
-    def _log_ambulance(self, ambulance):
+    def _log_ambulance(self, tobjective, thospital, origin, destination, severity, code, **_):
         if self.log_events:
             time = self.time.isoformat()
-            severity = ambulance["severity"]
-            origin = ambulance["origin"]
-            destination = ambulance["destination"]
-            tobjective = ambulance["tobjective"].isoformat()
-            thospital = ambulance["thospital"].isoformat()
-            code = ambulance["code"]
+            tobjective = self.calendar.datetime(tobjective).isoformat()
+            thospital = self.calendar.datetime(thospital).isoformat()
             info = f"AM {time} {severity} {origin} {destination} {tobjective} {thospital} {code}"
             with self.log_file.open("a") as log:
                 log.write(info + "\n")
@@ -0,0 +1,234 @@
+"""
+Clients of the CitySim server (see server.py).
+
+RemoteCitySim behaves like a CitySim with the same observations, rewards and action masks, but the
+simulation runs in a server worker. RemoteVecCitySim steps several environments with a single
+message per step.
+"""
+
+import json
+import socket
+import struct
+import time
+
+import gym
+import numpy as np
+from gym import spaces
+
+from .server import CLOSE, ERROR, HEADER, LOCATE, OPEN, PING, RESET, SEED, STEP, STEP_BATCH, STEP_HEADER
+
+
+def _connect(address, timeout=60.0):
+    """Connected blocking socket, retrying until the server listens or timeout seconds pass."""
+    if isinstance(address, (tuple, list)):
+        family, address = socket.AF_INET, tuple(address)
+    else:
+        family = socket.AF_UNIX
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class _Connection:
+    """Framed requests over a socket. Replies come in request order."""
+
+    def __init__(self, address, timeout=60.0):
+        self.sock = _connect(address, timeout)
+        self.buffer = bytearray()
+        self.request = 0
+
+    def send(self, code, slot=0, payload=b""):
+        self.request = (self.request + 1) & 0xFFFFFFFF
+        self.sock.sendall(HEADER.pack(len(payload), code, slot, self.request) + payload)
+
+    def send_many(self, frames):
+        """Pipeline several (code, slot, payload) requests in one write."""
+        messages = []
+        for code, slot, payload in frames:
+            self.request = (self.request + 1) & 0xFFFFFFFF
+            messages.append(HEADER.pack(len(payload), code, slot, self.request) + payload)
+        self.sock.sendall(b"".join(messages))
+
+    def receive(self):
+        """Payload of the next reply, as a writable bytearray."""
+        buffer = self.buffer
+        while True:
+            if len(buffer) >= HEADER.size:
+                length, status, _, _ = HEADER.unpack_from(buffer)
+                end = HEADER.size + length
+                if len(buffer) >= end:
+                    payload = buffer[HEADER.size : end]
+                    del buffer[:end]
+                    if status == ERROR:
+                        raise RuntimeError(f"CitySim server error: {payload.decode()}")
+                    return payload
+            chunk = self.sock.recv(1 << 20)
+            if not chunk:
+                raise ConnectionError("CitySim server closed the connection")
+            buffer += chunk
+
+    def call(self, code, slot=0, payload=b""):
+        self.send(code, slot, payload)
+        return self.receive()
+
+    def close(self):
+        self.sock.close()
+
+
+class _RemoteEnvs:
+    """count environments of a server worker, placed by the coordinator at address."""
+
+    def __init__(self, address, count=1, timeout=60.0):
+        self.lease = _Connection(address, timeout)
+        try:
+            located = json.loads(self.lease.call(LOCATE, 0, struct.pack("<H", count)))
+        except RuntimeError:
+            self.lease.close()
+            raise
+        self.connection = _Connection(located["address"], timeout)
+        self.layout = json.loads(self.connection.call(OPEN, 0, struct.pack("<H", count)))
+        self.count = count
+
+        nvec = np.array(self.layout["action_nvec"])
+        self.action_space = spaces.MultiDiscrete(nvec)
+        self.severity_levels = self.layout["severity_levels"]
+        self.n_hospitals = self.layout["n_hospitals"]
+
+        # Byte offsets of every array of a step reply
+        self.observation_parts = []
+        offset = STEP_HEADER.size
+        for dtype, shape in self.layout["observation"]:
+            dtype = np.dtype(dtype)
+            self.observation_parts.append((offset - STEP_HEADER.size, dtype, tuple(shape)))
+            offset += dtype.itemsize * int(np.prod(shape))
+        self.mask_parts = []
+        for name, length in self.layout["mask"]:
+            self.mask_parts.append((name, offset, length))
+            offset += length
+        self.step_size = offset
+
+    def decode_observation(self, payload, start=0):
+        return [
+            np.frombuffer(payload, dtype, int(np.prod(shape)), start + offset).reshape(shape)
+            for offset, dtype, shape in self.observation_parts
+        ]
+
+    def decode_step(self, payload, start=0):
+        reward, done = STEP_HEADER.unpack_from(payload, start)
+        observation = self.decode_observation(payload, start + STEP_HEADER.size)
+        mask = {
+            name: np.frombuffer(payload, np.bool_, length, start + offset)
+            for name, offset, length in self.mask_parts
+        }
+        return observation, reward, bool(done), {"action_mask": mask}
+
+    @staticmethod
+    def encode_action(action):
+        """Rows of (severity, start_hospital, end_hospital), any number of them as in CitySim."""
+        return np.ascontiguousarray(action, dtype=np.int64).reshape(-1, 3).tobytes()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.call(CLOSE)
+            self.connection.close()
+            self.lease.close()
+            self.connection = None
+
+
+class RemoteCitySim(gym.Env):
+    """CitySim running in a server, with the interface of CitySim.
+
+    step_async and step_wait split a step in two, so that the agent can work while the server
+    simulates.
+    """
+
+    metadata = {"render.modes": []}
+
+    def __init__(self, address, timeout: float = 60.0):
+        self.remote = _RemoteEnvs(address, 1, timeout)
+        self.action_space = self.remote.action_space
+        self.severity_levels = self.remote.severity_levels
+        self.n_hospitals = self.remote.n_hospitals
+
+    def seed(self, seed):
+        self.remote.connection.call(SEED, 0, np.int64(seed).tobytes())
+
+    def reset(self):
+        return self.remote.decode_observation(self.remote.connection.call(RESET))
+
+    def step(self, action):
+        self.step_async(action)
+        return self.step_wait()
+
+    def step_async(self, action):
+        self.remote.connection.send(STEP, 0, self.remote.encode_action(action))
+
+    def step_wait(self):
+        return self.remote.decode_step(self.remote.connection.receive())
+
+    def ping(self, payload=b""):
+        """Round trip of an empty request, to measure the transport."""
+        return self.remote.connection.call(PING, 0, payload)
+
+    def render(self, mode="console"):
+        raise NotImplementedError("Render CitySim in the server process")
+
+    def close(self):
+        self.remote.close()
+
+
+class RemoteVecCitySim:
+    """Several CitySim environments of one server worker stepped together.
+
+    Every step is one message with the actions of all the environments, and environments that
+    finish are reset by the server, their returned observation being the first of the new episode.
+    """
+
+    def __init__(self, address, num_envs: int, timeout: float = 60.0):
+        self.remote = _RemoteEnvs(address, num_envs, timeout)
+        self.num_envs = num_envs
+        self.action_space = self.remote.action_space
+        self.severity_levels = self.remote.severity_levels
+        self.n_hospitals = self.remote.n_hospitals
+
+    def seed(self, seeds):
+        """One seed per environment, or a base seed for seed, seed + 1, ..."""
+        if np.isscalar(seeds):
+            seeds = range(seeds, seeds + self.num_envs)
+        self.remote.connection.send_many([(SEED, slot, np.int64(s).tobytes()) for slot, s in enumerate(seeds)])
+        for _ in range(self.num_envs):
+            self.remote.connection.receive()
+
+    def reset(self):
+        self.remote.connection.send_many([(RESET, slot, b"") for slot in range(self.num_envs)])
+        return [self.remote.decode_observation(self.remote.connection.receive()) for _ in range(self.num_envs)]
+
+    def step_async(self, actions):
+        encoded = [self.remote.encode_action(action) for action in actions]
+        rows = np.array([len(action) // 24 for action in encoded], dtype=np.uint16)
+        self.remote.connection.send(STEP_BATCH, 0, rows.tobytes() + b"".join(encoded))
+
+    def step_wait(self):
+        """Lists of observations and infos, arrays of rewards and done flags."""
+        payload = self.remote.connection.receive()
+        results = [self.remote.decode_step(payload, i * self.remote.step_size) for i in range(self.num_envs)]
+        observations, rewards, dones, infos = zip(*results)
+        return list(observations), np.array(rewards), np.array(dones), list(infos)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        self.remote.close()
@@ -0,0 +1,133 @@
+"""
+Hospital coverage rasters for CitySim: travel times from every hospital to every cell of the city.
+
+The city is rasterized in square cells of coverage_cell km, keeping the cells whose centre is in a
+zone. The straight route from every hospital to every cell centre is split once by traffic
+district (CityGeometry.route_pieces), which is the costly geometric part, and the route lengths
+are cached on disk and memory mapped. With frozen traffic, as in TrafficManager.displacement_time,
+a travel time is the sum of the lengths over the speed of their districts, so the whole raster of
+a traffic slot is a matrix product of the cached lengths by the inverse speeds of the districts:
+
+    raster = CoverageRaster(geometry, x, y, origin_column, zone_traffic_column, n_columns)
+    times = raster.times(loads, speed)       # (n_hospitals + 1, n_cells) seconds
+    reached = times[h] <= 8 * 60             # cells hospital h reaches within 8 minutes
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+class CoverageRaster():
+    """Route lengths by traffic district from every hospital to the centre of every raster cell.
+
+    Attributes:
+        cell_size: float, side of the raster cells, in km.
+        x, y: np.ndarray (n_cells,), centres of the cells inside the city.
+        zone: np.ndarray (n_cells,), zone code of every cell.
+        lengths: np.ndarray (n_hospitals + 1, n_cells, n_columns + 1) float32, possibly memory
+            mapped, km of the route in every traffic district column and, last, outside the city.
+            Row 0 (no hospital) is empty.
+        present: np.ndarray (n_hospitals + 1, n_cells, n_columns) of bool, traffic districts of
+            every route: the ones it crosses and the one of the hospital.
+        cache_file: Path or None, .npy file of the lengths, the cache_file argument with a hash of
+            the geometry, hospitals and cells before its suffix.
+    """
+
+    def __init__(
+        self,
+        geometry,
+        hospital_x,
+        hospital_y,
+        origin_column,
+        zone_traffic_column,
+        n_columns,
+        cell_size: float = 0.5,
+        cache_file=None,
+        cell_geometry=None,
+    ):
+        self.cell_size = cell_size
+        self.n_columns = n_columns
+
+        # Centres of a regular grid over the zones, assigned to zones by cell_geometry
+        cell_geometry = cell_geometry or geometry
+        bounds = np.array([polygon.bounds for polygon in cell_geometry.zones.values()])
+        x = np.arange(bounds[:, 0].min() + cell_size / 2, bounds[:, 2].max(), cell_size)
+        y = np.arange(bounds[:, 1].min() + cell_size / 2, bounds[:, 3].max(), cell_size)
+        x, y = (grid.ravel() for grid in np.meshgrid(x, y))
+        zone = cell_geometry.lookup(x, y)
+        inside = zone > 0
+        self.x, self.y, self.zone = x[inside], y[inside], zone[inside]
+
+        hospital_x = np.asarray(hospital_x, dtype=float)
+        hospital_y = np.asarray(hospital_y, dtype=float)
+        origin_column = np.asarray(origin_column)
+        zone_traffic_column = np.asarray(zone_traffic_column)
+        self.cache_file = None
+        if cache_file is not None:
+            key = self._cache_key(geometry, hospital_x, hospital_y, origin_column, zone_traffic_column)
+            self.cache_file = Path(cache_file).with_suffix(f".{key[:16]}.npy")
+        if self.cache_file is not None and self.cache_file.is_file():
+            self.lengths = np.load(self.cache_file, mmap_mode="r")
+        else:
+            self.lengths = self._route_lengths(geometry, hospital_x, hospital_y, zone_traffic_column)
+            if self.cache_file is not None:
+                self._save_cache()
+
+        self.present = self.lengths[..., :-1] > 0
+        hospitals = np.flatnonzero(origin_column >= 0)
+        self.present[hospitals, :, origin_column[hospitals]] = True
+        self.present[0] = False
+
+    def _save_cache(self):
+        """Write the lengths and map them back from the file. Without write access to its
+        directory (read-only data), the raster keeps them in memory.
+        """
+        # Written aside and renamed, so that concurrent environments never read half a file
+        partial = self.cache_file.with_suffix(f".{os.getpid()}.partial")
+        try:
+            with partial.open("wb") as f:
+                np.save(f, self.lengths)
+            os.replace(partial, self.cache_file)
+        except OSError:
+            if partial.exists():
+                partial.unlink()
+            self.cache_file = None
+            return
+        self.lengths = np.load(self.cache_file, mmap_mode="r")
+
+    def _cache_key(self, geometry, hospital_x, hospital_y, origin_column, zone_traffic_column):
+        digest = hashlib.sha1(f"{CACHE_VERSION} {self.cell_size!r} {geometry._cache_key()}".encode())
+        for array in (hospital_x, hospital_y, origin_column, zone_traffic_column, self.x, self.y):
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def _route_lengths(self, geometry, hospital_x, hospital_y, zone_traffic_column):
+        lengths = np.zeros((len(hospital_x), len(self.x), self.n_columns + 1), dtype=np.float32)
+        for hospital in range(1, len(hospital_x)):
+            origin = (hospital_x[hospital], hospital_y[hospital])
+            for cell, destination in enumerate(zip(self.x.tolist(), self.y.tolist())):
+                position, length = geometry.route_pieces(origin, destination)
+                # Column -1, outside the city, is the last one
+                np.add.at(lengths[hospital, cell], zone_traffic_column[position], length)
+        return lengths
+
+    def times(self, loads, speed):
+        """Travel times in seconds from every hospital to every cell, (n_hospitals + 1, n_cells),
+        inf for row 0, with the traffic loads of every district column and speed(loads), the
+        speeds in km/h. Routes outside the city get the mean load of their districts, as in
+        TrafficManager.displacement_time.
+        """
+        loads = np.asarray(loads, dtype=float)
+        inside = self.lengths[..., :-1] @ (1 / speed(loads))
+        counts = self.present.sum(axis=-1)
+        outside_load = (self.present @ loads) / np.maximum(counts, 1)
+        outside = self.lengths[..., -1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            times = (inside + np.where(outside > 0, outside / speed(outside_load), 0)) * 3600
+        times[0] = np.inf
+        return times
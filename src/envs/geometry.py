@@ -0,0 +1,271 @@
+"""
+City geometry for CitySim: zones, point lookup and route lengths per zone.
+
+The city is split into zones, the 21 districts of Madrid by default but any finer partition
+(barrios, custom zones of a neighbouring municipality) described by a shapefile works the same way.
+Every zone boundary edge is bucketed by the cells of the DistrictIndex grid it goes through, so a
+route only tests the edges of the cells it crosses: its cost depends on the zones the route
+actually traverses, not on the number of zones of the city.
+
+Everything derived from the polygons (grid classification and edge buckets) is computed once and
+can be cached in a .npz file, keyed by a hash of the polygon coordinates and the cell size.
+
+simplified() builds a coarser level of detail of the same zones, every polygon simplified with
+Douglas-Peucker within a tolerance, together with its area and boundary errors, so that callers
+can trade exactness for fewer edges and vertices where the error does not matter.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+from shapely.geometry import Point, shape
+from shapely.prepared import prep
+
+from .spatial_index import DistrictIndex, _segment_points
+
+CACHE_VERSION = 1
+
+
+def _rings(polygon):
+    """Coordinate arrays of every ring (exteriors and holes) of a (multi)polygon."""
+    parts = getattr(polygon, "geoms", [polygon])
+    rings = []
+    for part in parts:
+        rings.append(np.asarray(part.exterior.coords))
+        rings.extend(np.asarray(interior.coords) for interior in part.interiors)
+    return rings
+
+
+def _vertices(polygon):
+    return sum(len(ring) for ring in _rings(polygon))
+
+
+def simplification_errors(originals, simplified):
+    """Errors of simplified versions of polygons, per polygon.
+
+    Returns a dict of arrays: vertices of the simplified polygon, area_error as the area of the
+    symmetric difference over the original area, and boundary_error as the Hausdorff distance
+    between both boundaries, which is bounded by the simplification tolerance.
+    """
+    return {
+        "vertices": np.array([_vertices(polygon) for polygon in simplified]),
+        "area_error": np.array(
+            [a.symmetric_difference(b).area / a.area for a, b in zip(originals, simplified)]
+        ),
+        "boundary_error": np.array(
+            [a.boundary.hausdorff_distance(b.boundary) for a, b in zip(originals, simplified)]
+        ),
+    }
+
+
+def level_cache_file(cache_file, tolerance):
+    """Cache file of the level of detail of a tolerance, next to the exact one."""
+    if cache_file is None or not tolerance:
+        return cache_file
+    cache_file = Path(cache_file)
+    name, _, suffixes = cache_file.name.partition(".")
+    return cache_file.with_name(f"{name}.lod{tolerance:g}.{suffixes}")
+
+
+class CityGeometry:
+    """Zones of a city, indexed for point lookups and route decomposition.
+
+    Attributes:
+        zones: dict {zone_code: shapely polygon}, codes 1..n in shapefile order.
+        codes: np.ndarray of int, zone codes in the same order as the polygons.
+        index: DistrictIndex over the zones.
+        edge_start, edge_end: np.ndarray (n_edges, 2), boundary edges of every zone.
+        cell_edges, cell_start: edges bucketed by grid cell, the edges that go through (or next to)
+            flat cell c are cell_edges[cell_start[c] : cell_start[c + 1]].
+        tolerance: float, simplification tolerance of the zones, 0 for the exact ones.
+        errors: dict of arrays indexed like codes, vertices, area_error and boundary_error of every
+            zone with respect to the exact one (see simplification_errors), None when exact.
+    """
+
+    def __init__(self, polygons, codes=None, cell_size: float = 0.1, cache_file=None):
+        polygons = list(polygons)
+        self.tolerance = 0.0
+        self.errors = None
+        codes = np.arange(1, len(polygons) + 1) if codes is None else np.asarray(codes)
+        self.zones = dict(zip(codes.tolist(), polygons))
+        self.codes = codes
+        self.cell_size = cell_size
+        self._prepared = {}
+        self._code_position = np.zeros(codes.max() + 1, dtype=np.int64)
+        self._code_position[codes] = np.arange(1, len(codes) + 1)
+
+        rings = [ring for polygon in polygons for ring in _rings(polygon)]
+        self.edge_start = np.concatenate([ring[:-1] for ring in rings])
+        self.edge_end = np.concatenate([ring[1:] for ring in rings])
+
+        key = self._cache_key()
+        arrays = self._load_cache(cache_file, key)
+        self.index = DistrictIndex(polygons, codes, cell_size, arrays)
+        if arrays is None:
+            self._bucket_edges()
+            self._save_cache(cache_file, key)
+        else:
+            self.cell_edges = arrays["cell_edges"]
+            self.cell_start = arrays["cell_start"]
+
+    @classmethod
+    def from_shapes(cls, shapes, cell_size: float = 0.1, cache_file=None):
+        """Zones from the shapes of a shapefile.Reader, with codes 1..n in file order."""
+        return cls([shape(s) for s in shapes], None, cell_size, cache_file)
+
+    def simplified(self, tolerance: float, cache_file=None):
+        """Level of detail of the zones simplified within tolerance (in the units of the
+        coordinates, km for CitySim), with the same codes and cell size.
+
+        Topology is preserved within every zone, so simplified zones stay valid, but neighbouring
+        zones are simplified independently: their shared boundary may open gaps or overlaps as
+        wide as the tolerance, which is part of the reported area error.
+        """
+        assert tolerance >= 0, "Invalid simplification tolerance"
+        if not tolerance:
+            return self
+        originals = list(self.zones.values())
+        polygons = [polygon.simplify(tolerance, preserve_topology=True) for polygon in originals]
+        level = CityGeometry(polygons, self.codes, self.cell_size, cache_file)
+        level.tolerance = tolerance
+        level.errors = simplification_errors(originals, polygons)
+        return level
+
+    def error_summary(self):
+        """Total vertices and worst area and boundary errors of the zones."""
+        if self.errors is None:
+            vertices = sum(_vertices(polygon) for polygon in self.zones.values())
+            return {"tolerance": 0.0, "vertices": vertices, "area_error": 0.0, "boundary_error": 0.0}
+        return {
+            "tolerance": self.tolerance,
+            "vertices": int(self.errors["vertices"].sum()),
+            "area_error": float(self.errors["area_error"].max()),
+            "boundary_error": float(self.errors["boundary_error"].max()),
+        }
+
+    def _cache_key(self):
+        digest = hashlib.sha1(f"{CACHE_VERSION} {self.cell_size!r}".encode())
+        for array in (self.codes, self.edge_start, self.edge_end):
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def _load_cache(self, cache_file, key):
+        if cache_file is None or not os.path.isfile(cache_file):
+            return None
+        with np.load(cache_file) as cache:
+            if str(cache["key"]) != key:
+                return None
+            return {name: cache[name] for name in cache.files}
+
+    def _save_cache(self, cache_file, key):
+        if cache_file is None:
+            return
+        try:
+            np.savez(
+                cache_file,
+                key=key,
+                cell_edges=self.cell_edges,
+                cell_start=self.cell_start,
+                **self.index.arrays(),
+            )
+        except OSError:
+            pass  # Read-only data directory, the index is rebuilt next time
+
+    def _bucket_edges(self):
+        """Bucket every edge by the grid cells within two cells of its points.
+
+        Edge and route points are sampled half a cell apart, so an intersection point is within a
+        quarter of a cell of a sample of each and their cells are at most two cells apart.
+        """
+        index = self.index
+        points, edge = _segment_points(self.edge_start, self.edge_end, self.cell_size / 2)
+        points = np.concatenate([points, self.edge_end])
+        edge = np.concatenate([edge, np.arange(len(self.edge_end))])
+        ix, iy = index._cell_of(points[:, 0], points[:, 1])
+
+        cells, edges = [], []
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                cells.append(np.clip(iy + dy, 0, index.ny - 1) * index.nx + np.clip(ix + dx, 0, index.nx - 1))
+                edges.append(edge)
+        n_edges = len(self.edge_end)
+        pairs = np.unique(np.concatenate(cells).astype(np.int64) * n_edges + np.concatenate(edges))
+        self.cell_edges = pairs % n_edges
+        self.cell_start = np.searchsorted(pairs // n_edges, np.arange(index.nx * index.ny + 1))
+
+    def position(self, code):
+        """Index of a zone code in the arrays returned by route_lengths, 0 for outside."""
+        return int(self._code_position[code])
+
+    def lookup(self, x, y):
+        """Zone codes of arrays of points, 0 outside the city."""
+        return self.index.lookup(x, y)
+
+    def lookup_one(self, x, y):
+        return self.index.lookup_one(x, y)
+
+    def _route_edges(self, origin, destination):
+        """Edges bucketed in the cells crossed by the segment origin -> destination."""
+        index = self.index
+        points, _ = _segment_points(
+            np.array([origin], dtype=float), np.array([destination], dtype=float), self.cell_size / 2
+        )
+        ix, iy = index._cell_of(np.append(points[:, 0], destination[0]), np.append(points[:, 1], destination[1]))
+        in_grid = (ix >= 0) & (ix < index.nx) & (iy >= 0) & (iy < index.ny)
+        cells = np.unique(iy[in_grid] * index.nx + ix[in_grid])
+
+        start, stop = self.cell_start[cells], self.cell_start[cells + 1]
+        counts = stop - start
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.unique(self.cell_edges[np.repeat(start, counts) + offsets])
+
+    def route_lengths(self, origin, destination):
+        """Length of the straight route origin -> destination inside every zone.
+
+        Returns an array indexed like [outside] + codes: element 0 is the length outside every
+        zone and element i the length inside zone codes[i - 1].
+        """
+        lengths = np.zeros(len(self.codes) + 1)
+        position, length = self.route_pieces(origin, destination)
+        np.add.at(lengths, position, length)
+        return lengths
+
+    def route_pieces(self, origin, destination):
+        """Pieces of the straight route origin -> destination between zone boundaries, in travel
+        order, as arrays of the position of their zone in [outside] + codes and of their length.
+        """
+        origin = np.asarray(origin, dtype=float)
+        route = np.asarray(destination, dtype=float) - origin
+        total = float(np.hypot(*route))
+        if total == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # Route parameters 0 <= t <= 1 where it crosses the boundary edges of its cells
+        edges = self._route_edges(origin, destination)
+        q = self.edge_start[edges]
+        s = self.edge_end[edges] - q
+        denominator = route[0] * s[:, 1] - route[1] * s[:, 0]
+        parallel = denominator == 0
+        denominator[parallel] = 1
+        t = ((q[:, 0] - origin[0]) * s[:, 1] - (q[:, 1] - origin[1]) * s[:, 0]) / denominator
+        u = ((q[:, 0] - origin[0]) * route[1] - (q[:, 1] - origin[1]) * route[0]) / denominator
+        crossing = ~parallel & (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+
+        # Between two consecutive crossings the route stays in one zone, the one of its midpoint
+        cuts = np.unique(np.concatenate([[0.0, 1.0], t[crossing]]))
+        middle = (cuts[:-1] + cuts[1:]) / 2
+        zone = self.lookup(origin[0] + middle * route[0], origin[1] + middle * route[1])
+        return self._code_position[zone], np.diff(cuts) * total
+
+    def random_point(self, code):
+        """Uniform random point of a zone, by rejection in its bounding box."""
+        if code not in self._prepared:
+            self._prepared[code] = prep(self.zones[code])
+        polygon = self._prepared[code]
+        min_x, min_y, max_x, max_y = self.zones[code].bounds
+        while True:
+            x, y = np.random.uniform(min_x, max_x), np.random.uniform(min_y, max_y)
+            if polygon.contains(Point(x, y)):
+                return x, y
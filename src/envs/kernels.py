@@ -0,0 +1,97 @@
+"""
+Compiled stepping kernel of CitySim.
+
+step_transition runs the array part of a step, the one that does not need the city geometry or
+the traffic model, as a single loop over the state arrays: ambulance arrivals and travel costs,
+the waiting cost of the queues, and the sequential validation of the actions, where every launch
+takes an ambulance and an emergency that the following actions no longer see. It is compiled with
+Numba when Numba is installed, and is plain (slow) Python otherwise, which CitySim avoids by
+keeping its NumPy path unless backend="numba" can actually be compiled.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # Optional dependency
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+
+def _jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+@_jit
+def step_transition(
+    clock,
+    time_step,
+    severity,
+    tobjective,
+    thospital,
+    destination,
+    available_amb,
+    queued,
+    actions,
+    severity_levels,
+    n_hospitals,
+):
+    """Advance the ambulances on the move and plan the launches of one step.
+
+    Ambulances that reach their destination hospital are added to available_amb, and the
+    launches take their ambulance from available_amb and their emergency from queued, both
+    updated in place.
+
+    Returns the reward of the step before the launches, the boolean mask of the ambulances still
+    on the move, and an int64 (n, 3) array of the launches in order, as (severity, start_hospital,
+    end_hospital) with the null end hospital of emergencies replaced by the start hospital.
+    """
+    n = severity.shape[0]
+    keep = np.empty(n, dtype=np.bool_)
+    travelling = 0
+    carrying = 0
+    for i in range(n):
+        if clock < tobjective[i]:
+            travelling += int(severity[i])
+            keep[i] = True
+        elif clock >= thospital[i]:
+            available_amb[destination[i]] += 1
+            keep[i] = False
+        else:
+            if severity[i] > 3:
+                carrying += int(severity[i])
+            keep[i] = True
+    reward = -float(travelling * time_step)
+    reward += -float(carrying * time_step * 0.5)
+
+    for level in range(1, severity_levels + 1):
+        reward += -level * time_step * queued[level]
+
+    launches = np.zeros((actions.shape[0], 3), dtype=np.int64)
+    n_launches = 0
+    for i in range(actions.shape[0]):
+        level, start, end = actions[i, 0], actions[i, 1], actions[i, 2]
+        if level < 0 or level > severity_levels or start < 0 or start > n_hospitals:
+            continue
+        if end < 0 or end > n_hospitals:
+            continue
+        if start == 0 or available_amb[start] == 0:
+            continue
+        if level == 0:
+            if end == start or end == 0:
+                continue
+        else:
+            if queued[level] == 0:
+                continue
+            if end == 0:
+                end = start
+            queued[level] -= 1
+        available_amb[start] -= 1
+        launches[n_launches, 0] = level
+        launches[n_launches, 1] = start
+        launches[n_launches, 2] = end
+        n_launches += 1
+    return reward, keep, launches[:n_launches]
@@ -0,0 +1,536 @@
+"""
+Real-time paced CitySim fed by a live emergency feed, to shadow the live dispatch.
+
+LiveFeed is an emergency source (see replay.ReplaySource) whose records arrive while the
+simulation runs: an asyncio consumer, in a background thread, reads EM lines in the format of
+the CitySim log (EM [timeISO] [severity] [coordXkm] [coordYkm] [district_code] [em_identifier])
+from producers connected to a local socket, or from the tail of a growing file. Other lines are
+ignored, so the log of another simulation can be tailed as is.
+
+RealTimeRunner steps the environment on the wall clock, time_step / speed seconds of wall time
+per step, and asks the agent for a recommendation after every step within a latency budget,
+falling back to a null action when the agent is late. It measures the latency from the ingest of
+every emergency to the first recommendation made with it in the observation. StandInFeed is a
+local producer of random emergencies with bursts, for tests.
+
+    python -m src.envs.live -a /tmp/samur_feed.sock -S -x 10 -t 5 -d 60
+"""
+
+import asyncio
+import getopt
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from .replay import FIELDS, _empty
+from .server import parse_address
+
+RECORD = np.dtype(
+    [
+        ("t", np.int64),
+        ("severity", np.int8),
+        ("district", np.int32),
+        ("x", np.float64),
+        ("y", np.float64),
+        ("ingest", np.float64),
+    ]
+)
+
+
+def parse_em_lines(data, time_start, arrival_seconds=None):
+    """Records of the EM lines of a bytes block, as (t, severity, district, x, y) tuples with t in
+    seconds since time_start. arrival_seconds, if given, replaces the line times.
+    """
+    records = []
+    for line in data.split(b"\n"):
+        fields = line.split()
+        if len(fields) < 6 or fields[0] != b"EM":
+            continue
+        try:
+            if arrival_seconds is None:
+                seconds = (datetime.fromisoformat(fields[1].decode()) - time_start).total_seconds()
+                t = math.ceil(seconds)
+            else:
+                t = arrival_seconds
+            records.append((t, int(fields[2]), int(fields[5]), float(fields[3]), float(fields[4])))
+        except ValueError:
+            continue  # Malformed line
+    return records
+
+
+class LiveFeed:
+    """Emergency source receiving EM lines while the simulation runs.
+
+    Attributes:
+        time_start: datetime, time of the simulation start, to convert the line times.
+        address: str socket path or (host, port) where producers connect, or None.
+        tail_file: str or Path of a file to follow, or None.
+        timestamps: "line" to use the time written in every line, "arrival" to use the simulation
+            time at which the line is received (see set_clock).
+        from_start: bool, read tail_file from its beginning instead of its current end.
+        poll_interval: float, seconds between two reads of tail_file when it does not grow.
+    """
+
+    def __init__(
+        self,
+        time_start,
+        address=None,
+        tail_file=None,
+        timestamps: str = "line",
+        from_start: bool = False,
+        poll_interval: float = 0.02,
+    ):
+        assert (address is None) != (tail_file is None), "A feed needs either an address or a file"
+        assert timestamps in ("line", "arrival"), "Invalid timestamps mode"
+        self.time_start = time_start
+        self.address = address
+        self.tail_file = tail_file
+        self.timestamps = timestamps
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+
+        self.received = 0
+        self._lock = threading.Lock()
+        self._arrived = []
+        self._held = np.zeros(0, dtype=RECORD)
+        self._ingest_times = []
+        self._wall_start, self._speed = time.perf_counter(), 1.0
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def set_clock(self, wall_start, speed):
+        """Wall time (time.perf_counter) of simulation time 0, and simulated seconds per second."""
+        self._wall_start, self._speed = wall_start, speed
+
+    def start(self):
+        """Start consuming in a background thread, once the socket listens or the file is open."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            self._ready.wait()
+
+    def close(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        """Forget the emergencies received and not consumed yet."""
+        with self._lock:
+            self._arrived = []
+        self._held = np.zeros(0, dtype=RECORD)
+        self._ingest_times = []
+
+    def _ingest(self, data):
+        now = time.perf_counter()
+        arrival = None
+        if self.timestamps == "arrival":
+            arrival = math.ceil((now - self._wall_start) * self._speed)
+        records = [record + (now,) for record in parse_em_lines(data, self.time_start, arrival)]
+        if records:
+            with self._lock:
+                self._arrived.extend(records)
+                self.received += len(records)
+
+    async def _consume_stream(self, reader, writer):
+        partial = b""
+        try:
+            while True:
+                data = await reader.read(1 << 16)
+                if not data:
+                    break
+                data, _, partial = (partial + data).rpartition(b"\n")
+                self._ingest(data)
+            # The producer closed, its last line may have no newline
+            if partial:
+                self._ingest(partial)
+        except asyncio.CancelledError:
+            pass  # The feed is closing
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        if isinstance(self.address, tuple):
+            server = await asyncio.start_server(self._consume_stream, *self.address)
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            server = await asyncio.start_unix_server(self._consume_stream, self.address)
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _tail(self):
+        with open(self.tail_file, "rb") as f:
+            if not self.from_start:
+                f.seek(0, os.SEEK_END)
+            self._ready.set()
+            partial = b""
+            while True:
+                data = f.read(1 << 16)
+                if not data:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                data, _, partial = (partial + data).rpartition(b"\n")
+                self._ingest(data)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(self._serve() if self.tail_file is None else self._tail())
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Connection handlers still reading
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            if pending:  # gather() of nothing needs a current loop, which this thread lacks
+                self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self._ready.set()
+            self._loop.close()
+
+    def pop_until(self, clock):
+        """Records received with t <= clock not returned yet, in time order, as a dict of arrays
+        with the fields t, severity, district, x and y. Records ahead of clock are held.
+        """
+        with self._lock:
+            arrived, self._arrived = self._arrived, []
+        if arrived:
+            self._held = np.concatenate([self._held, np.array(arrived, dtype=RECORD)])
+        if len(self._held) == 0:
+            return _empty()
+        ready = self._held["t"] <= clock
+        if not ready.any():
+            return _empty()
+        records = np.sort(self._held[ready], order="t", kind="stable")
+        self._held = self._held[~ready]
+        self._ingest_times.append(records["ingest"])
+        return {name: np.ascontiguousarray(records[name]) for name in FIELDS}
+
+    def take_ingest_times(self):
+        """Ingest times (time.perf_counter) of the records returned since the last call."""
+        times, self._ingest_times = self._ingest_times, []
+        return np.concatenate(times) if times else np.zeros(0)
+
+
+def sample_points(geometry, n, seed=0):
+    """n random (district, x, y) points inside the city, uniform over its area."""
+    rng = np.random.RandomState(seed)
+    index = geometry.index
+    x0, y0 = index.origin
+    width, height = index.nx * index.cell_size, index.ny * index.cell_size
+    points = []
+    while sum(len(p) for p in points) < n:
+        x = x0 + rng.uniform(0, width, 4 * n)
+        y = y0 + rng.uniform(0, height, 4 * n)
+        district = geometry.lookup(x, y)
+        inside = district > 0
+        points.append(np.column_stack((district[inside], x[inside], y[inside])))
+    return np.concatenate(points)[:n]
+
+
+class StandInFeed:
+    """Local producer of random EM lines, standing in for the live feed in tests.
+
+    Emergencies arrive as a Poisson process of rate emergencies per wall second, plus bursts of
+    burst_size emergencies every burst_every wall seconds. Line times are simulated times, wall
+    time since start() times speed after time_start.
+    """
+
+    def __init__(
+        self,
+        points,
+        time_start,
+        address=None,
+        output_file=None,
+        rate: float = 2.0,
+        speed: float = 1.0,
+        burst_size: int = 0,
+        burst_every: float = 10.0,
+        severity_weights=(0.2, 0.2, 0.1, 0.35, 0.15),
+        seed: int = 0,
+    ):
+        assert (address is None) != (output_file is None), "A stand-in feed needs either an address or a file"
+        self.points = points
+        self.time_start = time_start
+        self.address = address
+        self.output_file = output_file
+        self.rate = rate
+        self.speed = speed
+        self.burst_size = burst_size
+        self.burst_every = burst_every
+        self.severity_weights = np.asarray(severity_weights) / np.sum(severity_weights)
+        self.rng = np.random.RandomState(seed)
+        self.sent = 0
+        self._thread = None
+
+    def _lines(self, n, wall_start):
+        now = self.time_start + timedelta(seconds=(time.perf_counter() - wall_start) * self.speed)
+        severity = self.rng.choice(len(self.severity_weights), size=n, p=self.severity_weights) + 1
+        chosen = self.points[self.rng.randint(len(self.points), size=n)]
+        lines = [
+            f"EM {now.isoformat()} {s} {x:.8f} {y:.8f} {int(d)} {self.sent + i + 1}\n"
+            for i, (s, (d, x, y)) in enumerate(zip(severity.tolist(), chosen.tolist()))
+        ]
+        self.sent += n
+        return "".join(lines).encode()
+
+    async def _produce(self, duration, wall_start):
+        if self.output_file is not None:
+            output = open(self.output_file, "ab", buffering=0)
+            write = output.write
+        elif isinstance(self.address, tuple):
+            _, output = await asyncio.open_connection(*self.address)
+            write = output.write
+        else:
+            _, output = await asyncio.open_unix_connection(self.address)
+            write = output.write
+
+        next_burst = wall_start + self.rng.uniform(0, self.burst_every)
+        while time.perf_counter() - wall_start < duration:
+            await asyncio.sleep(self.rng.exponential(1 / self.rate) if self.rate > 0 else self.burst_every)
+            write(self._lines(1, wall_start))
+            if self.burst_size and time.perf_counter() >= next_burst:
+                write(self._lines(self.burst_size, wall_start))
+                next_burst += self.burst_every
+        output.close()
+
+    def start(self, duration: float, wall_start=None):
+        """Produce for duration wall seconds in a background thread. wall_start is the wall time
+        (time.perf_counter) of time_start, now by default.
+        """
+        wall_start = time.perf_counter() if wall_start is None else wall_start
+        coroutine = self._produce(duration, wall_start)
+        self._thread = threading.Thread(target=asyncio.run, args=(coroutine,), daemon=True)
+        self._thread.start()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+
+def latency_summary(seconds):
+    """Count, p50, p99 and maximum of a list of durations, in milliseconds."""
+    seconds = np.asarray(seconds) * 1000
+    if len(seconds) == 0:
+        return {"count": 0, "p50_ms": float("nan"), "p99_ms": float("nan"), "max_ms": float("nan")}
+    return {
+        "count": int(len(seconds)),
+        "p50_ms": float(np.percentile(seconds, 50)),
+        "p99_ms": float(np.percentile(seconds, 99)),
+        "max_ms": float(seconds.max()),
+    }
+
+
+class RealTimeRunner:
+    """Steps a CitySim fed by a LiveFeed on the wall clock and records its recommendations.
+
+    Attributes:
+        env: CitySim whose emergency_source is a LiveFeed.
+        agent: callable from an observation (and the action mask if use_mask) to an action.
+        speed: float, simulated seconds per wall second.
+        decision_budget: float, wall seconds the agent has to recommend, None for no limit. A late
+            recommendation is replaced by the null action, and later decisions keep using the null
+            action until the late call returns.
+        on_recommendation: optional callable(time, action) receiving every recommendation.
+        latencies: list of float, seconds from the ingest of every emergency to the first
+            recommendation made with it in the observation.
+        decision_times: list of float, seconds spent waiting for every recommendation.
+        lags: list of float, seconds every late step started after its wall deadline.
+        misses: int, decisions that missed their budget.
+    """
+
+    def __init__(self, env, agent, speed: float = 1.0, decision_budget=0.25, use_mask=False, on_recommendation=None):
+        self.env = env
+        self.feed = env.emergency_source
+        self.agent = agent
+        self.speed = speed
+        self.decision_budget = decision_budget
+        self.use_mask = use_mask
+        self.on_recommendation = on_recommendation
+        self.null_action = np.zeros((1, 3), dtype=np.int64)
+        self._executor = ThreadPoolExecutor(max_workers=1) if decision_budget is not None else None
+        self._late = None
+        self.latencies, self.decision_times, self.lags = [], [], []
+        self.misses = 0
+
+    def _call_agent(self, observation, info):
+        if self.use_mask:
+            return self.agent(observation, info["action_mask"])
+        return self.agent(observation)
+
+    def _decide(self, observation, info):
+        start = time.perf_counter()
+        if self._executor is None:
+            action = self._call_agent(observation, info)
+        elif self._late is not None and not self._late.done():
+            self.misses += 1
+            action = self.null_action
+        else:
+            future = self._executor.submit(self._call_agent, observation, info)
+            try:
+                action = future.result(timeout=self.decision_budget)
+                self._late = None
+            except FutureTimeout:
+                self._late = future
+                self.misses += 1
+                action = self.null_action
+        self.decision_times.append(time.perf_counter() - start)
+        return action
+
+    def run(self, duration=None, steps=None, wall_start=None):
+        """Run for duration wall seconds or a number of steps, whichever comes first, and return
+        the report. wall_start is the wall time (time.perf_counter) of the simulation start, now
+        by default.
+        """
+        env = self.env
+        self.feed.start()
+        observation = env.reset()
+        info = {"action_mask": env.action_mask()}
+        wall_start = time.perf_counter() if wall_start is None else wall_start
+        self.feed.set_clock(wall_start, self.speed)
+        seconds_per_step = env.time_step_seconds / self.speed
+
+        action = self._decide(observation, info)
+        n_steps = 0
+        while steps is None or n_steps < steps:
+            deadline = wall_start + (n_steps + 1) * seconds_per_step
+            if duration is not None and deadline - wall_start > duration:
+                break
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.lags.append(-delay)
+
+            observation, _, done, info = env.step(action)
+            ingested = self.feed.take_ingest_times()
+            action = self._decide(observation, info)
+            self.latencies.extend((time.perf_counter() - ingested).tolist())
+            if self.on_recommendation is not None:
+                self.on_recommendation(env.time, action)
+            n_steps += 1
+            if done:
+                break
+        return self.report(n_steps)
+
+    def report(self, n_steps=None):
+        return {
+            "steps": n_steps,
+            "emergencies": len(self.latencies),
+            "ingest_to_recommendation": latency_summary(self.latencies),
+            "decision": latency_summary(self.decision_times),
+            "budget_misses": self.misses,
+            "late_steps": len(self.lags),
+            "max_lag_ms": max(self.lags, default=0.0) * 1000,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.feed.close()
+
+
+def usage():
+    print("live.py (-a <socketpath|host:port> | -f <tailfile>) [-S] [-x <speed>] [-t <timestep>] [-d <seconds>]")
+    print("        [-r <rate>] [-b <burstsize>] [-B <burstevery>] [-l <budget>]")
+    print("-S runs a stand-in producer of random emergencies on the same socket or file")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "ha:f:Sx:t:d:r:b:B:l:",
+            ["address=", "file=", "stand-in", "speed=", "timestep=", "duration=", "rate=", "burst=", "burst-every=", "budget="],
+        )
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    address = tail_file = None
+    stand_in, speed, time_step, duration = False, 1.0, 1, 30.0
+    rate, burst_size, burst_every, budget = 2.0, 0, 10.0, 0.25
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt in ("-a", "--address"):
+            address = parse_address(arg)
+        elif opt in ("-f", "--file"):
+            tail_file = arg
+        elif opt in ("-S", "--stand-in"):
+            stand_in = True
+        elif opt in ("-x", "--speed"):
+            speed = float(arg)
+        elif opt in ("-t", "--timestep"):
+            time_step = int(arg)
+        elif opt in ("-d", "--duration"):
+            duration = float(arg)
+        elif opt in ("-r", "--rate"):
+            rate = float(arg)
+        elif opt in ("-b", "--burst"):
+            burst_size = int(arg)
+        elif opt in ("-B", "--burst-every"):
+            burst_every = float(arg)
+        elif opt in ("-l", "--budget"):
+            budget = float(arg)
+
+    from src.agents.test_agents import NaiveGreedyAgent
+
+    from .citysim import CitySim
+
+    root = Path(__file__).resolve().parents[2]
+    time_start = datetime.now().replace(microsecond=0)
+    if tail_file is not None and stand_in:
+        Path(tail_file).touch()
+    feed = LiveFeed(time_start, address, tail_file)
+    env = CitySim(
+        city_config=root / "data/city_defaults.yaml",
+        city_geometry=root / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        traffic_default_cols=root / "data/default_columns.csv",
+        traffic_models=root / "data/traffic_model.npz",
+        time_start=time_start,
+        time_end=time_start + timedelta(days=365),
+        time_step=time_step,
+        emergency_source=feed,
+    )
+    agent = NaiveGreedyAgent(len(env.hospitals) - 1, env.severity_levels, 5)
+    runner = RealTimeRunner(env, agent, speed, budget)
+    feed.start()
+    wall_start = time.perf_counter()
+    if stand_in:
+        producer = StandInFeed(
+            sample_points(env.geometry, 10000),
+            time_start,
+            address,
+            tail_file,
+            rate=rate,
+            speed=speed,
+            burst_size=burst_size,
+            burst_every=burst_every,
+        )
+        producer.start(duration, wall_start)
+
+    report = runner.run(duration, wall_start=wall_start)
+    runner.close()
+    latency, decision = report["ingest_to_recommendation"], report["decision"]
+    print(f"{report['steps']} steps, {report['emergencies']} emergencies, {feed.received} received")
+    print(
+        f"Ingest to recommendation: p50 {latency['p50_ms']:.1f} ms, p99 {latency['p99_ms']:.1f} ms, "
+        f"max {latency['max_ms']:.1f} ms"
+    )
+    print(f"Decision: p50 {decision['p50_ms']:.2f} ms, p99 {decision['p99_ms']:.2f} ms")
+    print(f"{report['budget_misses']} budget misses, {report['late_steps']} late steps, max lag {report['max_lag_ms']:.1f} ms")
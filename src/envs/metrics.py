@@ -0,0 +1,171 @@
+"""
+Streaming operational KPIs for CitySim.
+
+KPITracker is updated by the environment as events happen, in constant time per event, so that
+long evaluation runs can produce the response time and fleet dashboards without writing and
+parsing the text log. Response times are kept in fixed width histograms per severity and district,
+from which means and quantiles can be read at any moment.
+"""
+
+import numpy as np
+
+
+class KPITracker:
+    """Online aggregation of response times, queue lengths and fleet utilization.
+
+    Attributes:
+        severity_levels: int, number of emergency severity levels.
+        n_districts: int, highest district code. Histograms are indexed by district code, 0 is used
+            for emergencies outside the city.
+        initial_ambulances: np.ndarray, ambulances of every hospital at the start of an episode.
+        bin_seconds: int, width of the response time histogram bins.
+        max_seconds: int, response times from max_seconds on go to the last (overflow) bin.
+        queue_every: int, queue lengths are sampled every queue_every steps.
+        queue_steps, queue_lengths: np.ndarray [sample] and [sample, severity] int32, steps and
+            per severity queue lengths of the samples, the first n_samples rows.
+        wait_hist: np.ndarray [severity, district, bin], emergencies by time from appearance to
+            dispatch of their ambulance.
+        arrival_hist: np.ndarray [severity, district, bin], emergencies by time from appearance to
+            arrival of their ambulance (tobjective).
+        busy_seconds: np.ndarray [hospital], seconds spent out of their hospital by the ambulances
+            launched from every hospital to attend emergencies, counted at launch until thospital.
+        relocation_seconds: np.ndarray [hospital], the same for moves between hospitals.
+    """
+
+    COUNTERS = (
+        "wait_hist",
+        "arrival_hist",
+        "wait_sum",
+        "arrival_sum",
+        "dispatches",
+        "busy_seconds",
+        "relocation_seconds",
+    )
+
+    def __init__(
+        self,
+        severity_levels: int,
+        n_districts: int,
+        initial_ambulances,
+        bin_seconds: int = 60,
+        max_seconds: int = 4 * 3600,
+        queue_every: int = 1,
+    ):
+        self.severity_levels = severity_levels
+        self.n_districts = n_districts
+        self.initial_ambulances = np.asarray(initial_ambulances, dtype=np.int64)
+        self.bin_seconds = bin_seconds
+        self.n_bins = -(-max_seconds // bin_seconds) + 1
+        self.queue_every = queue_every
+        self.reset()
+
+    def reset(self):
+        shape = (self.severity_levels + 1, self.n_districts + 1, self.n_bins)
+        self.wait_hist = np.zeros(shape, dtype=np.int32)
+        self.arrival_hist = np.zeros(shape, dtype=np.int32)
+        self.wait_sum = np.zeros(shape[:2])
+        self.arrival_sum = np.zeros(shape[:2])
+
+        n_hospitals = len(self.initial_ambulances)
+        self.dispatches = np.zeros((self.severity_levels + 1, n_hospitals), dtype=np.int64)
+        self.busy_seconds = np.zeros(n_hospitals, dtype=np.int64)
+        self.relocation_seconds = np.zeros(n_hospitals, dtype=np.int64)
+
+        # int32 halves the samples, the largest part of long episodes
+        self.queue_steps = np.zeros(64, dtype=np.int32)
+        self.queue_lengths = np.zeros((64, self.severity_levels + 1), dtype=np.int32)
+        self.n_samples = 0
+        self.last_clock = 0
+
+    def get_state(self):
+        """Snapshot of the tracker as a dict of arrays. Histograms and counters are copied, the
+        queue samples already taken are never modified again and are only sliced.
+        """
+        state = {name: getattr(self, name).copy() for name in self.COUNTERS}
+        state["queue_steps"] = self.queue_steps[: self.n_samples]
+        state["queue_lengths"] = self.queue_lengths[: self.n_samples]
+        state["last_clock"] = np.int64(self.last_clock)
+        return state
+
+    def set_state(self, state):
+        for name in self.COUNTERS:
+            setattr(self, name, np.array(state[name]))
+        self.n_samples = len(state["queue_steps"])
+        capacity = max(64, 1 << self.n_samples.bit_length())
+        self.queue_steps = np.zeros(capacity, dtype=np.int32)
+        self.queue_lengths = np.zeros((capacity, self.severity_levels + 1), dtype=np.int32)
+        self.queue_steps[: self.n_samples] = state["queue_steps"]
+        self.queue_lengths[: self.n_samples] = state["queue_lengths"]
+        self.last_clock = int(state["last_clock"])
+
+    def _bin(self, seconds):
+        return min(max(int(seconds), 0) // self.bin_seconds, self.n_bins - 1)
+
+    def record_launch(self, clock, severity, origin, district, tappearance, tobjective, thospital):
+        """Account an ambulance launched at clock (seconds since the start of the episode)."""
+        self.dispatches[severity, origin] += 1
+        if severity == 0:
+            self.relocation_seconds[origin] += thospital - clock
+            return
+        self.busy_seconds[origin] += thospital - clock
+
+        wait = clock - tappearance
+        arrival = tobjective - tappearance
+        self.wait_hist[severity, district, self._bin(wait)] += 1
+        self.arrival_hist[severity, district, self._bin(arrival)] += 1
+        self.wait_sum[severity, district] += wait
+        self.arrival_sum[severity, district] += arrival
+
+    def record_step(self, step, clock, queued):
+        """Sample the per severity queue lengths every queue_every steps."""
+        self.last_clock = clock
+        if step % self.queue_every:
+            return
+        if self.n_samples == len(self.queue_steps):
+            self.queue_steps = np.concatenate([self.queue_steps, np.zeros_like(self.queue_steps)])
+            self.queue_lengths = np.concatenate([self.queue_lengths, np.zeros_like(self.queue_lengths)])
+        self.queue_steps[self.n_samples] = step
+        self.queue_lengths[self.n_samples] = queued
+        self.n_samples += 1
+
+    def utilization(self):
+        """Fraction of the fleet time of every hospital spent attending emergencies."""
+        fleet_seconds = self.initial_ambulances * max(self.last_clock, 1)
+        return np.divide(
+            self.busy_seconds,
+            fleet_seconds,
+            out=np.zeros(len(fleet_seconds)),
+            where=fleet_seconds > 0,
+        )
+
+    def quantile(self, q, kind="arrival", severity=None, district=None):
+        """Quantile q of a response time histogram ("wait" or "arrival"), in seconds, optionally
+        restricted to one severity and/or district. Resolution is bin_seconds, upper bin edge.
+        """
+        hist = self.wait_hist if kind == "wait" else self.arrival_hist
+        hist = hist[1:] if severity is None else hist[severity : severity + 1]
+        hist = hist.sum(axis=0)
+        hist = hist.sum(axis=0) if district is None else hist[district]
+        total = hist.sum()
+        if total == 0:
+            return float("nan")
+        return float((np.searchsorted(np.cumsum(hist), q * total) + 1) * self.bin_seconds)
+
+    def export(self):
+        """All the KPIs as a dict of NumPy arrays, ready for np.savez."""
+        counts = self.wait_hist.sum(axis=2)
+        return {
+            "bin_edges": np.arange(self.n_bins + 1) * self.bin_seconds,
+            "wait_hist": self.wait_hist.copy(),
+            "arrival_hist": self.arrival_hist.copy(),
+            "wait_mean": np.divide(self.wait_sum, counts, out=np.full(counts.shape, np.nan), where=counts > 0),
+            "arrival_mean": np.divide(
+                self.arrival_sum, counts, out=np.full(counts.shape, np.nan), where=counts > 0
+            ),
+            "queue_steps": self.queue_steps[: self.n_samples].copy(),
+            "queue_lengths": self.queue_lengths[: self.n_samples].copy(),
+            "dispatches": self.dispatches.copy(),
+            "busy_seconds": self.busy_seconds.copy(),
+            "relocation_seconds": self.relocation_seconds.copy(),
+            "utilization": self.utilization(),
+        }
@@ -0,0 +1,227 @@
+"""
+Raster renderer for the rgb_array mode of CitySim.
+
+Everything static is computed once: the zone of every pixel (one batched lookup of the pixel
+centers in the city geometry), the zone boundaries and the hospital markers. A frame is then a
+gather of per zone colors, shaded with the current traffic of their traffic district, into a reused
+frame buffer, plus a few vectorized writes for the static overlay, the queued emergencies and the
+moving ambulances. Frames can be streamed to disk by a background thread (FrameWriter).
+"""
+
+import json
+import queue
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+
+import numpy as np
+
+BACKGROUND = (255, 255, 255)
+BOUNDARY = (90, 90, 90)
+HOSPITAL = (20, 60, 200)
+TRAFFIC = np.array([200, 30, 30], dtype=float)
+AMBULANCE = (20, 20, 20)
+
+# Light zone colors, and one color per severity level from green (1) to red (5 and above)
+ZONE_PALETTE = np.array(
+    [
+        (232, 240, 226),
+        (226, 234, 244),
+        (244, 236, 222),
+        (236, 226, 242),
+        (224, 242, 240),
+        (244, 242, 222),
+    ],
+    dtype=float,
+)
+SEVERITY_COLORS = np.array(
+    [(0, 0, 0), (40, 160, 40), (150, 190, 30), (240, 180, 20), (240, 110, 20), (220, 20, 20)],
+    dtype=np.uint8,
+)
+
+
+def _square(size):
+    """Row and column offsets of a size x size square centered on a pixel."""
+    offsets = np.arange(size) - size // 2
+    rows, cols = np.meshgrid(offsets, offsets, indexing="ij")
+    return rows.ravel(), cols.ravel()
+
+
+class CityRenderer:
+    """Renders the state of a CitySim as an RGB array.
+
+    Attributes:
+        env: CitySim being rendered.
+        width, height: int, frame size in pixels. height defaults to the aspect ratio of the city.
+        frame: np.ndarray (height, width, 3) of uint8, reused for every frame.
+        writer: optional FrameWriter receiving every rendered frame.
+    """
+
+    def __init__(self, env, width: int = 640, height=None, writer=None):
+        self.env = env
+        index = env.geometry.index
+        x0, y0 = index.origin
+        x1, y1 = x0 + index.nx * index.cell_size, y0 + index.ny * index.cell_size
+        self.scale = width / (x1 - x0)  # pixels per km
+        self.width = width
+        self.height = height or int(round((y1 - y0) * self.scale))
+        self.x0, self.y1 = x0, y1
+        self.writer = writer
+
+        self.frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self._build_background()
+
+    def _to_pixels(self, x, y):
+        """Row and column of world coordinates (km), north up."""
+        cols = ((np.asarray(x) - self.x0) * self.scale).astype(np.int64)
+        rows = ((self.y1 - np.asarray(y)) * self.scale).astype(np.int64)
+        return rows, cols
+
+    def _build_background(self):
+        env = self.env
+        cols, rows = np.meshgrid(np.arange(self.width), np.arange(self.height))
+        x = self.x0 + (cols + 0.5) / self.scale
+        y = self.y1 - (rows + 0.5) / self.scale
+
+        # Position of the zone of every pixel in [outside] + geometry.codes
+        zones = env.geometry.lookup(x.ravel(), y.ravel()).reshape(self.height, self.width)
+        self.pixel_zone = env.geometry._code_position[zones].astype(np.intp)
+        n_zones = len(env.geometry.codes)
+        self.zone_colors = np.vstack([BACKGROUND, ZONE_PALETTE[np.arange(n_zones) % len(ZONE_PALETTE)]])
+        self.zone_traffic_district = env.zone_traffic_district
+
+        # Static overlay: zone boundaries and hospital markers, as flat pixel indices and colors
+        boundary = np.zeros((self.height, self.width), dtype=bool)
+        boundary[:-1] |= self.pixel_zone[:-1] != self.pixel_zone[1:]
+        boundary[:, :-1] |= self.pixel_zone[:, :-1] != self.pixel_zone[:, 1:]
+        overlay = [(np.flatnonzero(boundary), BOUNDARY)]
+
+        marker_rows, marker_cols = _square(7)
+        rows, cols = self._to_pixels(env.hospital_x[1:], env.hospital_y[1:])
+        rows = (rows[:, None] + marker_rows).ravel()
+        cols = (cols[:, None] + marker_cols).ravel()
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        overlay.append((rows[inside] * self.width + cols[inside], HOSPITAL))
+
+        self.overlay_index = np.concatenate([index for index, _ in overlay])
+        self.overlay_color = np.concatenate(
+            [np.tile(np.array(color, dtype=np.uint8), (len(index), 1)) for index, color in overlay]
+        )
+
+    def _draw_points(self, x, y, colors, size):
+        """Draw size x size squares centered on world coordinates, colors being one RGB per point."""
+        if len(x) == 0:
+            return
+        offset_rows, offset_cols = _square(size)
+        rows, cols = self._to_pixels(x, y)
+        rows = (rows[:, None] + offset_rows).ravel()
+        cols = (cols[:, None] + offset_cols).ravel()
+        colors = np.repeat(colors, len(offset_rows), axis=0)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        self.frame.reshape(-1, 3)[rows[inside] * self.width + cols[inside]] = colors[inside]
+
+    def _ambulance_positions(self):
+        """Current position of the ambulances on the move, interpolated along their route: origin
+        hospital to emergency until tobjective, then emergency to destination hospital.
+        """
+        env = self.env
+        store = env.ambulances
+        if len(store) == 0:
+            return np.zeros(0), np.zeros(0)
+        clock = env.clock
+        t0, t1, t2 = store.view("tdispatch"), store.view("tobjective"), store.view("thospital")
+        origin, destination = store.view("origin"), store.view("destination")
+        ox, oy = env.hospital_x[origin], env.hospital_y[origin]
+        dx, dy = env.hospital_x[destination], env.hospital_y[destination]
+        ex, ey = store.view("x"), store.view("y")
+
+        going = clock < t1
+        start_x, start_y = np.where(going, ox, ex), np.where(going, oy, ey)
+        end_x, end_y = np.where(going, ex, dx), np.where(going, ey, dy)
+        start_t, end_t = np.where(going, t0, t1), np.where(going, t1, t2)
+        fraction = np.clip((clock - start_t) / np.maximum(end_t - start_t, 1), 0, 1)
+        return start_x + (end_x - start_x) * fraction, start_y + (end_y - start_y) * fraction
+
+    def render(self):
+        """Draw the current state into the frame buffer and return it (the same array every
+        call, copy it to keep a frame).
+        """
+        env = self.env
+        manager = env.traffic_manager
+
+        # Zone colors shaded with the load of their traffic district
+        loads = np.array([manager.traffic.get(d, 0.0) for d in self.zone_traffic_district.tolist()])
+        shade = np.clip(loads / manager.max_load, 0, 1)[:, None] * 0.6
+        shade[0] = 0
+        lut = (self.zone_colors * (1 - shade) + TRAFFIC * shade).astype(np.uint8)
+        np.take(lut, self.pixel_zone, axis=0, out=self.frame)
+        self.frame.reshape(-1, 3)[self.overlay_index] = self.overlay_color
+
+        for severity in range(1, env.severity_levels + 1):
+            queued = env.active_emergencies[severity].head(len(env.active_emergencies[severity]))
+            color = SEVERITY_COLORS[min(severity, len(SEVERITY_COLORS) - 1)]
+            self._draw_points(queued["x"], queued["y"], np.tile(color, (len(queued["x"]), 1)), 5)
+
+        x, y = self._ambulance_positions()
+        self._draw_points(x, y, np.tile(np.array(AMBULANCE, dtype=np.uint8), (len(x), 1)), 3)
+
+        if self.writer is not None:
+            self.writer.write(self.frame)
+        return self.frame
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class FrameWriter:
+    """Streams frames to disk from a background thread.
+
+    Video files (.mp4, .mkv, .avi) are encoded by an ffmpeg process, and need ffmpeg. Any other
+    path receives the raw RGB frames back to back, described by a .json sidecar with their shape
+    and frame rate, readable with np.memmap.
+    """
+
+    VIDEO_SUFFIXES = (".mp4", ".mkv", ".avi")
+
+    def __init__(self, path, width: int, height: int, fps: int = 30, max_pending: int = 64):
+        self.path = Path(path)
+        self.shape = (height, width, 3)
+        self._queue = queue.Queue(maxsize=max_pending)
+        if self.path.suffix in self.VIDEO_SUFFIXES:
+            if not shutil.which("ffmpeg"):
+                raise RuntimeError(f"ffmpeg is needed to write {self.path}, use another suffix for raw frames")
+            self._process = subprocess.Popen(
+                [
+                    "ffmpeg", "-loglevel", "error", "-y",
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps),
+                    "-i", "-", "-pix_fmt", "yuv420p", str(self.path),
+                ],
+                stdin=subprocess.PIPE,
+            )
+            self._output = self._process.stdin
+        else:
+            self._process = None
+            self._output = self.path.open("wb")
+            with self.path.with_suffix(self.path.suffix + ".json").open("w") as f:
+                json.dump({"shape": list(self.shape), "dtype": "uint8", "fps": fps}, f)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def write(self, frame):
+        self._queue.put(frame.copy())
+
+    def _write(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            self._output.write(frame.tobytes())
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._output.close()
+        if self._process is not None:
+            self._process.wait()
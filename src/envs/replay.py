@@ -0,0 +1,195 @@
+"""
+Historical replay of real SAMUR emergencies for CitySim.
+
+ReplaySource streams the processed SAMUR dataset (see preprocess_SAMUR.py), which is sorted by
+request time, and hands CitySim the emergencies of every step as arrays. A reader thread parses
+the CSV in chunks and keeps at most a few of them ready in a bounded queue, so multi-year replays
+use constant memory and the simulation does not wait for pandas between steps.
+"""
+
+import importlib.util
+import queue
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DATASET_DIR = Path(__file__).resolve().parents[2] / "Dataset Cleaning and Exploration"
+
+FIELDS = ("t", "severity", "district", "x", "y")
+
+
+def _load_dataset_utils():
+    """Import the coordinate helpers of the dataset pipeline (utils.py), which imports its
+    DatasetPaths sibling.
+    """
+    if str(DATASET_DIR) not in sys.path:
+        sys.path.append(str(DATASET_DIR))
+    spec = importlib.util.spec_from_file_location("samur_dataset_utils", DATASET_DIR / "utils.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _empty():
+    return {
+        "t": np.zeros(0, dtype=np.int64),
+        "severity": np.zeros(0, dtype=np.int8),
+        "district": np.zeros(0, dtype=np.int32),
+        "x": np.zeros(0),
+        "y": np.zeros(0),
+    }
+
+
+class ReplaySource:
+    """Emergency source that replays historical records on the simulation clock.
+
+    Attributes:
+        samur_file: str or Path, processed SAMUR dataset, sorted by request time.
+        districts_file: str or Path, distritos_municipio_madrid.csv, used to map the dataset
+            district names (DATASET_SAMUR column) to district codes.
+        time_start: datetime, historical time that corresponds to the start of the simulation.
+        time_column, severity_column, district_column: str, dataset column names.
+        latitude_column, longitude_column: str, optional coordinate columns. When present, the
+            coordinates are converted with utils.coordinatesToKm0, otherwise CitySim places the
+            emergency at a random point of its district.
+        chunksize: int, rows parsed at a time by the reader thread.
+        prefetch: int, maximum number of parsed chunks waiting to be consumed.
+    """
+
+    def __init__(
+        self,
+        samur_file,
+        districts_file,
+        time_start,
+        time_column: str = "Solicitud",
+        severity_column: str = "Gravedad",
+        district_column: str = "Distrito",
+        latitude_column=None,
+        longitude_column=None,
+        chunksize: int = 100000,
+        prefetch: int = 4,
+    ):
+        self.samur_file = samur_file
+        self.time_start = pd.Timestamp(time_start)
+        self.time_column = time_column
+        self.severity_column = severity_column
+        self.district_column = district_column
+        self.latitude_column = latitude_column
+        self.longitude_column = longitude_column
+        self.chunksize = chunksize
+        self.prefetch = prefetch
+
+        df_districts = pd.read_csv(districts_file, encoding="utf-8-sig")
+        self.district_codes = dict(zip(df_districts["DATASET_SAMUR"], df_districts["codigo"].astype(int)))
+        self.coordinates = latitude_column is not None and longitude_column is not None
+        if self.coordinates:
+            self.utils = _load_dataset_utils()
+
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        """Restart the replay from time_start."""
+        self.close()
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._stop = threading.Event()
+        self._current = _empty()
+        self._position = 0
+        self._exhausted = False
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        # Unblock the reader if it is waiting for room in the queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        self._thread = None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _read(self):
+        usecols = [self.time_column, self.severity_column, self.district_column]
+        if self.coordinates:
+            usecols += [self.latitude_column, self.longitude_column]
+        try:
+            for chunk in pd.read_csv(self.samur_file, usecols=usecols, chunksize=self.chunksize):
+                if self._stop.is_set():
+                    return
+                records = self._convert(chunk)
+                if len(records["t"]) > 0:
+                    self._put(records)
+            self._put(None)
+        except Exception as error:  # Surfaced in the simulation thread
+            self._put(error)
+
+    def _convert(self, chunk):
+        time = pd.to_datetime(chunk[self.time_column])
+        seconds = (time - self.time_start).dt.total_seconds().values
+        severity = pd.to_numeric(chunk[self.severity_column], errors="coerce").fillna(0).values
+        district = chunk[self.district_column].map(self.district_codes).fillna(0).values
+
+        if self.coordinates:
+            x, y = self.utils.coordinatesToKm0(
+                chunk[self.latitude_column].values.astype(float),
+                chunk[self.longitude_column].values.astype(float),
+            )
+        else:
+            x = y = np.full(len(chunk), np.nan)
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+        # Records before the start, without severity or without any location are skipped
+        located = (district > 0) | (~np.isnan(x) & ~np.isnan(y))
+        valid = (seconds >= 0) & (severity > 0) & located
+        return {
+            "t": np.ceil(seconds[valid]).astype(np.int64),
+            "severity": severity[valid].astype(np.int8),
+            "district": district[valid].astype(np.int32),
+            "x": x[valid],
+            "y": y[valid],
+        }
+
+    def _next_chunk(self):
+        item = self._queue.get()
+        if item is None:
+            self._exhausted = True
+            return False
+        if isinstance(item, Exception):
+            self._exhausted = True
+            raise item
+        self._current = item
+        self._position = 0
+        return True
+
+    def pop_until(self, clock):
+        """Records with t <= clock (seconds since time_start) not returned yet, as a dict of arrays
+        with the fields t, severity, district, x and y.
+        """
+        pieces = []
+        while True:
+            t = self._current["t"]
+            end = self._position + np.searchsorted(t[self._position :], clock, side="right")
+            if end > self._position:
+                pieces.append({k: v[self._position : end] for k, v in self._current.items()})
+                self._position = end
+            if end < len(t) or self._exhausted or not self._next_chunk():
+                break
+        if not pieces:
+            return _empty()
+        if len(pieces) == 1:
+            return pieces[0]
+        return {k: np.concatenate([piece[k] for piece in pieces]) for k in FIELDS}
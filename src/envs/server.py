@@ -0,0 +1,386 @@
+"""
+Local asynchronous server of CitySim instances.
+
+Agents in other processes (or other languages) use simulators hosted by the server instead of
+loading the city data themselves. The server is a coordinator plus worker processes, every worker
+holding a pool of ready CitySim instances behind its own socket, a Unix domain socket path or a
+localhost TCP port. A client first asks the coordinator for room for its environments, the
+coordinator places them on the least loaded worker and replies with its address, and the client
+then talks to that worker directly, so steps never go through an extra hop. The coordinator
+connection is kept open as a lease and closing it frees the room.
+
+Messages are binary frames, a fixed header followed by a payload:
+
+    length u32 | opcode (status in replies) u8 | slot u16 | request id u32 | payload
+
+with little endian raw arrays as payloads: int64 actions, and in replies the observation tables
+in the layout announced by OPEN. Requests are pipelined: a client can send several frames without
+waiting, the worker answers them in order and all the replies to what arrived together are
+written at once.
+
+    python -m src.envs.server -a /tmp/citysim.sock -w 2 -n 8
+"""
+
+import abc
+import asyncio
+import getopt
+import json
+import multiprocessing
+import os
+import random
+import signal
+import struct
+import sys
+from pathlib import Path
+
+import numpy as np
+
+HEADER = struct.Struct("<IBHI")
+STEP_HEADER = struct.Struct("<dB")
+
+# Opcodes
+PING = 0
+LOCATE = 1  # Coordinator: room for u16 environments, replies with the worker address
+OPEN = 2  # Worker: u16 environments for this connection, replies with the JSON layout
+CLOSE = 3
+SEED = 4  # int64 seed
+RESET = 5
+STEP = 6  # int64 actions, (n, 3)
+STEP_BATCH = 7  # u16 n of every environment of the connection, then all their int64 actions
+
+# Reply status
+OK = 0
+ERROR = 1
+
+
+def frame(code, slot, request, payload=b""):
+    return HEADER.pack(len(payload), code, slot, request) + payload
+
+
+def worker_address(address, worker):
+    """Address of a worker: socket path with a .<worker> suffix, or the next TCP ports."""
+    if isinstance(address, tuple):
+        return (address[0], address[1] + 1 + worker)
+    return f"{address}.{worker}"
+
+
+def parse_address(address):
+    """"host:port" for TCP, anything else is a Unix domain socket path."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+async def _listen(factory, address):
+    loop = asyncio.get_running_loop()
+    if isinstance(address, tuple):
+        return await loop.create_server(factory, *address)
+    if os.path.exists(address):
+        os.unlink(address)
+    return await loop.create_unix_server(factory, address)
+
+
+class _FrameProtocol(asyncio.Protocol, metaclass=abc.ABCMeta):
+    """Splits the incoming bytes into frames and writes the replies to every read at once."""
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.buffer = bytearray()
+
+    def data_received(self, data):
+        self.buffer += data
+        replies = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, code, slot, request = HEADER.unpack_from(self.buffer, offset)
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            payload = self.buffer[offset + HEADER.size : end]
+            offset = end
+            try:
+                replies.append(frame(OK, slot, request, self.handle(code, slot, payload)))
+            except Exception as error:
+                replies.append(frame(ERROR, slot, request, repr(error).encode()))
+        del self.buffer[:offset]
+        if replies:
+            self.transport.write(b"".join(replies))
+
+    @abc.abstractmethod
+    def handle(self, code, slot, payload):
+        """Payload of the reply to a request frame, raising to reply with an error."""
+
+
+class _Worker:
+    """Pool of CitySim instances of one worker process.
+
+    The instances share the process wide NumPy and Python random generators, so the state of the
+    generators is swapped whenever a different instance is used, which keeps every episode
+    identical to one run by a standalone CitySim with the same seed.
+    """
+
+    def __init__(self, env_kwargs, capacity):
+        from .citysim import CitySim
+
+        self.envs = [CitySim(**env_kwargs) for _ in range(capacity)]
+        for env in self.envs:
+            env.reset()
+        self.free = list(range(capacity))
+        self.rng_states = [(np.random.get_state(), random.getstate()) for _ in range(capacity)]
+        self.active = None
+
+        env = self.envs[0]
+        observation = env._get_obs()
+        mask = env.action_mask()
+        self.observation_layout = [(part.dtype, part.shape) for part in observation]
+        self.layout = {
+            "observation": [[dtype.str, list(shape)] for dtype, shape in self.observation_layout],
+            "mask": [[name, len(mask[name])] for name in ("severity", "hospital")],
+            "action_nvec": env.action_space.nvec.tolist(),
+            "severity_levels": env.severity_levels,
+            "n_hospitals": env.n_hospitals,
+            "time_step": env.time_step_seconds,
+        }
+
+    def acquire(self, count):
+        if count > len(self.free):
+            raise RuntimeError(f"{count} environments requested, {len(self.free)} free")
+        acquired, self.free = self.free[:count], self.free[count:]
+        return acquired
+
+    def release(self, indices):
+        """Free instances for the next client, each one reset to a new episode with new random
+        generators, as a new CitySim.
+        """
+        if self.active in indices:
+            self.activate(None)
+        for index in indices:
+            self.envs[index].reset()
+            self.rng_states[index] = (np.random.RandomState().get_state(), random.Random().getstate())
+        self.free.extend(indices)
+
+    def activate(self, index):
+        """Make the random generators those of instance index."""
+        if index == self.active:
+            return
+        if self.active is not None:
+            self.rng_states[self.active] = (np.random.get_state(), random.getstate())
+        if index is not None:
+            np_state, py_state = self.rng_states[index]
+            np.random.set_state(np_state)
+            random.setstate(py_state)
+        self.active = index
+
+    def encode_observation(self, observation):
+        """Raw bytes of the observation tables, which must keep the layout announced by OPEN: the
+        client decodes them with those dtypes and shapes.
+        """
+        layout = self.observation_layout
+        if len(observation) != len(layout):
+            raise ValueError(f"Observation of {len(observation)} tables, the layout has {len(layout)}")
+        for part, (dtype, shape) in zip(observation, layout):
+            if part.dtype != dtype or part.shape != shape:
+                raise ValueError(f"Observation table {part.dtype.str} {part.shape}, the layout has {dtype.str} {shape}")
+        return b"".join(np.ascontiguousarray(part).tobytes() for part in observation)
+
+    def encode_step(self, observation, reward, done, info):
+        mask = info["action_mask"]
+        return b"".join(
+            (
+                STEP_HEADER.pack(reward, done),
+                self.encode_observation(observation),
+                mask["severity"].tobytes(),
+                mask["hospital"].tobytes(),
+            )
+        )
+
+    def step(self, index, action):
+        self.activate(index)
+        return self.envs[index].step(action)
+
+
+class _WorkerProtocol(_FrameProtocol):
+    def __init__(self, worker):
+        self.worker = worker
+        self.slots = []
+
+    def handle(self, code, slot, payload):
+        worker = self.worker
+        if code == STEP:
+            index = self.slots[slot]
+            action = np.frombuffer(payload, dtype=np.int64).reshape(-1, 3)
+            return worker.encode_step(*worker.step(index, action))
+        if code == STEP_BATCH:
+            # Finished environments are reset, returning the first observation of the next episode
+            rows = np.frombuffer(payload, dtype=np.uint16, count=len(self.slots))
+            actions = np.frombuffer(payload, dtype=np.int64, offset=2 * len(self.slots)).reshape(-1, 3)
+            records = []
+            for index, action in zip(self.slots, np.split(actions, np.cumsum(rows)[:-1])):
+                observation, reward, done, info = worker.step(index, action)
+                if done:
+                    observation = worker.envs[index].reset()
+                records.append(worker.encode_step(observation, reward, done, info))
+            return b"".join(records)
+        if code == RESET:
+            index = self.slots[slot]
+            worker.activate(index)
+            return worker.encode_observation(worker.envs[index].reset())
+        if code == SEED:
+            # Both generators, the Python one drives the traffic noise
+            seed = int(np.frombuffer(payload, dtype=np.int64)[0])
+            worker.activate(self.slots[slot])
+            worker.envs[self.slots[slot]].seed(seed)
+            random.seed(seed)
+            return b""
+        if code == PING:
+            return payload
+        if code == OPEN:
+            self.slots += worker.acquire(struct.unpack("<H", payload)[0])
+            return json.dumps(dict(worker.layout, slots=len(self.slots))).encode()
+        if code == CLOSE:
+            self.release()
+            return b""
+        raise ValueError(f"Unknown opcode {code}")
+
+    def release(self):
+        self.worker.release(self.slots)
+        self.slots = []
+
+    def connection_lost(self, exc):
+        self.release()
+
+
+def _run_worker(address, env_kwargs, capacity, ready):
+    worker = _Worker(env_kwargs, capacity)
+
+    async def serve():
+        server = await _listen(lambda: _WorkerProtocol(worker), address)
+        ready.send(True)
+        ready.close()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+class _CoordinatorProtocol(_FrameProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.leases = []
+
+    def handle(self, code, slot, payload):
+        if code == LOCATE:
+            count = struct.unpack("<H", payload)[0]
+            worker = self.server.place(count)
+            self.leases.append((worker, count))
+            return json.dumps({"address": worker_address(self.server.address, worker)}).encode()
+        if code == PING:
+            return payload
+        raise ValueError(f"Unknown opcode {code}")
+
+    def connection_lost(self, exc):
+        for worker, count in self.leases:
+            self.server.load[worker] -= count
+        self.leases = []
+
+
+class EnvServer:
+    """Coordinator of a set of worker processes hosting CitySim instances.
+
+    Attributes:
+        address: str path of a Unix domain socket, or (host, port) for TCP. Workers listen on the
+            same path with a .<worker> suffix, or on the next ports.
+        env_kwargs: dict of CitySim arguments of every instance.
+        workers: int, number of worker processes.
+        envs_per_worker: int, instances built by every worker.
+        load: list of int, environments currently placed on every worker.
+    """
+
+    def __init__(self, address, env_kwargs=None, workers: int = 1, envs_per_worker: int = 4):
+        self.address = address
+        self.env_kwargs = env_kwargs or {}
+        self.workers = workers
+        self.envs_per_worker = envs_per_worker
+        self.load = [0] * workers
+        self.processes = []
+
+    def place(self, count):
+        """Worker with the fewest environments among those with room for count more."""
+        candidates = [k for k in range(self.workers) if self.load[k] + count <= self.envs_per_worker]
+        if not candidates:
+            raise RuntimeError(f"No worker has room for {count} more environments")
+        worker = min(candidates, key=lambda k: self.load[k])
+        self.load[worker] += count
+        return worker
+
+    async def serve(self):
+        pipes = []
+        for worker in range(self.workers):
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_run_worker,
+                args=(worker_address(self.address, worker), self.env_kwargs, self.envs_per_worker, sender),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+            pipes.append(receiver)
+        loop = asyncio.get_running_loop()
+        for receiver in pipes:
+            await loop.run_in_executor(None, receiver.recv)
+
+        server = await _listen(lambda: _CoordinatorProtocol(self), self.address)
+        serving = asyncio.ensure_future(server.serve_forever())
+        loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+        try:
+            async with server:
+                await serving
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for process in self.processes:
+                process.terminate()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+def usage():
+    print("server.py [-a <socketpath|host:port>] [-w <workers>] [-n <envsperworker>] [-s <stress>] [-t <timestep>]")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:], "ha:w:n:s:t:", ["address=", "workers=", "envs=", "stress=", "timestep="]
+        )
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    root = Path(__file__).resolve().parents[2]
+    env_kwargs = {
+        "city_config": root / "data/city_defaults.yaml",
+        "city_geometry": root / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        "traffic_default_cols": root / "data/default_columns.csv",
+        "traffic_models": root / "data/traffic_model.npz",
+    }
+    address, workers, envs_per_worker = "/tmp/citysim.sock", 1, 4
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt in ("-a", "--address"):
+            address = parse_address(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-n", "--envs"):
+            envs_per_worker = int(arg)
+        elif opt in ("-s", "--stress"):
+            env_kwargs["stress"] = float(arg)
+        elif opt in ("-t", "--timestep"):
+            env_kwargs["time_step"] = int(arg)
+
+    print(f"Serving {workers * envs_per_worker} CitySim instances on {address}")
+    EnvServer(address, env_kwargs, workers, envs_per_worker).run()
@@ -0,0 +1,87 @@
+"""
+Precomputed calendar for an integer simulation clock.
+
+CitySim advances an integer number of steps of time_step seconds. Everything that depends on the
+date (emergency rates, observations, traffic updates) reads it from per-step arrays computed once
+for the whole episode, and datetimes are only materialized when talking to the outside world
+(API, logs).
+"""
+
+from datetime import timedelta
+import math
+
+import numpy as np
+
+
+class SimCalendar:
+    """Calendar fields for every step of an episode.
+
+    Attributes:
+        time_start: datetime, time of step 0.
+        time_step: int, seconds per step.
+        slot_minutes: int, length of a traffic slot. Slot 0 is the one containing time_start.
+        year, month, day, weekday, hour, minute: np.ndarray per step. weekday follows
+            datetime.weekday(), 0 is Monday.
+        slot: np.ndarray, traffic slot of every step.
+        slot_offset: int, seconds from the start of slot 0 to time_start.
+    """
+
+    def __init__(self, time_start, time_end, time_step: int, slot_minutes: int = 15):
+        self.time_start = time_start
+        self.time_step = time_step
+        self.slot_minutes = slot_minutes
+        self.end_seconds = math.ceil((time_end - time_start).total_seconds())
+        self._build(self.end_seconds // time_step + 2)
+
+    def _build(self, n_steps):
+        self.n_steps = n_steps
+        seconds = np.arange(n_steps, dtype=np.int64) * self.time_step
+        self.year, self.month, self.day, self.weekday, self.hour, self.minute = self.fields(seconds)
+
+        slot_seconds = self.slot_minutes * 60
+        self.slot_offset = (int(self.hour[0]) * 3600 + int(self.minute[0]) * 60 + self.time_start.second) % slot_seconds
+        self.slot = ((self.slot_offset + seconds) // slot_seconds).astype(np.int32)
+
+    def fields(self, seconds):
+        """(year, month, day, weekday, hour, minute) arrays for clock values in seconds."""
+        start = np.datetime64(self.time_start.replace(tzinfo=None), "s")
+        times = start + np.asarray(seconds, dtype=np.int64) * np.timedelta64(1, "s")
+
+        days = times.astype("M8[D]")
+        months = times.astype("M8[M]")
+        seconds_of_day = (times - days).astype(np.int64)
+        return (
+            (times.astype("M8[Y]").astype(np.int64) + 1970).astype(np.int16),
+            (months.astype(np.int64) % 12 + 1).astype(np.int8),
+            ((days - months.astype("M8[D]")).astype(np.int64) + 1).astype(np.int8),
+            ((days.astype(np.int64) + 3) % 7).astype(np.int8),  # 1970-01-01 was Thursday
+            (seconds_of_day // 3600).astype(np.int8),
+            (seconds_of_day % 3600 // 60).astype(np.int8),
+        )
+
+    def ensure(self, step):
+        """Extend the tables if an agent keeps stepping after the end of the episode."""
+        if step >= self.n_steps:
+            self._build(max(step + 1, 2 * self.n_steps))
+
+    def datetime(self, seconds):
+        """Materialize a clock value, in seconds since time_start, as a datetime."""
+        return self.time_start + timedelta(seconds=int(seconds))
+
+    def slot_start(self, slot):
+        """Clock value in seconds at the start of a traffic slot, negative for slot 0 when
+        time_start is not on a slot boundary.
+        """
+        return slot * self.slot_minutes * 60 - self.slot_offset
+
+    def slot_point(self, step):
+        """(year, month, day, weekday, hour, minute) at the start of the traffic slot of a step."""
+        minute = int(self.minute[step])
+        return (
+            int(self.year[step]),
+            int(self.month[step]),
+            int(self.day[step]),
+            int(self.weekday[step]),
+            int(self.hour[step]),
+            minute - minute % self.slot_minutes,
+        )
@@ -0,0 +1,173 @@
+"""
+Point in district lookup for the city geometry.
+
+DistrictIndex lays a regular grid over the city. Every cell is classified once: fully inside one
+district, outside every district, or crossed by a district boundary. Looking up a point is then an
+array index for most points, and exact polygon tests are only run, batched per polygon, for the
+points that fall in boundary cells. Any number of zones can be indexed (21 districts, ~131
+barrios or custom zones), and lookups take arrays of coordinates so that the dataset pipeline can
+geocode millions of points at once.
+"""
+
+import numpy as np
+import shapefile
+from shapely.geometry import shape
+
+try:  # Shapely 2
+    from shapely import contains_xy
+except ImportError:
+    from shapely.vectorized import contains as contains_xy
+
+OUTSIDE = 0
+BOUNDARY = -1
+
+
+def _segment_points(start, end, spacing):
+    """Points along the segments start[i] -> end[i], at most spacing apart, and the segment index
+    of every point. The end point of the segments is not included.
+    """
+    steps = np.maximum(np.ceil(np.hypot(*(end - start).T) / spacing).astype(int), 1)
+    segment = np.repeat(np.arange(len(steps)), steps)
+    fractions = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)
+    fractions = fractions / steps[segment]
+    return start[segment] + (end - start)[segment] * fractions[:, None], segment
+
+
+def _ring_points(geometry, spacing):
+    """Points along every ring of a (multi)polygon, at most spacing apart."""
+    boundary = geometry.boundary
+    lines = getattr(boundary, "geoms", [boundary])
+    points = []
+    for line in lines:
+        coords = np.asarray(line.coords)
+        points.append(_segment_points(coords[:-1], coords[1:], spacing)[0])
+        points.append(coords[-1:])
+    return np.concatenate(points)
+
+
+class DistrictIndex:
+    """Grid accelerated point in polygon index.
+
+    Attributes:
+        codes: np.ndarray of int, zone code of every indexed polygon.
+        polygons: list of shapely geometries, in the same order as codes.
+        cell_size: float, grid cell side in the units of the geometry (km for CitySim).
+        origin: (x, y) of the lower left corner of the grid.
+        grid: np.ndarray (ny, nx), zone code of every cell fully inside a zone, OUTSIDE (0) for
+            cells outside every zone and BOUNDARY (-1) for cells crossed by a boundary.
+        candidates: np.ndarray (n_boundary_cells, n_polygons) of bool, polygons that may contain
+            the points of every boundary cell. Row i belongs to the cell where boundary_id is i.
+    """
+
+    def __init__(self, polygons, codes=None, cell_size: float = 0.1, arrays=None):
+        self.polygons = list(polygons)
+        self.codes = np.arange(1, len(self.polygons) + 1) if codes is None else np.asarray(codes)
+        self.cell_size = cell_size
+
+        bounds = np.array([polygon.bounds for polygon in self.polygons])
+        self.origin = (bounds[:, 0].min() - cell_size, bounds[:, 1].min() - cell_size)
+        self.nx = int(np.ceil((bounds[:, 2].max() - self.origin[0]) / cell_size)) + 2
+        self.ny = int(np.ceil((bounds[:, 3].max() - self.origin[1]) / cell_size)) + 2
+        if arrays is None:
+            self._build()
+        else:
+            # Classification saved by arrays() for the same polygons and cell size
+            self.grid = arrays["grid"]
+            self.boundary_id = arrays["boundary_id"]
+            self.candidates = arrays["candidates"]
+
+    @classmethod
+    def from_shapefile(cls, path, codes=None, cell_size: float = 0.1):
+        """Index the shapes of a shapefile. Codes default to 1..n in file order, as CitySim does."""
+        with shapefile.Reader(str(path)) as sf:
+            polygons = [shape(s) for s in sf.shapes()]
+        return cls(polygons, codes, cell_size)
+
+    def _build(self):
+        n = len(self.polygons)
+        grid = np.full((self.ny, self.nx), OUTSIDE, dtype=np.int32)
+        boundary = np.zeros((n, self.ny, self.nx), dtype=bool)
+
+        # Grid corners, a cell not crossed by a boundary is inside a polygon iff its corners are
+        corner_x = self.origin[0] + np.arange(self.nx + 1) * self.cell_size
+        corner_y = self.origin[1] + np.arange(self.ny + 1) * self.cell_size
+        for i, polygon in enumerate(self.polygons):
+            # Cells within one cell of a boundary sample, samples half a cell apart
+            points = _ring_points(polygon, self.cell_size / 2)
+            ix, iy = self._cell_of(points[:, 0], points[:, 1])
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    boundary[i, np.clip(iy + dy, 0, self.ny - 1), np.clip(ix + dx, 0, self.nx - 1)] = True
+
+            min_x, min_y, max_x, max_y = polygon.bounds
+            cols = slice(*self._cell_range(min_x, max_x, corner_x))
+            rows = slice(*self._cell_range(min_y, max_y, corner_y))
+            cx, cy = np.meshgrid(corner_x[cols.start : cols.stop + 1], corner_y[rows.start : rows.stop + 1])
+            inside = contains_xy(polygon, cx, cy)
+            cells_inside = inside[:-1, :-1] & inside[1:, :-1] & inside[:-1, 1:] & inside[1:, 1:]
+            window = grid[rows, cols]
+            window[cells_inside & ~boundary[i, rows, cols]] = self.codes[i]
+
+        crossed = boundary.any(axis=0)
+        grid[crossed] = BOUNDARY
+        self.grid = grid
+        self.boundary_id = np.full(grid.shape, -1, dtype=np.int64)
+        self.boundary_id[crossed] = np.arange(crossed.sum())
+        self.candidates = boundary[:, crossed].T.copy()
+
+    def arrays(self):
+        """Grid classification, to be cached and passed back to the constructor."""
+        return {"grid": self.grid, "boundary_id": self.boundary_id, "candidates": self.candidates}
+
+    def _cell_range(self, low, high, corners):
+        start = max(int(np.floor((low - corners[0]) / self.cell_size)), 0)
+        stop = min(int(np.ceil((high - corners[0]) / self.cell_size)), len(corners) - 1)
+        return start, stop
+
+    def _cell_of(self, x, y):
+        """Cell column and row of every point, -1 for points with missing coordinates."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        finite = np.isfinite(x) & np.isfinite(y)
+        ix = np.floor((np.where(finite, x, self.origin[0]) - self.origin[0]) / self.cell_size)
+        iy = np.floor((np.where(finite, y, self.origin[1]) - self.origin[1]) / self.cell_size)
+        return np.where(finite, ix, -1).astype(np.int64), np.where(finite, iy, -1).astype(np.int64)
+
+    def lookup(self, x, y):
+        """Zone code containing every point of the arrays x, y, 0 for points outside every zone."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        ix, iy = self._cell_of(x, y)
+        in_grid = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+
+        result = np.full(x.shape, OUTSIDE, dtype=np.int64)
+        result[in_grid] = self.grid[iy[in_grid], ix[in_grid]]
+
+        # Exact tests for the points in boundary cells, batched by candidate polygon
+        pending = np.flatnonzero(result == BOUNDARY)
+        result[pending] = OUTSIDE
+        if pending.size:
+            rows = self.boundary_id[iy.flat[pending], ix.flat[pending]]
+            for i in np.flatnonzero(self.candidates[rows].any(axis=0)):
+                test = pending[self.candidates[rows, i]]
+                test = test[result.flat[test] == OUTSIDE]
+                if test.size:
+                    inside = contains_xy(self.polygons[i], x.flat[test], y.flat[test])
+                    result.flat[test[inside]] = self.codes[i]
+        return result
+
+    def lookup_one(self, x, y):
+        return int(self.lookup(np.array([x]), np.array([y]))[0])
+
+    def cell_centers(self):
+        """(x, y) arrays, shaped like grid, with the center of every cell."""
+        x = self.origin[0] + (np.arange(self.nx) + 0.5) * self.cell_size
+        y = self.origin[1] + (np.arange(self.ny) + 0.5) * self.cell_size
+        return np.meshgrid(x, y)
+
+    def center_codes(self):
+        """Zone code at the center of every cell, boundary cells resolved exactly."""
+        if not hasattr(self, "_center_codes"):
+            x, y = self.cell_centers()
+            self._center_codes = self.lookup(x, y)
+        return self._center_codes
@@ -0,0 +1,188 @@
+"""
+Array-backed storage for the dynamic state of CitySim.
+
+Emergencies waiting for an ambulance and ambulances on the move are kept as structures of arrays:
+one growable NumPy column per field instead of one Python object per record. Queues of tens of
+thousands of emergencies then take a few dozen bytes per record, and the observation and reward
+computations work on column slices instead of Python loops.
+"""
+
+import numpy as np
+
+
+class ColumnStore:
+    """Set of equally long, growable NumPy columns described by a (name, dtype) list."""
+
+    FIELDS = ()
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.FIELDS}
+
+    def _grow(self, order):
+        """Double the capacity, copying the records given by the index array order to the front."""
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.zeros(self.capacity, dtype=column.dtype)
+            grown[: len(order)] = column[order]
+            self.columns[name] = grown
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+
+class EmergencyQueue(ColumnStore):
+    """FIFO queue of emergencies of one severity, stored as a ring buffer."""
+
+    FIELDS = (
+        ("x", np.float64),
+        ("y", np.float64),
+        ("district", np.int32),
+        ("severity", np.int8),
+        ("tappearance", np.int64),
+        ("code", np.int64),
+    )
+
+    def __init__(self, capacity: int = 64):
+        super().__init__(capacity)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def _indices(self, n):
+        return (self.start + np.arange(n)) % self.capacity
+
+    def append(self, x, y, district, severity, tappearance, code):
+        if self.size == self.capacity:
+            self._grow(self._indices(self.size))
+            self.start = 0
+        i = (self.start + self.size) % self.capacity
+        columns = self.columns
+        columns["x"][i] = x
+        columns["y"][i] = y
+        columns["district"][i] = district
+        columns["severity"][i] = severity
+        columns["tappearance"][i] = tappearance
+        columns["code"][i] = code
+        self.size += 1
+
+    def popleft(self):
+        """Remove the oldest emergency and return it as (x, y, district, severity, tappearance, code)."""
+        if self.size == 0:
+            raise IndexError("pop from an empty emergency queue")
+        i = self.start
+        self.start = (self.start + 1) % self.capacity
+        self.size -= 1
+        return tuple(self.columns[name][i].item() for name, _ in self.FIELDS)
+
+    def get_state(self):
+        """Copy of the queued emergencies, oldest first, as a dict of columns."""
+        return {name: np.array(column) for name, column in self.head(self.size).items()}
+
+    def set_state(self, columns):
+        size = len(columns["code"])
+        self.capacity = max(64, 1 << int(size).bit_length())
+        self.columns = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in self.FIELDS}
+        for name, column in self.columns.items():
+            column[:size] = columns[name]
+        self.start = 0
+        self.size = size
+
+    def head(self, n):
+        """Columns of the n oldest emergencies (or fewer if the queue is shorter)."""
+        n = min(n, self.size)
+        if self.start + n <= self.capacity:
+            return {name: column[self.start : self.start + n] for name, column in self.columns.items()}
+        indices = self._indices(n)
+        return {name: column[indices] for name, column in self.columns.items()}
+
+
+class AmbulanceStore(ColumnStore):
+    """Ambulances that left a hospital and have not reached their destination hospital yet.
+
+    An ambulance is travelling to its emergency until tobjective, and then going to its
+    destination hospital until thospital. Relocations between hospitals have severity 0 and
+    tobjective equal to the dispatch time. Records are kept compact, in dispatch order.
+    """
+
+    FIELDS = (
+        ("tdispatch", np.int64),
+        ("tobjective", np.int64),
+        ("thospital", np.int64),
+        ("origin", np.int16),
+        ("destination", np.int16),
+        ("severity", np.int8),
+        ("code", np.int64),
+        ("x", np.float64),
+        ("y", np.float64),
+        ("district", np.int32),
+        ("tappearance", np.int64),
+    )
+
+    def __init__(self, capacity: int = 64):
+        super().__init__(capacity)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.size = 0
+
+    def append(self, **values):
+        if self.size == self.capacity:
+            self._grow(np.arange(self.size))
+        for name, value in values.items():
+            self.columns[name][self.size] = value
+        self.size += 1
+
+    def get_state(self):
+        """Copy of the ambulances on the move as a dict of columns."""
+        return {name: self.view(name).copy() for name in self.columns}
+
+    def set_state(self, columns):
+        size = len(columns["code"])
+        self.capacity = max(64, 1 << int(size).bit_length())
+        self.columns = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in self.FIELDS}
+        for name, column in self.columns.items():
+            column[:size] = columns[name]
+        self.size = size
+
+    def view(self, name):
+        return self.columns[name][: self.size]
+
+    def advance(self, clock, time_step):
+        """Apply one step of travel at time clock.
+
+        Returns the reward accumulated by the ambulances still on their way (every severity on
+        the way to the emergency, severities above 3 also on the way to the hospital) and the
+        destination hospitals of the ambulances that arrived, which are removed from the store.
+        """
+        severity = self.view("severity").astype(np.int64)
+        travelling = clock < self.view("tobjective")
+        arrived = ~travelling & (clock >= self.view("thospital"))
+        carrying = ~travelling & ~arrived & (severity > 3)
+
+        reward = -float(severity[travelling].sum() * time_step)
+        # Once the patient is in the ambulance the cost should be lower
+        reward += -float(severity[carrying].sum() * time_step * 0.5)
+
+        released = self.view("destination")[arrived].astype(np.int64)
+        if released.size:
+            self.compact(np.flatnonzero(~arrived))
+        return reward, released
+
+    def compact(self, keep):
+        """Keep only the records of the index array keep, in that order."""
+        for column in self.columns.values():
+            column[: keep.size] = column[keep]
+        self.size = keep.size
+
+    def count_by_destination(self, n_hospitals):
+        return np.bincount(self.view("destination"), minlength=n_hospitals)
@@ -0,0 +1,343 @@
+"""
+Golden traces of CitySim runs, to prove that engine variants keep the reference dynamics.
+
+A trace records a seeded run: the actions of every step, the reward and the event counts (new
+emergencies, launches, arrivals) of every step, and every `every` steps a hash of each group of
+the complete dynamic state (see CitySim.get_state): random generators, queues, ambulances,
+counters, traffic and KPIs. Hashes are chained, each one covers the previous one, so a state
+difference that appears between two hashed steps is still caught at the next one.
+
+Replaying a trace feeds the recorded actions to any CitySim (another backend, a new kernel, an
+optimized geometry) and reports the first step where a reward or an event count differs, or the
+first hashed step, and state group, that does. The agent of the recording runs with its own
+random state, so replaying without it leaves the environment generators untouched.
+
+Traces are compressed .npz files of a few bytes per step, so long reference runs can be kept in
+the repository next to the code they check.
+
+    python -m src.envs.trace -r data/traces/reference.npz -n 8640 -t 300 -x 3
+    python -m src.envs.trace -c data/traces/reference.npz -o backend=numba
+"""
+
+import getopt
+import hashlib
+import json
+import random
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+TRACE_VERSION = 1
+ROOT = Path(__file__).resolve().parents[2]
+
+# Groups of the keys of CitySim.get_state hashed separately, by key prefix
+STATE_GROUPS = {
+    "random": ("np_random_", "py_random_"),
+    "emergencies": ("emergencies_",),
+    "ambulances": ("ambulances_",),
+    "counters": ("current_step", "available_amb", "queued", "total_"),
+    "traffic": ("traffic_",),
+    "kpis": ("kpis_",),
+}
+EVENTS = ("emergencies", "launches", "arrivals")
+
+
+def state_digests(state, previous):
+    """Chained 64-bit hashes of every group of a get_state dict, as a uint64 array."""
+    digests = np.zeros(len(STATE_GROUPS), dtype=np.uint64)
+    for i, prefixes in enumerate(STATE_GROUPS.values()):
+        digest = hashlib.blake2b(previous[i].tobytes(), digest_size=8)
+        for name in sorted(state):
+            if name.startswith(prefixes):
+                value = np.ascontiguousarray(state[name])
+                digest.update(f"{name} {value.dtype.str} {value.shape}".encode())
+                digest.update(value.tobytes())
+        digests[i] = np.frombuffer(digest.digest(), dtype=np.uint64)[0]
+    return digests
+
+
+def _events(env):
+    return (
+        sum(env.total_emergencies.values()),
+        sum(env.total_ambulances.values()),
+        len(env.ambulances),
+    )
+
+
+def _portable(env_kwargs):
+    """Environment arguments as JSON values, paths inside the repository made relative."""
+    portable = {}
+    for name, value in (env_kwargs or {}).items():
+        if isinstance(value, Path) or (isinstance(value, str) and Path(value).is_absolute()):
+            path = Path(value).resolve()
+            value = str(path.relative_to(ROOT)) if ROOT in path.parents else str(path)
+        elif hasattr(value, "isoformat"):
+            value = value.isoformat()
+        portable[name] = value
+    return portable
+
+
+@dataclass
+class GoldenTrace:
+    """Per step digest of a seeded CitySim run.
+
+    Attributes:
+        seed: int, seed of the NumPy and Python generators before reset().
+        every: int, steps between two state hashes.
+        env_kwargs: dict, CitySim arguments of the run, for build_env.
+        actions: np.ndarray (steps, rows, 3) int16, actions of every step.
+        rewards: np.ndarray (steps,) float64.
+        events: np.ndarray (steps, 3) uint16, new emergencies, launches and arrivals of every step.
+        digests: np.ndarray (steps // every, n_groups) uint64, chained state hashes after steps
+            every, 2 * every, ...
+    """
+
+    seed: int
+    every: int
+    env_kwargs: dict
+    actions: np.ndarray
+    rewards: np.ndarray
+    events: np.ndarray
+    digests: np.ndarray
+
+    @property
+    def steps(self):
+        return len(self.rewards)
+
+    def save(self, path):
+        meta = {
+            "version": TRACE_VERSION,
+            "seed": self.seed,
+            "every": self.every,
+            "env_kwargs": self.env_kwargs,
+            "groups": list(STATE_GROUPS),
+        }
+        np.savez_compressed(
+            path,
+            meta=np.array(json.dumps(meta)),
+            actions=self.actions,
+            rewards=self.rewards,
+            events=self.events,
+            digests=self.digests,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            meta = json.loads(str(saved["meta"]))
+            assert meta["version"] == TRACE_VERSION, "Unsupported trace version"
+            assert meta["groups"] == list(STATE_GROUPS), "Trace hashes other state groups"
+            return cls(
+                meta["seed"],
+                meta["every"],
+                meta["env_kwargs"],
+                saved["actions"],
+                saved["rewards"],
+                saved["events"],
+                saved["digests"],
+            )
+
+    def build_env(self, **overrides):
+        """CitySim with the arguments of the recorded run, some of them replaced by overrides."""
+        from datetime import datetime
+
+        from .citysim import CitySim
+
+        env_kwargs = dict(self.env_kwargs, **overrides)
+        for name in ("city_config", "city_geometry", "traffic_default_cols", "traffic_models"):
+            if name in env_kwargs and not Path(env_kwargs[name]).is_absolute():
+                env_kwargs[name] = ROOT / env_kwargs[name]
+        for name in ("time_start", "time_end"):
+            if isinstance(env_kwargs.get(name), str):
+                env_kwargs[name] = datetime.fromisoformat(env_kwargs[name])
+        return CitySim(**env_kwargs)
+
+
+@dataclass
+class Divergence:
+    """First difference between a trace and a replay. For state groups, the difference appeared
+    after step first_step and is seen at step (the next hashed one)."""
+
+    step: int
+    field: str
+    expected: object
+    actual: object
+    first_step: int = None
+
+    def __str__(self):
+        where = f"step {self.step}"
+        if self.first_step is not None and self.first_step < self.step:
+            where = f"steps {self.first_step}-{self.step}"
+        return f"{self.field} diverges at {where}: expected {self.expected}, got {self.actual}"
+
+
+def _run(env, seed, steps, every, act):
+    """Seed, reset and step env, taking the actions of act(step, observation, info). Yields the
+    reward and events of every step and the digests of every hashed step.
+    """
+    env.seed(seed)
+    random.seed(seed)
+    observation, info = env.reset(), {}
+    previous = np.zeros(len(STATE_GROUPS), dtype=np.uint64)
+    before = _events(env)
+    for step in range(steps):
+        action = act(step, observation, info)
+        observation, reward, done, info = env.step(action)
+        after = _events(env)
+        launches = after[1] - before[1]
+        events = (after[0] - before[0], launches, before[2] + launches - after[2])
+        before = after
+        digests = None
+        if (step + 1) % every == 0:
+            digests = previous = state_digests(env.get_state(), previous)
+        yield step, reward, events, digests
+        if done:
+            break
+
+
+def record_trace(env, agent, steps, seed=0, every=60, env_kwargs=None, actions_per_round=None):
+    """Run agent on env for steps steps from seed and return its GoldenTrace.
+
+    The agent draws from its own NumPy and Python random states, seeded from seed, so that the
+    environment sees the same random numbers as in a replay without the agent.
+    """
+    rows = actions_per_round or env.actions_per_round
+    actions = np.zeros((steps, rows, 3), dtype=np.int16)
+    rewards = np.zeros(steps)
+    events = np.zeros((steps, len(EVENTS)), dtype=np.uint16)
+    digests = []
+    agent_random = [np.random.RandomState(seed + 1).get_state(), random.Random(seed + 1).getstate()]
+
+    def act(step, observation, info):
+        env_random = np.random.get_state(), random.getstate()
+        np.random.set_state(agent_random[0])
+        random.setstate(agent_random[1])
+        action = np.asarray(agent(observation, info.get("action_mask")), dtype=np.int64).reshape(-1, 3)[:rows]
+        agent_random[:] = np.random.get_state(), random.getstate()
+        np.random.set_state(env_random[0])
+        random.setstate(env_random[1])
+        assert np.all(np.abs(action) <= np.iinfo(actions.dtype).max), "Action out of the trace range"
+        actions[step, : len(action)] = action  # Padded with no-op rows
+        return actions[step]
+
+    n = 0
+    for step, reward, step_events, step_digests in _run(env, seed, steps, every, act):
+        rewards[step] = reward
+        events[step] = step_events
+        if step_digests is not None:
+            digests.append(step_digests)
+        n = step + 1
+    return GoldenTrace(
+        seed,
+        every,
+        _portable(env_kwargs),
+        actions[:n],
+        rewards[:n],
+        events[:n],
+        np.array(digests, dtype=np.uint64).reshape(-1, len(STATE_GROUPS)),
+    )
+
+
+def replay_trace(trace, env):
+    """Replay the actions of trace on env. Returns the first Divergence, None if the run matches."""
+    groups = list(STATE_GROUPS)
+    hashed = 0
+    run = _run(env, trace.seed, trace.steps, trace.every, lambda step, observation, info: trace.actions[step])
+    for step, reward, events, digests in run:
+        if reward != trace.rewards[step]:
+            return Divergence(step, "reward", float(trace.rewards[step]), float(reward))
+        for name, expected, actual in zip(EVENTS, trace.events[step].tolist(), events):
+            if expected != actual:
+                return Divergence(step, f"events.{name}", expected, actual)
+        if digests is not None:
+            mismatch = np.flatnonzero(digests != trace.digests[hashed])
+            if len(mismatch):
+                i = mismatch[0]
+                first = step + 1 - trace.every
+                return Divergence(step, f"state.{groups[i]}", hex(trace.digests[hashed][i]), hex(digests[i]), first)
+            hashed += 1
+    return None
+
+
+def usage():
+    print("trace.py -r <tracefile> [-n <steps>] [-s <seed>] [-e <every>] [-t <timestep>] [-x <stress>]")
+    print("trace.py -c <tracefile> [-o <option>=<value> ...]")
+    print("-r records a trace of a random agent, -c replays one with some CitySim options replaced")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "hr:c:n:s:e:t:x:o:",
+            ["record=", "check=", "steps=", "seed=", "every=", "timestep=", "stress=", "option="],
+        )
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    import yaml
+
+    from src.agents.test_agents import RandomAgent
+
+    record_file, check_file = None, None
+    steps, seed, every = 8640, 0, 60
+    env_kwargs = {
+        "city_config": ROOT / "data/city_defaults.yaml",
+        "city_geometry": ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp",
+        "traffic_default_cols": ROOT / "data/default_columns.csv",
+        "traffic_models": ROOT / "data/traffic_model.npz",
+        "actions_per_round": 5,
+        "kpis": True,
+    }
+    overrides = {}
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt in ("-r", "--record"):
+            record_file = arg
+        elif opt in ("-c", "--check"):
+            check_file = arg
+        elif opt in ("-n", "--steps"):
+            steps = int(arg)
+        elif opt in ("-s", "--seed"):
+            seed = int(arg)
+        elif opt in ("-e", "--every"):
+            every = int(arg)
+        elif opt in ("-t", "--timestep"):
+            env_kwargs["time_step"] = int(arg)
+        elif opt in ("-x", "--stress"):
+            env_kwargs["stress"] = float(arg)
+        elif opt in ("-o", "--option"):
+            name, _, value = arg.partition("=")
+            overrides[name] = yaml.safe_load(value)
+
+    if record_file is not None:
+        trace = GoldenTrace(seed, every, _portable(env_kwargs), None, None, None, None)
+        env = trace.build_env()
+        agent = RandomAgent(len(env.hospitals) - 1, env.severity_levels, env.actions_per_round)
+        start = time.perf_counter()
+        trace = record_trace(env, agent, steps, seed, every, env_kwargs)
+        trace.save(record_file)
+        print(
+            f"Recorded {trace.steps} steps in {time.perf_counter() - start:.1f} s, "
+            f"{Path(record_file).stat().st_size / trace.steps:.2f} bytes per step"
+        )
+    elif check_file is not None:
+        trace = GoldenTrace.load(check_file)
+        env = trace.build_env(**overrides)
+        start = time.perf_counter()
+        divergence = replay_trace(trace, env)
+        elapsed = time.perf_counter() - start
+        if divergence is None:
+            print(f"{trace.steps} steps match the trace ({elapsed:.1f} s)")
+        else:
+            print(divergence)
+            sys.exit(1)
+    else:
+        usage()
+        sys.exit(2)
@@ -1,70 +1,228 @@
 
-from datetime import datetime, timedelta
+import bisect
 import random
 import os
-import pickle
 
-import pandas as pd
+import numpy as np
+
+from .traffic_model import LinearTrafficModel
+
+
+class TrafficProfile():
+    """Piecewise constant speed of every district over consecutive traffic slots, with the
+    cumulative distance a vehicle covers in each district from the start of the first slot.
+
+    Moving through a district from time t covers distance D(t') - D(t) by time t', so the arrival
+    after a length L is the inverse of D at D(t) + L: one binary search in the cumulative table
+    of the district, whatever the number of slot boundaries the trip crosses. Speeds of the last
+    slot hold after the end of the table.
+
+    Attributes:
+        start: float, clock in seconds at the start of the first slot.
+        slot_seconds: int, length of a slot.
+        speed: np.ndarray (n_districts, n_slots), speeds in km/s.
+        cumulative: np.ndarray (n_districts, n_slots), km covered up to the start of every slot.
+    """
+
+    def __init__(self, start, slot_seconds, speed):
+        self.start = float(start)
+        self.slot_seconds = slot_seconds
+        self.speed = np.asarray(speed, dtype=float)
+        self.cumulative = np.zeros_like(self.speed)
+        np.cumsum(self.speed[:, :-1] * slot_seconds, axis=1, out=self.cumulative[:, 1:])
+        self._rows = list(zip(self.cumulative.tolist(), self.speed.tolist()))
+
+    def _arrival_one(self, cumulative, speed, length, time):
+        """_arrival of a single trip, with the rows of its district as lists."""
+        slot = min(max(int((time - self.start) // self.slot_seconds), 0), len(speed) - 1)
+        target = cumulative[slot] + (time - self.start - slot * self.slot_seconds) * speed[slot] + length
+        slot = max(bisect.bisect_right(cumulative, target) - 1, 0)
+        return self.start + slot * self.slot_seconds + (target - cumulative[slot]) / speed[slot]
+
+    def _travel_time_one(self, departure, column, length):
+        rows = self._rows
+        inside = [c for c in column if c >= 0]
+        if len(inside) < len(column):
+            present = sorted(set(inside)) or slice(None)
+            rows = rows + [(self.cumulative[present].mean(axis=0).tolist(), self.speed[present].mean(axis=0).tolist())]
+        time = departure
+        for c, piece_length in zip(column, length):
+            if piece_length > 0:
+                time = self._arrival_one(*rows[c], piece_length, time)
+        return time - departure
+
+    def _arrival(self, cumulative, speed, searchable, rows, length, time):
+        """Time at which trips starting at time cover length km in their rows of the tables."""
+        n_slots = speed.shape[1]
+        slot = np.clip((time - self.start) // self.slot_seconds, 0, n_slots - 1).astype(np.int64)
+        target = cumulative[rows, slot] + (time - self.start - slot * self.slot_seconds) * speed[rows, slot] + length
+
+        # Last slot starting before the target distance, searched in all rows at once
+        key = np.minimum(target, cumulative[rows, -1]) + searchable[rows * n_slots]
+        slot = np.maximum(np.searchsorted(searchable, key, side="right") - 1 - rows * n_slots, 0)
+        return self.start + slot * self.slot_seconds + (target - cumulative[rows, slot]) / speed[rows, slot]
+
+    def travel_times(self, departure, route, column, length):
+        """Travel times in seconds of many routes.
+
+        Args:
+            departure: array (n_routes,), clock in seconds at the start of every route.
+            route, column, length: arrays (n_pieces,) of the route pieces, grouped by route in
+                increasing route order and in travel order within a route: their route, their
+                district row in the tables (-1 outside the city) and their length in km.
+
+        Pieces outside the city move at the mean speed of the districts of their route, which is
+        what displacement_time does with the mean traffic of the route.
+        """
+        departure = np.asarray(departure, dtype=float)
+        route = np.asarray(route, dtype=np.int64)
+        column = np.asarray(column, dtype=np.int64)
+        length = np.asarray(length, dtype=float)
+        if len(departure) == 1:
+            # Plain Python is faster than array operations on single pieces (row -1 is outside)
+            return np.array([self._travel_time_one(float(departure[0]), column.tolist(), length.tolist())])
+        cumulative, speed = self.cumulative, self.speed
+        n_districts = len(speed)
+
+        outside = column < 0
+        if outside.any():
+            present = np.zeros((len(departure), n_districts))
+            present[route[~outside], column[~outside]] = 1
+            present[present.sum(axis=1) == 0] = 1
+            present /= present.sum(axis=1, keepdims=True)
+            cumulative = np.vstack((cumulative, present @ cumulative))
+            speed = np.vstack((speed, present @ speed))
+            column = np.where(outside, n_districts + route, column)
+
+        # Rows offset to be a single sorted array
+        scale = cumulative[:, -1].max() + 1
+        searchable = (cumulative + scale * np.arange(len(cumulative))[:, None]).ravel()
+
+        # Pieces advance every route in turn, the k-th piece of all routes at once
+        order = np.arange(len(route)) - np.searchsorted(route, route)
+        time = departure.copy()
+        for k in range(int(order.max()) + 1 if len(order) else 0):
+            piece = np.flatnonzero(order == k)
+            trip = route[piece]
+            time[trip] = self._arrival(cumulative, speed, searchable, column[piece], length[piece], time[trip])
+        return time - departure
+
 
 class TrafficManager():
 
-    def __init__(self, start_time, districts, dir_traffic_models, default_df,
+    def __init__(self, districts, traffic_model, default_df=None,
         updates_per_hour: int = 4,
         max_avg_speed: float = 60.0,
         max_load: float = 100.0,
         perc = 0.1,
         ):
 
-        self.update_period = 60 / updates_per_hour
-        self.update_points = {i: int(self.update_period * i) for i in range(updates_per_hour)}
+        self.update_period = 60 // updates_per_hour
 
-        self.last_update = self._normalize_time(start_time)
+        # Traffic slots are counted by the simulation calendar, slot 0 contains the start time
+        self.last_update = 0
         self.districts = districts
-        self.models = self._load_traffic_models(dir_traffic_models)
-        self.default_df = default_df
+        self.model = self._load_traffic_model(traffic_model, default_df)
 
         self.max_avg_speed = max_avg_speed
         self.max_load = max_load
         self.perc = perc
 
-        self.traffic = {district : 0 for district in districts.keys()}
-
-    def _normalize_time(self, time):
-        return time.replace(minute=self.update_points[int(time.minute / self.update_period)])
+        self.traffic = {district : 0 for district in districts}
+        self.profile = None
 
-    def _load_traffic_models(self, dir_traffic_models):
-        models = {}
+        # Forecasts: traffic predicted for every slot of the calendar, noise added when read
+        self.forecast_table = None
+        self.forecast_seed = 0
 
-        for model_file in os.listdir(dir_traffic_models):
-            district = int(model_file.split('_')[-1].split('.')[0])
-            models[district] = pickle.load(open(os.path.join(dir_traffic_models, model_file), 'rb'))
+    def reset(self):
+        """Forget the traffic of the previous episode, back to the state of a new manager."""
+        self.last_update = 0
+        self.traffic = {district : 0 for district in self.districts}
+        self.profile = None
 
-        return models
+    def _load_traffic_model(self, traffic_model, default_df):
+        if os.path.isdir(traffic_model):
+            # Legacy directory with one pickled regressor per district
+            return self._convert_traffic_models(traffic_model, default_df)
+        return LinearTrafficModel.load(traffic_model)
 
-    def _prepare_data(self, time):
-        data = self.default_df[0:0]
+    def _convert_traffic_models(self, dir_traffic_models, default_df):
+        import pickle
 
-        new_row = {'year': time.year,
-                'day_{}'.format(time.day): 1,
-                'month_{}'.format(time.month): 1,
-                'hour-minute_{}'.format(time.strftime('%H:%M')): 1,
-                'weekday_{}'.format(time.weekday()): 1}
+        models = {}
+        for model_file in os.listdir(dir_traffic_models):
+            district = int(model_file.split('_')[-1].split('.')[0])
+            with open(os.path.join(dir_traffic_models, model_file), 'rb') as f:
+                models[district] = pickle.load(f)
 
-        data = data.append(new_row, ignore_index=True).fillna(0).astype(int).iloc[0]
+        return LinearTrafficModel.from_sklearn(models, list(default_df.columns))
 
-        return data
+    def _prepare_data(self, slot_point):
+        return self.model.features(*slot_point)
 
     def _get_speed(self, traffic_load):
         return self.max_avg_speed * (1 - traffic_load / self.max_load)
 
-    def update_traffic(self, time):
-        norm_time = self._normalize_time(time)
-        if norm_time > self.last_update:
-            data = self._prepare_data(norm_time)
-            self.traffic = {district: self.models[district].predict([data])[0] * (1 + random.uniform(-self.perc, self.perc))
+    def update_traffic(self, slot, slot_point):
+        """Predict new traffic when the clock enters a new slot. slot_point is the (year, month,
+        day, weekday, hour, minute) at the start of the slot.
+        """
+        if slot > self.last_update:
+            data = self._prepare_data(slot_point)
+            prediction = dict(zip(self.model.districts.tolist(), self.model.predict(data)))
+            self.traffic = {district: prediction[district] * (1 + random.uniform(-self.perc, self.perc))
                             for district in self.traffic.keys()
                             if district != 'Missing'}
-            self.last_update = norm_time
+            self.last_update = slot
+            self.profile = None
+
+    def build_profile(self, start, slot_seconds, points=None):
+        """Traffic profile from the slot starting at start (clock seconds): the current traffic,
+        then the traffic predicted without noise at the (year, month, day, weekday, hour, minute)
+        arrays of points, the starts of the following slots. Without points the current traffic
+        holds, as in displacement_time.
+        """
+        loads = [[self.traffic[district] for district in self.districts]]
+        if points is not None and len(points[0]):
+            columns = [self.model.districts.tolist().index(district) for district in self.districts]
+            points = [np.asarray(field, dtype=np.int64) for field in points]
+            loads.extend(self.model.predict_calendar(*points)[:, columns])
+        speed = self._get_speed(np.array(loads, dtype=float)).T / 3600
+        # Loads over max_load would stop the traffic for good, keep it crawling
+        self.profile = TrafficProfile(start, slot_seconds, np.maximum(speed, self.max_avg_speed / 3600 * 0.01))
+        return self.profile
+
+    def set_forecast_table(self, points):
+        """Precompute the traffic predicted without noise for slots 0, 1, ... from the (year, month,
+        day, weekday, hour, minute) arrays of points, the starts of the slots.
+        """
+        columns = [self.model.districts.tolist().index(district) for district in self.districts]
+        points = [np.asarray(field, dtype=np.int64) for field in points]
+        self.forecast_table = self.model.predict_calendar(*points)[:, columns]
+
+    def _forecast_noise(self, first_slot, n):
+        """Uniform numbers in [0, 1) for every district of n slots from first_slot, a hash of
+        (forecast_seed, slot, district): the same for a slot whenever it is asked for, without
+        drawing from the random generators of the simulation.
+        """
+        keys = np.arange(first_slot * len(self.districts), (first_slot + n) * len(self.districts), dtype=np.uint64)
+        seed = np.full(1, self.forecast_seed + 1, dtype=np.uint64)  # Arrays wrap around silently
+        z = keys + seed * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)  # splitmix64 finalizer
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+        return ((z >> np.uint64(11)) * 2.0 ** -53).reshape(n, len(self.districts))
+
+    def forecast(self, slot, n):
+        """Traffic of every district (in self.districts order) for the n slots after slot, as an
+        (n, districts) array: the precomputed prediction with a noise of the same range as the
+        updates, fixed for every slot. Realized traffic draws its own noise, so forecasts err as
+        much as perc.
+        """
+        assert slot + n < len(self.forecast_table), "Forecast beyond the forecast table"
+        noise = self._forecast_noise(slot + 1, n)
+        return self.forecast_table[slot + 1 : slot + 1 + n] * (1 + self.perc * (2 * noise - 1))
 
     def displacement_time(self, distance_per_district):
         # If something is outside the limits, it gets assigned average traffic of present districts
@@ -0,0 +1,132 @@
+"""
+Multi-output linear traffic model shared by all the districts of the city.
+
+The model predicts the traffic load of every district from the same calendar features (year and
+one-hot day, month, hour-minute and weekday) with a single coefficient matrix of shape
+features x districts, so one matrix-vector product gives the traffic for the whole city. It is
+stored as a plain .npz file and only needs NumPy at runtime.
+"""
+
+import math
+
+import numpy as np
+
+# One-hot feature groups, by column name prefix. Exactly one column of each group is active.
+ONE_HOT_GROUPS = ("day_", "month_", "hour-minute_", "weekday_")
+
+
+class LinearTrafficModel:
+    """Traffic load = features @ coef + intercept, for all districts at once.
+
+    Attributes:
+        columns: list of str, feature names in the order of the rows of coef.
+        districts: np.ndarray of int, district code of every column of coef.
+        coef: np.ndarray, (n_features, n_districts) coefficient matrix.
+        intercept: np.ndarray, (n_districts,) intercept per district.
+    """
+
+    def __init__(self, columns, districts, coef, intercept):
+        self.columns = list(columns)
+        self.districts = np.asarray(districts, dtype=int)
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        self.year_index = self.column_index["year"]
+        self._row_tables = {}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["columns"].tolist(), data["districts"], data["coef"], data["intercept"])
+
+    def save(self, path):
+        np.savez(
+            path,
+            columns=np.array(self.columns),
+            districts=self.districts,
+            coef=self.coef,
+            intercept=self.intercept,
+        )
+
+    @classmethod
+    def from_sklearn(cls, models, columns):
+        """Build the model from a {district_code: fitted LinearRegression} dict, such as the legacy
+        lr_model_<district>.sav files.
+
+        The one-hot groups are perfectly collinear with the intercept, so the legacy fits carry huge
+        coefficients that cancel each other. Every group is re-centered on its mean and the shift is
+        moved to the intercept, which leaves the predictions unchanged but keeps the matrix product
+        numerically stable.
+        """
+        districts = sorted(models.keys())
+        coef = np.stack([np.asarray(models[d].coef_, dtype=np.float64) for d in districts], axis=1)
+        intercept = [float(models[d].intercept_) for d in districts]
+        return cls.centered(columns, districts, coef, intercept)
+
+    @classmethod
+    def centered(cls, columns, districts, coef, intercept):
+        coef = np.array(coef, dtype=np.float64)
+        shifts = [np.asarray(intercept, dtype=np.float64)]
+        for prefix in ONE_HOT_GROUPS:
+            rows = [i for i, name in enumerate(columns) if name.startswith(prefix)]
+            shift = coef[rows].mean(axis=0)
+            coef[rows] -= shift
+            shifts.append(shift)
+        # Exact summation, the shifts are large and of opposite signs
+        intercept = [math.fsum(values) for values in zip(*shifts)]
+        return cls(columns, districts, coef, intercept)
+
+    def features(self, year, month, day, weekday, hour, minute):
+        """Feature vector for a calendar point. weekday follows datetime.weekday()."""
+        x = np.zeros(len(self.columns))
+        x[self.year_index] = year
+        for name in self._active_columns(month, day, weekday, hour, minute):
+            x[self.column_index[name]] = 1
+        return x
+
+    def predict(self, x):
+        """Traffic of all districts for one (n_features,) or many (n, n_features) feature rows."""
+        return x @ self.coef + self.intercept
+
+    def predict_calendar(self, year, month, day, weekday, hour, minute):
+        """Same as predict(features(...)) for arrays of calendar points, without building the
+        one-hot rows: the product reduces to gathering one coefficient row per group.
+        """
+        year, month, day, weekday, hour, minute = np.broadcast_arrays(
+            year, month, day, weekday, hour, minute
+        )
+        rows = (
+            self._rows("day_", day),
+            self._rows("month_", month),
+            self._rows("hour-minute_", hour * 60 + minute),
+            self._rows("weekday_", weekday),
+        )
+        traffic = self.intercept + year[..., None] * self.coef[self.year_index]
+        for group_rows in rows:
+            traffic = traffic + self.coef[group_rows]
+        return traffic
+
+    def _rows(self, prefix, values):
+        """Coefficient row of the active one-hot column of a group for an array of values."""
+        if prefix not in self._row_tables:
+            table = np.full(24 * 60 if prefix == "hour-minute_" else 32, -1, dtype=int)
+            for name, i in self.column_index.items():
+                if name.startswith(prefix):
+                    key = name[len(prefix) :]
+                    if prefix == "hour-minute_":
+                        table[int(key[:2]) * 60 + int(key[3:])] = i
+                    else:
+                        table[int(key)] = i
+            self._row_tables[prefix] = table
+        rows = self._row_tables[prefix][values]
+        if np.any(rows < 0):
+            raise KeyError(f"Calendar values without a {prefix} feature column")
+        return rows
+
+    def _active_columns(self, month, day, weekday, hour, minute):
+        return (
+            f"day_{day}",
+            f"month_{month}",
+            f"hour-minute_{hour:02d}:{minute:02d}",
+            f"weekday_{weekday}",
+        )
@@ -0,0 +1,286 @@
+"""
+Evolution strategies training of a DispatchPolicy on CitySim.
+
+Every generation samples population perturbation directions of the policy parameters, evaluates
+each one in both signs (antithetic sampling) on a short episode, and moves the parameters towards
+the better ones, weighting them by centered ranks. All the episodes of a generation use the same
+seed, so every pair of evaluations sees the same emergencies and traffic, whatever the worker
+simulated before (see benchmarks/es_rollouts.py).
+
+Directions are offsets into a noise table of standard normal samples. The table is built once
+before the worker pool, which inherits it from the parent process without copying, so the tasks
+only carry the parameters and a few integers, and the results are two returns per direction.
+Workers keep their CitySim between tasks (see sweep.py).
+
+    python -m src.experiments.es_trainer -g 50 -p 64 -t 720 -H 32 -o policy.npz
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import getopt
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from src.agents.dispatch_policy import DispatchPolicy, flatten_observation
+from src.agents.test_agents import RandomAgent
+from src.experiments.sweep import DEFAULT_ENV, ROOT, _get_env
+
+_noise = None  # Noise table, inherited by forked workers or rebuilt from its seed
+_noise_spec = None
+
+
+def noise_table(size, seed):
+    """Table of size standard normal float32 samples, the same for the same seed."""
+    global _noise, _noise_spec
+    if _noise_spec != (size, seed):
+        _noise = np.random.RandomState(seed).standard_normal(size).astype(np.float32)
+        _noise_spec = (size, seed)
+    return _noise
+
+
+def rollout(env, policy, steps, seed):
+    """Total reward and length of an episode of at most steps steps."""
+    env.seed(seed)
+    random.seed(seed)
+    observation, info = env.reset(), {}
+    total_reward = 0.0
+    for step in range(steps):
+        observation, reward, done, info = env.step(policy(observation, info.get("action_mask")))
+        total_reward += reward
+        if done:
+            break
+    return total_reward, step + 1
+
+
+def _evaluate(params, offsets, sigma, steps, seed, spec, normalization, noise_spec, env_kwargs):
+    """Worker entry point: returns of params +- sigma * noise at every offset (params alone if
+    offsets is empty), with the steps simulated and the seconds spent.
+    """
+    start = time.perf_counter()
+    env = _get_env(env_kwargs)
+    noise = noise_table(*noise_spec)
+    policy = DispatchPolicy(*spec)
+    policy.obs_mean, policy.obs_std = normalization
+    returns, total_steps = [], 0
+    if not offsets:
+        policy.set_params(params)
+        reward, n = rollout(env, policy, steps, seed)
+        return [(reward, reward)], n, time.perf_counter() - start
+    for offset in offsets:
+        epsilon = noise[offset : offset + len(params)]
+        pair = []
+        for sign in (1, -1):
+            policy.set_params(params + sign * sigma * epsilon)
+            reward, n = rollout(env, policy, steps, seed)
+            pair.append(reward)
+            total_steps += n
+        returns.append(tuple(pair))
+    return returns, total_steps, time.perf_counter() - start
+
+
+def centered_ranks(values):
+    """Ranks of values scaled to [-0.5, 0.5]."""
+    ranks = np.empty(values.size, dtype=np.float32)
+    ranks[values.ravel().argsort()] = np.arange(values.size)
+    return (ranks / (values.size - 1) - 0.5).reshape(values.shape)
+
+
+class ESTrainer:
+    """Antithetic evolution strategies with Adam updates.
+
+    Attributes:
+        policy: DispatchPolicy being trained.
+        population: int, perturbation directions per generation, two episodes each.
+        sigma: float, standard deviation of the perturbations.
+        learning_rate: float, Adam step size.
+        weight_decay: float, L2 penalty on the parameters.
+        steps: int, steps of every evaluation episode.
+        workers: int, evaluation processes, one means evaluating in this process.
+        history: list of dicts, one per generation, with the return of the current parameters and
+            the env-steps per second, overall and per core.
+    """
+
+    def __init__(
+        self,
+        hidden: int = 0,
+        population: int = 64,
+        sigma: float = 0.05,
+        learning_rate: float = 0.02,
+        weight_decay: float = 0.005,
+        steps: int = 720,
+        n_actions: int = 5,
+        noise_size: int = 10_000_000,
+        workers=None,
+        env_kwargs=None,
+        seed: int = 0,
+    ):
+        self.env_kwargs = dict(DEFAULT_ENV, kpis=False)  # Rollouts only need the rewards
+        self.env_kwargs.update(env_kwargs or {})
+        self.env = _get_env(self.env_kwargs)
+        self.population = population
+        self.sigma = sigma
+        self.learning_rate = learning_rate
+        self.weight_decay = weight_decay
+        self.steps = steps
+        self.workers = workers or os.cpu_count()
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+        observation = self.env.reset()
+        self.spec = (
+            len(self.env.hospitals) - 1,
+            self.env.severity_levels,
+            n_actions,
+            len(flatten_observation(observation)),
+            hidden,
+            seed,
+        )
+        self.policy = DispatchPolicy(*self.spec)
+        self.policy.fit_normalization(self._random_observations())
+        assert noise_size > self.policy.n_params, "Noise table smaller than the policy"
+        self.noise_spec = (noise_size, seed)
+        noise_table(*self.noise_spec)  # Built before the pool so that workers inherit it
+
+        self.params = self.policy.params.copy()
+        self._adam_m = np.zeros_like(self.params)
+        self._adam_v = np.zeros_like(self.params)
+        self._adam_t = 0
+        self.history = []
+
+    def _random_observations(self):
+        """Observations of a random agent episode, to standardize the policy inputs."""
+        env = self.env
+        env.seed(self.seed)
+        agent = RandomAgent(len(env.hospitals) - 1, env.severity_levels, self.spec[2])
+        observation, info = env.reset(), {}
+        observations = [observation]
+        for _ in range(self.steps):
+            observation, _, done, info = env.step(agent(observation, info.get("action_mask")))
+            observations.append(observation)
+            if done:
+                break
+        return observations
+
+    def _adam(self, gradient, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self._adam_t += 1
+        self._adam_m = beta1 * self._adam_m + (1 - beta1) * gradient
+        self._adam_v = beta2 * self._adam_v + (1 - beta2) * gradient * gradient
+        step = self.learning_rate * math.sqrt(1 - beta2 ** self._adam_t) / (1 - beta1 ** self._adam_t)
+        return step * self._adam_m / (np.sqrt(self._adam_v) + epsilon)
+
+    def _tasks(self, offsets, episode_seed):
+        """Worker tasks: the unperturbed parameters, then the directions in two chunks per worker."""
+        common = (self.sigma, self.steps, episode_seed, self.spec, (self.policy.obs_mean, self.policy.obs_std))
+        chunks = np.array_split(offsets, min(len(offsets), 2 * self.workers))
+        tasks = [(self.params, [])] + [(self.params, chunk.tolist()) for chunk in chunks]
+        return [task + common + (self.noise_spec, self.env_kwargs) for task in tasks]
+
+    def generation(self, executor, index):
+        noise = noise_table(*self.noise_spec)
+        offsets = self.rng.randint(0, len(noise) - len(self.params) + 1, size=self.population)
+        episode_seed = self.seed * 100_003 + index
+
+        start = time.perf_counter()
+        tasks = self._tasks(offsets, episode_seed)
+        if executor is None:
+            results = [_evaluate(*task) for task in tasks]
+        else:
+            results = list(executor.map(_evaluate, *zip(*tasks)))
+        elapsed = time.perf_counter() - start
+
+        current = results[0][0][0][0]
+        returns = np.array([pair for result in results[1:] for pair in result[0]])
+        steps = sum(result[1] for result in results)
+        busy = sum(result[2] for result in results)
+
+        # Gradient estimate from the rank weighted antithetic differences
+        ranks = centered_ranks(returns)
+        weights = ranks[:, 0] - ranks[:, 1]
+        gradient = np.zeros_like(self.params)
+        for weight, offset in zip(weights, offsets):
+            gradient += weight * noise[offset : offset + len(self.params)]
+        gradient /= 2 * len(offsets) * self.sigma
+        self.params = self.params + self._adam(gradient - self.weight_decay * self.params)
+        self.policy.set_params(self.params)
+
+        record = {
+            "generation": index,
+            "return": float(current),
+            "mean_perturbed": float(returns.mean()),
+            "max_perturbed": float(returns.max()),
+            "env_steps": int(steps),
+            "seconds": elapsed,
+            "steps_per_second": steps / elapsed,
+            "steps_per_second_per_core": steps / busy,
+        }
+        self.history.append(record)
+        return record
+
+    def run(self, generations: int = 50, verbose: bool = True):
+        """Train for a number of generations and return the policy."""
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            for index in range(generations):
+                record = self.generation(executor, index)
+                if verbose:
+                    print(
+                        f"Generation {index}: return {record['return']:.0f}, "
+                        f"perturbed mean {record['mean_perturbed']:.0f} max {record['max_perturbed']:.0f}, "
+                        f"{record['steps_per_second']:.0f} env-steps/s "
+                        f"({record['steps_per_second_per_core']:.0f} per core)"
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.policy
+
+
+def usage():
+    print("es_trainer.py [-g <generations>] [-p <population>] [-s <sigma>] [-l <learningrate>]")
+    print("              [-t <steps>] [-H <hidden>] [-w <workers>] [-o <outputfile>]")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "hg:p:s:l:t:H:w:o:",
+            ["generations=", "population=", "sigma=", "learning-rate=", "steps=", "hidden=", "workers=", "output="],
+        )
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    options = {}
+    generations = 50
+    output_file = ROOT / "data" / "dispatch_policy.npz"
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt in ("-g", "--generations"):
+            generations = int(arg)
+        elif opt in ("-p", "--population"):
+            options["population"] = int(arg)
+        elif opt in ("-s", "--sigma"):
+            options["sigma"] = float(arg)
+        elif opt in ("-l", "--learning-rate"):
+            options["learning_rate"] = float(arg)
+        elif opt in ("-t", "--steps"):
+            options["steps"] = int(arg)
+        elif opt in ("-H", "--hidden"):
+            options["hidden"] = int(arg)
+        elif opt in ("-w", "--workers"):
+            options["workers"] = int(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+
+    trainer = ESTrainer(**options)
+    print(f"Policy with {trainer.policy.n_params} parameters, {trainer.workers} workers")
+    policy = trainer.run(generations)
+    policy.save(output_file)
+    print(f"Saved to {output_file}")
@@ -0,0 +1,232 @@
+"""
+Simulation-based optimization of the number of ambulances of every hospital.
+
+merge_hospitals.assign_ambulances splits the fleet in proportion to historical calls. This module
+searches the allocation instead, with the cross-entropy method: allocations are sampled from a
+multinomial distribution over hospitals, simulated with short CitySim episodes, and the
+distribution moves towards the best ones.
+
+Evaluations are batched in a process pool (see sweep.py). All the candidates of an iteration are
+simulated with the same seeds, so that their emergencies and traffic are identical (common random
+numbers) and only the allocation changes between them, whatever the worker simulated before
+(see benchmarks/fleet_repeatability.py). Seeds are added by successive halving: every candidate gets
+one seed, the better half a second one, and so on, so poor candidates are dropped after a single
+short episode.
+
+    python -m src.experiments.fleet_optimizer -f 90 -i 8 -p 16 -n 4 -o hospitals.yaml
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import getopt
+import math
+import os
+import sys
+
+import numpy as np
+import yaml
+
+from src.experiments.sweep import DEFAULT_ENV, ROOT, _get_env, allocate, simulate
+
+
+def _evaluate(ambulances, seed, steps, stress, agent, env_kwargs):
+    """Worker entry point: total reward of one allocation and seed."""
+    env = _get_env(env_kwargs)
+    return simulate(env, steps, seed, agent, [0] + list(ambulances), stress)["reward"]
+
+
+class FleetOptimizer:
+    """Cross-entropy search of the per hospital ambulance counts for a fixed fleet total.
+
+    Attributes:
+        fleet: int, total number of ambulances.
+        seeds: list of int, episode seeds, shared by all the candidates.
+        steps: int, steps of every evaluation episode.
+        stress: float, emergency stress of the evaluation episodes.
+        population: int, candidates sampled per iteration.
+        elite: int, best candidates the distribution is fitted to.
+        smoothing: float, weight of the previous distribution in every update.
+        probabilities: np.ndarray, current multinomial distribution over hospitals 1..n.
+        best, best_reward: best allocation found so far and its mean reward over all the seeds.
+        history: list of dicts, one per iteration.
+    """
+
+    def __init__(
+        self,
+        fleet=None,
+        seeds=(0, 1, 2, 3),
+        steps: int = 1440,
+        stress: float = 1.0,
+        population: int = 16,
+        elite: int = 4,
+        smoothing: float = 0.5,
+        agent: str = "greedy",
+        workers=None,
+        env_kwargs=None,
+        rng_seed: int = 0,
+    ):
+        self.env_kwargs = dict(DEFAULT_ENV, **(env_kwargs or {}))
+        self.env = _get_env(self.env_kwargs)
+        configured = np.array(self.env.config_ambulances[1:])
+        self.fleet = int(configured.sum()) if fleet is None else int(fleet)
+        self.seeds = list(seeds)
+        self.steps = steps
+        self.stress = stress
+        self.population = population
+        self.elite = elite
+        self.smoothing = smoothing
+        self.agent = agent
+        self.workers = workers or os.cpu_count()
+        self.rng = np.random.RandomState(rng_seed)
+
+        # Start from the configured allocation, the one of merge_hospitals
+        self.initial = allocate(configured, self.fleet)
+        self.probabilities = (configured + 0.5) / (configured + 0.5).sum()
+        self.best = self.initial
+        self.best_reward = -np.inf
+        self.history = []
+        self._cache = {}
+
+    def _evaluate_batch(self, executor, jobs):
+        """Rewards of (allocation, seed) pairs, simulating only the pairs not seen yet."""
+        pending = [job for job in dict.fromkeys(jobs) if job not in self._cache]
+        arguments = [(a, s, self.steps, self.stress, self.agent, self.env_kwargs) for a, s in pending]
+        if executor is None:
+            rewards = [_evaluate(*args) for args in arguments]
+        else:
+            chunksize = max(1, math.ceil(len(arguments) / (4 * self.workers)))
+            rewards = executor.map(_evaluate, *zip(*arguments), chunksize=chunksize) if arguments else []
+        self._cache.update(zip(pending, rewards))
+        return [self._cache[job] for job in jobs]
+
+    def _race(self, executor, candidates):
+        """Successive halving over the seeds. Returns the candidates still alive after the last
+        seed with their mean rewards, best first.
+        """
+        alive = list(candidates)
+        n_seeds = 1
+        while True:
+            seeds = self.seeds[:n_seeds]
+            jobs = [(c, s) for c in alive for s in seeds]
+            rewards = np.array(self._evaluate_batch(executor, jobs)).reshape(len(alive), len(seeds))
+            means = rewards.mean(axis=1)
+            order = np.argsort(-means)
+            if n_seeds == len(self.seeds):
+                return [alive[i] for i in order], means[order]
+            keep = max(self.elite, math.ceil(len(alive) / 2))
+            alive = [alive[i] for i in order[:keep]]
+            n_seeds = min(2 * n_seeds, len(self.seeds))
+
+    def _sample(self):
+        candidates = {tuple(self.best.tolist()), tuple(self.initial.tolist())}
+        while len(candidates) < self.population:
+            candidates.add(tuple(self.rng.multinomial(self.fleet, self.probabilities).tolist()))
+        return list(candidates)
+
+    def run(self, iterations: int = 8, verbose: bool = True):
+        """Optimize for a number of iterations and return the best allocation (hospitals 1..n)."""
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            for iteration in range(iterations):
+                ranked, means = self._race(executor, self._sample())
+                if means[0] > self.best_reward:
+                    self.best, self.best_reward = np.array(ranked[0]), float(means[0])
+
+                elite = np.array(ranked[: self.elite], dtype=float)
+                self.probabilities = self.smoothing * self.probabilities + (1 - self.smoothing) * (
+                    elite.mean(axis=0) / self.fleet
+                )
+                self.history.append(
+                    {
+                        "iteration": iteration,
+                        "best_reward": self.best_reward,
+                        "elite_reward": float(means[: self.elite].mean()),
+                        "evaluations": len(self._cache),
+                    }
+                )
+                if verbose:
+                    print(
+                        f"Iteration {iteration}: best {self.best_reward:.0f}, "
+                        f"elite {self.history[-1]['elite_reward']:.0f}, {len(self._cache)} episodes"
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.best
+
+    def initial_reward(self):
+        """Mean reward of the configured allocation over all the seeds."""
+        jobs = [(tuple(self.initial.tolist()), s) for s in self.seeds]
+        return float(np.mean(self._evaluate_batch(None, jobs)))
+
+
+def hospitals_yaml(config_hospitals, ambulances, yaml_path):
+    """Write a hospitals YAML in the format of merge_hospitals.py with the given ambulances for
+    hospitals 1..n.
+    """
+    hospitals = [
+        {0: {"available_amb": 0, "name": "NaN", "loc": {"district_code": 0, "x": 0.0, "y": 0.0}}}
+    ]
+    for hospital_id, count in zip(sorted(config_hospitals)[1:], ambulances):
+        hospital = config_hospitals[hospital_id]
+        loc = hospital["loc"]
+        hospitals.append(
+            {
+                hospital_id: {
+                    "available_amb": int(count),
+                    "name": hospital["name"],
+                    "loc": {"district_code": int(loc["district_code"]), "x": loc["x"], "y": loc["y"]},
+                }
+            }
+        )
+    with open(yaml_path, "w+", encoding="utf8") as yaml_file:
+        yaml.dump(hospitals, yaml_file, allow_unicode=True)
+
+
+def usage():
+    print("fleet_optimizer.py [-f <fleet>] [-i <iterations>] [-p <population>] [-e <elite>]")
+    print("                   [-n <seeds>] [-t <steps>] [-s <stress>] [-w <workers>] [-o <outputfile>]")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "hf:i:p:e:n:t:s:w:o:",
+            ["fleet=", "iterations=", "population=", "elite=", "seeds=", "steps=", "stress=", "workers=", "output="],
+        )
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    options = {}
+    iterations = 8
+    output_file = ROOT / "Dataset Cleaning and Exploration" / "Processed Datasets" / "hospitals_optimized.yaml"
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt in ("-f", "--fleet"):
+            options["fleet"] = int(arg)
+        elif opt in ("-i", "--iterations"):
+            iterations = int(arg)
+        elif opt in ("-p", "--population"):
+            options["population"] = int(arg)
+        elif opt in ("-e", "--elite"):
+            options["elite"] = int(arg)
+        elif opt in ("-n", "--seeds"):
+            options["seeds"] = range(int(arg))
+        elif opt in ("-t", "--steps"):
+            options["steps"] = int(arg)
+        elif opt in ("-s", "--stress"):
+            options["stress"] = float(arg)
+        elif opt in ("-w", "--workers"):
+            options["workers"] = int(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+
+    optimizer = FleetOptimizer(**options)
+    print(f"Configured allocation: {optimizer.initial_reward():.0f}")
+    best = optimizer.run(iterations)
+    print("Best allocation:", best.tolist())
+    hospitals_yaml(optimizer.env.config["hospitals"], best, output_file)
+    print(f"Saved to {output_file}")
@@ -0,0 +1,308 @@
+"""
+Parallel parameter sweeps over CitySim stress, fleet size and ambulance allocation.
+
+Every configuration of a grid is simulated with several seeds in a process pool. Each worker
+builds its CitySim once and reconfigures it between runs (set_stress, set_fleet), results are
+summarized from the environment KPIs and cached as one JSON file per run, keyed by a hash of the
+run parameters, the content of the data files and the simulator code, so that rerunning or
+extending a sweep only simulates the new runs, and retrained models or code changes rerun them all.
+
+    python -m src.experiments.sweep -s 1,2,4 -f 60,90,120 -a config,demand -n 4 -o sweep.csv
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import getopt
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[2]
+
+DEFAULT_ENV = {
+    "city_config": str(ROOT / "data/city_defaults.yaml"),
+    "city_geometry": str(ROOT / "data/madrid_districts_processed/madrid_districts_processed.shp"),
+    "traffic_default_cols": str(ROOT / "data/default_columns.csv"),
+    "traffic_models": str(ROOT / "data/traffic_model.npz"),
+    "time_start": "2020-01-01T00:00:00",
+    "time_step": 60,
+    "kpis": True,
+}
+
+ALLOCATIONS = ("config", "demand", "uniform")
+
+CACHE_VERSION = 1
+# Sources of the simulation, their content is part of the cache keys
+CODE = ("src/envs", "src/agents", "src/experiments/sweep.py")
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+_env = None  # CitySim of the worker process, built on first use
+_env_key = None
+
+
+def allocate(weights, total):
+    """Split total ambulances proportionally to weights, rounding by largest remainder so that
+    the counts always add up to total.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if weights.sum() == 0:
+        weights = np.ones(len(weights))
+    exact = weights / weights.sum() * total
+    counts = np.floor(exact).astype(int)
+    counts[np.argsort(counts - exact)[: total - counts.sum()]] += 1
+    return counts
+
+
+def district_demand(env):
+    """Expected emergencies per second of every district (index 0 unused) under the marginal
+    severity distributions of the city configuration.
+    """
+    demand = np.zeros(int(env.geometry.codes.max()) + 1)
+    for severity in range(1, env.severity_levels + 1):
+        dist = env.severity_dists[severity]
+        probs = dist["district_prob"]
+        total = sum(probs.values())
+        for district, weight in probs.items():
+            demand[district] += dist["frequency"] * weight / total
+    return demand
+
+
+def demand_weights(env):
+    """Demand served by every hospital (hospital 0 excluded) when every district is served by the
+    hospital closest to its centroid.
+    """
+    demand = district_demand(env)
+    weights = np.zeros(env.n_hospitals)
+    for district, polygon in env.geo_dict.items():
+        centroid = polygon.centroid
+        distance = np.hypot(env.hospital_x[1:] - centroid.x, env.hospital_y[1:] - centroid.y)
+        weights[np.argmin(distance)] += demand[district]
+    return weights
+
+
+def fleet_vector(env, fleet=None, allocation="config"):
+    """Ambulances per hospital, hospital 0 included, for a fleet total and an allocation rule:
+    "config" scales the counts of the city configuration (proportional to historical calls, see
+    merge_hospitals.assign_ambulances), "demand" splits the fleet by the expected emergencies of
+    the districts closest to every hospital, and "uniform" gives every hospital the same share.
+    fleet None keeps the configured total.
+    """
+    configured = np.array(env.config_ambulances[1:])
+    total = int(configured.sum()) if fleet is None else int(fleet)
+    if allocation == "config":
+        counts = configured if fleet is None else allocate(configured, total)
+    elif allocation == "demand":
+        counts = allocate(demand_weights(env), total)
+    elif allocation == "uniform":
+        counts = allocate(np.ones(len(configured)), total)
+    else:
+        raise ValueError(f"Unknown allocation rule {allocation}, expected one of {ALLOCATIONS}")
+    return [0] + [int(n) for n in counts]
+
+
+def run_key(run):
+    """Hash of the parameters of a run, used as its cache file name."""
+    return hashlib.sha1(json.dumps(run, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def inputs_digest(env_kwargs):
+    """Hash of what runs depend on besides their parameters: the content of the files of
+    env_kwargs (every part of a shapefile), of the simulator code and CACHE_VERSION.
+    """
+    files = []
+    for name, value in sorted(env_kwargs.items()):
+        if isinstance(value, (str, Path)) and Path(value).is_file():
+            path = Path(value)
+            parts = [path.with_suffix(suffix) for suffix in SHAPEFILE_PARTS] if path.suffix == ".shp" else [path]
+            files += [part for part in parts if part.is_file()]
+    for source in CODE:
+        source = ROOT / source
+        files += sorted(source.rglob("*.py")) if source.is_dir() else [source]
+
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    for path in files:
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _get_env(env_kwargs):
+    """CitySim of this process for env_kwargs, reused between runs."""
+    global _env, _env_key
+    key = json.dumps(env_kwargs, sort_keys=True, default=str)
+    if _env is None or _env_key != key:
+        from src.envs.citysim import CitySim
+
+        kwargs = dict(env_kwargs)
+        kwargs["time_start"] = datetime.fromisoformat(kwargs["time_start"])
+        kwargs.setdefault("time_end", kwargs["time_start"] + timedelta(days=365))
+        _env = CitySim(**kwargs)
+        _env_key = key
+    return _env
+
+
+def simulate(env, steps, seed, agent="greedy", ambulances=None, stress=1.0):
+    """Run one episode of steps on env with the given seed and return its KPI summary.
+    ambulances, if given, is the number of ambulances of every hospital (see fleet_vector).
+    """
+    from src.agents.test_agents import NaiveGreedyAgent, RandomAgent
+
+    if ambulances is not None:
+        env.set_fleet(ambulances)
+    env.set_stress(stress)
+    env.seed(seed)
+    random.seed(seed)
+    agent_class = NaiveGreedyAgent if agent == "greedy" else RandomAgent
+    policy = agent_class(
+        n_hospitals=len(env.hospitals) - 1, n_severity_levels=env.severity_levels, n_actions=5
+    )
+
+    observation = env.reset()
+    total_reward = 0.0
+    for _ in range(steps):
+        observation, reward, done, _ = env.step(policy(observation))
+        total_reward += reward
+        if done:
+            break
+    return summarize_kpis(env, total_reward)
+
+
+def summarize_kpis(env, total_reward):
+    """Scalar KPIs of the episode that env just ran."""
+    kpis = env.kpis.export()
+    counts = kpis["wait_hist"][1:].sum(axis=2)
+    dispatched = int(counts.sum())
+    return {
+        "reward": float(total_reward),
+        "emergencies": int(sum(env.total_emergencies.values())),
+        "dispatched": dispatched,
+        "mean_wait": float(np.nansum(kpis["wait_mean"][1:] * counts) / max(dispatched, 1)),
+        "mean_arrival": float(np.nansum(kpis["arrival_mean"][1:] * counts) / max(dispatched, 1)),
+        "p50_arrival": env.kpis.quantile(0.5),
+        "p90_arrival": env.kpis.quantile(0.9),
+        "max_queue": int(kpis["queue_lengths"][:, 1:].sum(axis=1).max(initial=0)),
+        "utilization": float(kpis["utilization"][1:].mean()),
+    }
+
+
+def _execute(run, env_kwargs, cache_dir, inputs=None):
+    """Worker entry point: run a sweep point unless it is already cached. inputs is the
+    inputs_digest of env_kwargs, part of the cache key."""
+    key = run_key(dict(run, env=env_kwargs, inputs=inputs))
+    cache_file = Path(cache_dir) / f"{key}.json" if cache_dir else None
+    if cache_file is not None and cache_file.exists():
+        with cache_file.open() as f:
+            return json.load(f)
+
+    env = _get_env(env_kwargs)
+    ambulances = fleet_vector(env, run["fleet"], run["allocation"])
+    result = dict(run, **simulate(env, run["steps"], run["seed"], run["agent"], ambulances, run["stress"]))
+
+    if cache_file is not None:
+        temporary = cache_file.with_suffix(".tmp")
+        with temporary.open("w") as f:
+            json.dump(result, f)
+        temporary.replace(cache_file)
+    return result
+
+
+def sweep_grid(stress=(1.0,), fleet=(None,), allocation=("config",), seeds=1, steps=1440, agent="greedy"):
+    """List of runs, one per configuration of the grid and seed."""
+    return [
+        {"stress": s, "fleet": f, "allocation": a, "seed": seed, "steps": steps, "agent": agent}
+        for s, f, a, seed in itertools.product(stress, fleet, allocation, range(seeds))
+    ]
+
+
+def run_sweep(runs, workers=None, cache_dir=None, env_kwargs=None):
+    """Simulate every run in a process pool and return one result row per run."""
+    env_kwargs = dict(DEFAULT_ENV, **(env_kwargs or {}))
+    inputs = None
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        inputs = inputs_digest(env_kwargs)
+    if workers == 1:
+        results = [_execute(run, env_kwargs, cache_dir, inputs) for run in runs]
+    else:
+        # Runs of the same configuration go to the same chunk, so workers reuse their env
+        workers = workers or os.cpu_count()
+        chunksize = max(1, math.ceil(len(runs) / (4 * workers)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    _execute,
+                    runs,
+                    itertools.repeat(env_kwargs),
+                    itertools.repeat(cache_dir),
+                    itertools.repeat(inputs),
+                    chunksize=chunksize,
+                )
+            )
+    return pd.DataFrame(results)
+
+
+def aggregate(results):
+    """Mean and standard deviation over seeds of every KPI, one row per configuration."""
+    keys = ["stress", "fleet", "allocation", "steps", "agent"]
+    results = results.assign(fleet=results["fleet"].fillna(-1))
+    metrics = [c for c in results.columns if c not in keys + ["seed"]]
+    table = results.groupby(keys)[metrics].agg(["mean", "std"])
+    table.columns = [f"{metric}_{stat}" for metric, stat in table.columns]
+    return table.reset_index()
+
+
+def usage():
+    print("sweep.py [-s <stress,...>] [-f <fleet,...>] [-a <allocation,...>] [-n <seeds>]")
+    print("         [-t <steps>] [-w <workers>] [-c <cachedir>] [-o <outputfile>] [-r]")
+    print(f"allocation rules: {', '.join(ALLOCATIONS)}, -r uses the random agent")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "hs:f:a:n:t:w:c:o:r",
+            ["stress=", "fleet=", "allocation=", "seeds=", "steps=", "workers=", "cache=", "output=", "random"],
+        )
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    grid = {"stress": (1.0,), "fleet": (None,), "allocation": ("config",), "seeds": 1, "steps": 1440}
+    workers, cache_dir, output_file, agent = None, ROOT / ".sweep_cache", None, "greedy"
+    for opt, arg in opts:
+        if opt == "-h":
+            usage()
+            sys.exit()
+        elif opt in ("-s", "--stress"):
+            grid["stress"] = [float(v) for v in arg.split(",")]
+        elif opt in ("-f", "--fleet"):
+            grid["fleet"] = [int(v) for v in arg.split(",")]
+        elif opt in ("-a", "--allocation"):
+            grid["allocation"] = arg.split(",")
+        elif opt in ("-n", "--seeds"):
+            grid["seeds"] = int(arg)
+        elif opt in ("-t", "--steps"):
+            grid["steps"] = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-c", "--cache"):
+            cache_dir = arg
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-r", "--random"):
+            agent = "random"
+
+    results = run_sweep(sweep_grid(agent=agent, **grid), workers, cache_dir)
+    table = aggregate(results)
+    print(table.to_string())
+    if output_file is not None:
+        table.to_csv(output_file, index=False)
@@ -0,0 +1,314 @@
+"""
+Shared memory trajectory buffer for CitySim experience collection.
+
+A transition is one fixed size record (TransitionLayout): only what changes between steps is
+stored, in the smallest type its range allows. Hospital positions, traffic district codes and the
+districts table are the same in every observation and are kept once in the layout; ambulance
+counts are int16, emergency positions int16 metres, traffic loads and forecasts float16. The next
+observation of a transition is the observation of the following record of the same producer.
+
+TrajectoryBuffer keeps one ring of records per producer in a multiprocessing.shared_memory block,
+or in a memory mapped file, with a header of write counters. Every producer is the only writer of
+its ring and of its counter, which it increments after writing a record, so producers and
+consumers never lock: a consumer reads the counters, copies the records and checks the counters
+again to drop the records overwritten while it copied them.
+
+    layout = TransitionLayout.from_env(env)
+    buffer = TrajectoryBuffer(layout, capacity=1_000_000, producers=4)
+    # in producer process i (the buffer pickles by name):
+    writer = buffer.producer(i)
+    writer.add(observation, action, reward, done, info)
+    # in the consumer:
+    batch = buffer.sample(256)
+    sequences = buffer.sequences(32, 50)
+"""
+
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+
+NAN_METRES = np.iinfo(np.int16).min  # Emergency coordinates unknown (replayed records)
+
+
+class TransitionLayout():
+    """Record dtype of a CitySim transition, and its conversions from and to observations.
+
+    Attributes:
+        dtype: np.dtype, structured record of one transition.
+        hospitals_static: np.ndarray (n_hospitals + 1, 4), id, x, y and district of the hospitals.
+        traffic_districts: np.ndarray, codes of the traffic districts, in observation order.
+        traffic_forecast: int, slots of the traffic forecast table of the observations, 0 if none.
+        coverage_thresholds: int, thresholds of the coverage table of the observations, 0 if none.
+        zone_codes: np.ndarray, codes of the zones of the coverage table.
+        districts_table: np.ndarray or None, the static districts table of the observations.
+    """
+
+    def __init__(
+        self,
+        hospitals_static,
+        severity_levels,
+        shown_emergencies,
+        traffic_districts,
+        actions_per_round,
+        max_zone_code,
+        districts_table=None,
+        traffic_forecast=0,
+        coverage_thresholds=0,
+        zone_codes=(),
+    ):
+        self.hospitals_static = np.asarray(hospitals_static, dtype=float)
+        self.severity_levels = severity_levels
+        self.shown_emergencies = shown_emergencies
+        self.traffic_districts = np.asarray(traffic_districts, dtype=float)
+        self.actions_per_round = actions_per_round
+        self.districts_table = districts_table
+        self.traffic_forecast = traffic_forecast
+        self.coverage_thresholds = coverage_thresholds
+        self.zone_codes = np.asarray(zone_codes, dtype=float)
+        n_hospitals = len(self.hospitals_static)
+        shown = (severity_levels, shown_emergencies)
+        self.dtype = np.dtype(
+            [
+                ("step", np.int32),
+                ("reward", np.float32),
+                ("done", np.bool_),
+                ("ambulances", np.int16, (n_hospitals, 2)),  # available, incoming
+                ("time", np.int16, (6,)),
+                ("traffic", np.float16, (len(self.traffic_districts),)),
+                ("forecast", np.float16, (len(self.traffic_districts), traffic_forecast)),
+                ("coverage", np.float16, (len(self.zone_codes), coverage_thresholds)),  # Thousands
+                ("queued", np.int16, (severity_levels,)),  # Shown emergencies per severity
+                ("waited", np.int16, shown),
+                ("location", np.int16, shown + (2,)),  # x, y in metres
+                ("district", np.uint8 if max_zone_code < 256 else np.int16, shown),
+                ("severity_mask", np.bool_, (severity_levels + 1,)),
+                ("hospital_mask", np.bool_, (n_hospitals,)),
+                ("action", np.int16, (actions_per_round, 3)),
+            ]
+        )
+
+    @classmethod
+    def from_env(cls, env):
+        return cls(
+            np.column_stack((np.arange(env.n_hospitals + 1), env.hospital_x, env.hospital_y, env.hospital_district)),
+            env.severity_levels,
+            env.shown_emergencies_per_severity,
+            env.traffic_districts,
+            env.actions_per_round,
+            int(env.geometry.codes.max()),
+            env.districts_table,
+            env.traffic_forecast,
+            len(env.coverage_minutes),
+            env.geometry.codes,
+        )
+
+    def encode(self, record, observation, action, reward, done, info=None, step=0):
+        """Write a transition into a record (a one element slice of a record array), step being
+        its position in the episode.
+        """
+        hospitals, emergencies, time_data, traffic = observation[:4]
+        record["step"] = step
+        record["reward"] = reward
+        record["done"] = done
+        record["ambulances"] = hospitals[:, 4:6]
+        record["time"] = time_data
+        record["traffic"] = traffic[:, 1]
+        if self.traffic_forecast:
+            record["forecast"] = observation[4][:, 1:]
+        if self.coverage_thresholds:
+            record["coverage"] = observation[4 + bool(self.traffic_forecast)][:, 1:]
+        record["queued"] = np.count_nonzero(emergencies[:, :, 0], axis=1)
+        record["waited"] = np.minimum(emergencies[:, :, 1], np.iinfo(np.int16).max)
+        metres = np.round(emergencies[:, :, 2:4] * 1000)
+        record["location"] = np.where(np.isnan(metres), NAN_METRES, np.clip(metres, NAN_METRES + 1, -NAN_METRES))
+        record["district"] = emergencies[:, :, 4]
+        mask = (info or {}).get("action_mask", {})
+        record["severity_mask"] = mask.get("severity", True)
+        record["hospital_mask"] = mask.get("hospital", True)
+        rows = np.asarray(action, dtype=np.int64).reshape(-1, 3)[: self.actions_per_round]
+        padded = np.zeros((self.actions_per_round, 3), dtype=np.int16)  # Start hospital 0 is a no-op
+        padded[: len(rows)] = rows
+        record["action"] = padded
+
+    def decode(self, records):
+        """Observation tables of a record array, each with the record dimensions first."""
+        batch = records.shape
+        hospitals = np.empty(batch + self.hospitals_static.shape[:1] + (6,))
+        hospitals[..., :4] = self.hospitals_static
+        hospitals[..., 4:] = records["ambulances"]
+
+        emergencies = np.zeros(batch + (self.severity_levels, self.shown_emergencies, 5))
+        filled = np.arange(self.shown_emergencies) < records["queued"][..., None]
+        emergencies[..., 0] = np.where(filled, np.arange(1, self.severity_levels + 1)[:, None], 0)
+        emergencies[..., 1] = records["waited"]
+        location = records["location"]
+        emergencies[..., 2:4] = np.where(location == NAN_METRES, np.nan, location / 1000)
+        emergencies[..., 4] = records["district"]
+
+        traffic = np.empty(batch + (len(self.traffic_districts), 2))
+        traffic[..., 0] = self.traffic_districts
+        traffic[..., 1] = records["traffic"]
+
+        observation = [hospitals, emergencies, records["time"].astype(int), traffic]
+        if self.traffic_forecast:
+            forecast = np.empty(batch + (len(self.traffic_districts), self.traffic_forecast + 1))
+            forecast[..., 0] = self.traffic_districts
+            forecast[..., 1:] = records["forecast"]
+            observation.append(forecast)
+        if self.coverage_thresholds:
+            coverage = np.empty(batch + (len(self.zone_codes), self.coverage_thresholds + 1))
+            coverage[..., 0] = self.zone_codes
+            coverage[..., 1:] = records["coverage"]
+            observation.append(coverage)
+        if self.districts_table is not None:
+            observation.append(np.broadcast_to(self.districts_table, batch + self.districts_table.shape))
+        return observation
+
+    def masks(self, records):
+        return {"severity": records["severity_mask"], "hospital": records["hospital_mask"]}
+
+
+class _Producer():
+    """Writer of one ring of a TrajectoryBuffer."""
+
+    def __init__(self, buffer, index):
+        self.ring = buffer.records[index]
+        self.counters = buffer.counters
+        self.index = index
+        self.layout = buffer.layout
+        self.count = int(self.counters[index])
+        self.step = 0
+
+    def add(self, observation, action, reward, done, info=None):
+        """Store the transition from observation, the one action was taken on, and its info (the
+        one that came with observation, for the action mask), with the reward and done flag
+        returned by step.
+        """
+        slot = self.count % len(self.ring)
+        self.layout.encode(self.ring[slot : slot + 1], observation, action, reward, done, info, self.step)
+        self.step = 0 if done else self.step + 1
+        self.count += 1
+        self.counters[self.index] = self.count  # Publish after the record is complete
+
+
+class TrajectoryBuffer():
+    """Rings of transitions, one per producer, in shared memory or a memory mapped file.
+
+    Attributes:
+        layout: TransitionLayout of the records.
+        capacity: int, records per producer ring.
+        producers: int, number of rings.
+        name: str, name of the shared memory block (None for a file).
+        path: str, memory mapped file (None for shared memory).
+        records: np.ndarray (producers, capacity) of layout.dtype records.
+        counters: np.ndarray (producers,) int64, records written to every ring since creation.
+    """
+
+    def __init__(self, layout, capacity, producers=1, name=None, path=None, create=True):
+        self.layout = layout
+        self.capacity = capacity
+        self.producers = producers
+        self.path = path
+        header = 64 * ((8 * producers + 63) // 64)  # Counters, then the records cache aligned
+        size = header + producers * capacity * layout.dtype.itemsize
+        self._memory = None
+        if path is not None:
+            mode = "w+" if create or not os.path.isfile(path) else "r+"
+            buffer = self._memory = np.memmap(path, np.uint8, mode, shape=(size,))
+            self.name = None
+        else:
+            # Processes started with multiprocessing share the resource tracker of the creator,
+            # which only frees the block if it was not unlinked by close()
+            self._memory = shared_memory.SharedMemory(name, create=create, size=size)
+            buffer = self._memory.buf
+            self.name = self._memory.name
+        self._owner = create
+        self.counters = np.ndarray((producers,), np.int64, buffer, 0)
+        self.records = np.ndarray((producers, capacity), layout.dtype, buffer, header)
+        if create:
+            self.counters[:] = 0
+
+    def __getstate__(self):
+        return {
+            "layout": self.layout,
+            "capacity": self.capacity,
+            "producers": self.producers,
+            "name": self.name,
+            "path": self.path,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(create=False, **state)
+
+    @property
+    def nbytes(self):
+        return self.records.nbytes + self.counters.nbytes
+
+    def producer(self, index):
+        return _Producer(self, index)
+
+    def __len__(self):
+        counters = self.counters.copy()
+        return int((counters - self._valid_since(counters)).sum())
+
+    def _valid_since(self, counters):
+        """Oldest absolute index of every ring that no producer can be writing over: the next
+        record of a ring goes to the slot of index counter - capacity.
+        """
+        return np.maximum(counters - self.capacity + 1, 0)
+
+    def _gather(self, ring, index):
+        """Copies of the records at absolute indices of rings, and whether they are intact."""
+        records = self.records[ring, index % self.capacity]
+        intact = index >= self._valid_since(self.counters)[ring]
+        return records, intact
+
+    def _draw(self, rng, n, length):
+        """Rings and absolute start indices of n windows of length records written so far."""
+        counters = self.counters.copy()
+        oldest = self._valid_since(counters)
+        available = np.maximum(counters - oldest - length + 1, 0)
+        assert available.sum() > 0, "Not enough transitions in the buffer"
+        ring = rng.choice(self.producers, n, p=available / available.sum())
+        return ring, oldest[ring] + rng.randint(0, available[ring])
+
+    def sample(self, batch_size, rng=np.random):
+        """Random minibatch of transitions, as a dict of observations, masks, actions,
+        rewards, dones and next observations.
+        """
+        ring, start = self._draw(rng, batch_size, 2)
+        index = start[:, None] + np.arange(2)
+        records, intact = self._gather(ring[:, None], index)
+        keep = intact.all(axis=1)
+        records = records[keep]
+        return {
+            "observation": self.layout.decode(records[:, 0]),
+            "action_mask": self.layout.masks(records[:, 0]),
+            "action": records[:, 0]["action"].astype(np.int64),
+            "reward": records[:, 0]["reward"],
+            "done": records[:, 0]["done"],
+            "next_observation": self.layout.decode(records[:, 1]),
+        }
+
+    def sequences(self, batch_size, length, rng=np.random):
+        """Random contiguous sequences of length transitions of one producer, as a record array
+        (batch, length) to decode with layout.decode; sequences can go across episode ends,
+        marked by done.
+        """
+        ring, start = self._draw(rng, batch_size, length)
+        records, intact = self._gather(ring[:, None], start[:, None] + np.arange(length))
+        return records[intact.all(axis=1)]
+
+    def close(self):
+        """Detach, and free the shared memory block or flush the file when this is the buffer
+        that created it.
+        """
+        self.counters = self.records = None
+        if isinstance(self._memory, np.memmap):
+            self._memory.flush()
+        elif self._memory is not None:
+            self._memory.close()
+            if self._owner:
+                self._memory.unlink()
+        self._memory = None